@@ -0,0 +1,154 @@
+"""
+Micro-benchmark for DBFace postprocessing.
+
+Compares per-image decoding used previously (stride tricks max pooling, full heatmap argsort top-k and
+per-candidate numba loop) with batch-wide decoding in `DBFace.postprocess` on synthetic network outputs,
+for several batch sizes and face densities (fraction of heatmap cells with high score).
+
+Usage:
+    python benchmarks/dbface_decode.py --width 640 --height 480 --repeats 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from numba import njit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.dbface import DBFace
+
+
+@njit()
+def legacy_exp(v):
+    gate: int = 1
+    base = np.exp(1)
+
+    def a(v):
+        if abs(v) < gate:
+            return v * base
+        if v > 0:
+            return np.exp(v)
+        else:
+            return -np.exp(-v)
+
+    return np.array([a(item) for item in v], v.dtype)
+
+
+def legacy_max_pool2d(A, kernel_size=3, stride=1, padding=1):
+    A = np.pad(A, padding, mode='constant')
+    output_shape = ((A.shape[0] - kernel_size) // stride + 1, (A.shape[1] - kernel_size) // stride + 1)
+    kernel_size = (kernel_size, kernel_size)
+    A_w = np.lib.stride_tricks.as_strided(A,
+                                          shape=output_shape + kernel_size,
+                                          strides=(stride * A.strides[0], stride * A.strides[1]) + A.strides)
+    A_w = A_w.reshape(-1, *kernel_size)
+    return A_w.max(axis=(1, 2)).reshape(output_shape)
+
+
+def legacy_topk(hm_pool, hm, k):
+    ary = ((hm_pool == hm).astype(bool) * hm).reshape(-1)
+    indices = ary.argsort()[::-1][:k]
+    scores = ary[indices]
+    return scores, indices
+
+
+@njit()
+def legacy_bx_lm(box, landmark, scores, threshold, xs, ys):
+    size = xs.shape[0]
+    stride = 4
+    lms = np.zeros((size, 5, 2))
+    boxes = np.zeros((size, 5))
+    count = 0
+    for i in range(size):
+        if scores[i] < threshold:
+            break
+        x, y, r, b = box[:, ys[i], xs[i]]
+        xyrbs = (np.array([xs[i], ys[i], xs[i], ys[i], 0]) + np.array([-x, -y, r, b, 0])) * stride
+        xyrbs[4] = scores[i]
+        x5y5 = landmark[:, ys[i], xs[i]]
+        x5y5s = (legacy_exp(x5y5 * 4) + np.array([xs[i]] * 5 + [ys[i]] * 5)) * stride
+        box_landmark = np.dstack((x5y5s[:5], x5y5s[5:]))[0]
+        boxes[count] = xyrbs
+        lms[count] = box_landmark
+        count += 1
+    return boxes[:count], lms[:count]
+
+
+def legacy_postprocess(hm, box, landmark, threshold, nms_threshold):
+    dets, lmks = [], []
+    for i in range(hm.shape[0]):
+        hm_pool = legacy_max_pool2d(hm[i, 0, :, :], 3, 1, 1)[None, None]
+        scores, indices = legacy_topk(hm_pool, hm[i:i + 1], k=1000)
+        hm_width = hm.shape[3]
+        ys = indices // hm_width
+        xs = indices % hm_width
+        boxes, landmarks = legacy_bx_lm(box[i], landmark[i], scores, threshold, xs, ys)
+        boxes = np.asarray(boxes, dtype=np.float32)
+        keep = nms(boxes, nms_threshold)
+        dets.append(boxes[keep, :])
+        lmks.append(np.asarray(landmarks, dtype=np.float32)[keep, :])
+    return dets, lmks
+
+
+def make_outputs(batch_size, height, width, density, threshold, seed=0):
+    rng = np.random.default_rng(seed)
+    h, w = height // 4, width // 4
+    hm = rng.random((batch_size, 1, h, w), dtype=np.float32) * threshold
+    hits = rng.random((batch_size, 1, h, w)) < density
+    hm[hits] = threshold + (1 - threshold) * rng.random(int(hits.sum()), dtype=np.float32)
+    box = rng.random((batch_size, 4, h, w), dtype=np.float32) * 8
+    landmark = rng.normal(scale=0.3, size=(batch_size, 10, h, w)).astype(np.float32)
+    return hm, box, landmark
+
+
+def same(ref, out):
+    if out.shape != ref.shape or out.shape[0] == 0:
+        return out.shape == ref.shape
+    ia = np.lexsort(out.reshape(out.shape[0], -1).T[::-1])
+    ib = np.lexsort(ref.reshape(ref.shape[0], -1).T[::-1])
+    return np.allclose(out[ia], ref[ib], atol=1e-3)
+
+
+def timeit(func, repeats):
+    func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(height: int = 480, width: int = 640, repeats: int = 20, threshold: float = 0.4, batch_sizes=(1, 4, 16),
+        densities=(0.0001, 0.001, 0.01, 0.05)):
+    detector = DBFace(inference_backend=None)
+
+    print(f'{"batch":>5} {"density":>8} {"faces/img":>9} {"loop ms":>9} {"vector ms":>9} {"speedup":>8}')
+    for batch_size in batch_sizes:
+        for density in densities:
+            hm, box, landmark = make_outputs(batch_size, height, width, density, threshold)
+            ref_dets, ref_lmks = legacy_postprocess(hm, box, landmark, threshold, detector.nms_threshold)
+            dets, lmks = detector.postprocess(hm, box, landmark, threshold)
+            assert all(same(a, b) for a, b in zip(ref_dets, dets))
+            assert all(same(a, b) for a, b in zip(ref_lmks, lmks))
+
+            t_loop = timeit(lambda: legacy_postprocess(hm, box, landmark, threshold, detector.nms_threshold),
+                            repeats)
+            t_vec = timeit(lambda: detector.postprocess(hm, box, landmark, threshold), repeats)
+            faces = sum(len(e) for e in dets) / batch_size
+            print(f'{batch_size:>5} {density:>8} {faces:>9.1f} {t_loop:>9.3f} {t_vec:>9.3f} '
+                  f'{t_loop / t_vec:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='DBFace postprocessing benchmark')
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threshold', type=float, default=0.4)
+    args = parser.parse_args()
+    run(args.height, args.width, args.repeats, args.threshold)
@@ -0,0 +1,231 @@
+"""
+Micro-benchmark for face alignment.
+
+Compares per-face Umeyama estimation used previously (numba loop with SVD, matrix rank and determinants
+for every face) with batched closed-form similarity transform in `fast_face_align.estimate_norm_batch`,
+and full `norm_crop_batched` alignment, on synthetic landmarks for several numbers of faces.
+
+Usage:
+    python benchmarks/face_align.py --repeats 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numba as nb
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.utils import fast_face_align as face_align
+from if_rest.core.utils.fast_face_align import arcface_src
+
+
+@nb.njit(cache=True, fastmath=True)
+def np_mean(array, axis):
+    """
+    Compute mean of a 2D array along axis 0 or 1.
+    Returns a 1D array of means for the other axis.
+    """
+    assert array.ndim == 2
+    assert axis in (0, 1)
+    if axis == 0:
+        out = np.empty(array.shape[1], dtype=np.double)
+        n = array.shape[0]
+        for j in range(array.shape[1]):
+            s = 0.0
+            for i in range(n):
+                s += array[i, j]
+            out[j] = s / n
+        return out
+    else:
+        out = np.empty(array.shape[0], dtype=np.double)
+        n = array.shape[1]
+        for i in range(array.shape[0]):
+            s = 0.0
+            for j in range(n):
+                s += array[i, j]
+            out[i] = s / n
+        return out
+
+
+@nb.njit(cache=True, fastmath=True)
+def np_var(array, axis):
+    """
+    Compute variance of a 2D array along axis 0 or 1.
+    """
+    assert array.ndim == 2
+    assert axis in (0, 1)
+    if axis == 0:
+        mean = np_mean(array, 0)
+        out = np.empty(array.shape[1], dtype=np.double)
+        n = array.shape[0]
+        for j in range(array.shape[1]):
+            s = 0.0
+            m = mean[j]
+            for i in range(n):
+                d = array[i, j] - m
+                s += d * d
+            out[j] = s / n
+        return out
+    else:
+        mean = np_mean(array, 1)
+        out = np.empty(array.shape[0], dtype=np.double)
+        n = array.shape[1]
+        for i in range(array.shape[0]):
+            s = 0.0
+            m = mean[i]
+            for j in range(n):
+                d = array[i, j] - m
+                s += d * d
+            out[i] = s / n
+        return out
+
+
+@nb.njit(cache=True, fastmath=True)
+def np_std(array, axis):
+    """
+    Compute standard deviation of a 2D array along axis 0 or 1.
+    """
+    v = np_var(array, axis)
+    out = np.empty(v.shape[0], dtype=np.double)
+    for i in range(v.shape[0]):
+        out[i] = np.sqrt(v[i])
+    return out
+
+
+@nb.njit(fastmath=True, cache=True)
+def _umeyama(src, dst, estimate_scale):
+    """
+    Estimates the transformation matrix using the Umeyama algorithm.
+
+    Args:
+        src: The source points.
+        dst: The destination points.
+        estimate_scale: Whether to estimate the scale factor.
+
+    Returns:
+        A 3x3 transformation matrix.
+    """
+    num = src.shape[0]
+    dim = src.shape[1]
+
+    # Compute mean of src and dst.
+    src_mean = np_mean(src, 0)
+    dst_mean = np_mean(dst, 0)
+
+    # Subtract mean from src and dst.
+    src_demean = src - src_mean
+    dst_demean = dst - dst_mean
+
+    # Eq. (38).
+    A = dst_demean.T @ src_demean / num
+
+    # Eq. (39).
+    d = np.ones((dim,), dtype=np.double)
+    if np.linalg.det(A) < 0:
+        d[dim - 1] = -1
+
+    T = np.eye(dim + 1, dtype=np.double)
+
+    U, S, V = np.linalg.svd(A)
+
+    # Eq. (40) and (43).
+    rank = np.linalg.matrix_rank(A)
+    if rank == 0:
+        return np.nan * T
+    elif rank == dim - 1:
+        if np.linalg.det(U) * np.linalg.det(V) > 0:
+            T[:dim, :dim] = U @ V
+        else:
+            s = d[dim - 1]
+            d[dim - 1] = -1
+            T[:dim, :dim] = U @ np.diag(d) @ V
+            d[dim - 1] = s
+    else:
+        T[:dim, :dim] = U @ np.diag(d) @ V
+
+    scale = 1.0
+    if estimate_scale:
+        # Eq. (41) and (42).
+        div = np_var(src_demean, 0)
+        div = np.sum(div)
+        scale = scale / div * (S @ d)
+
+    T[:dim, dim] = dst_mean - scale * (np.ascontiguousarray(T[:dim, :dim]) @ np.ascontiguousarray(src_mean.T))
+    T[:dim, :dim] *= scale
+
+    return T
+
+
+
+@nb.njit(cache=True, fastmath=True)
+def legacy_estimate_norm_batch(lmks):
+    Ms = []
+    for lmk in lmks:
+        Ms.append(_umeyama(lmk, arcface_src[0], True)[0:2, :])
+    return Ms
+
+
+def legacy_norm_crop_batched(img, landmarks, image_size=112):
+    crops = []
+    for M in legacy_estimate_norm_batch(landmarks):
+        crops.append(cv2.warpAffine(img, M, (image_size, image_size), borderValue=0.0))
+    return crops
+
+
+def make_landmarks(faces, image_size=(1080, 1920), seed=0):
+    """
+    Reference landmarks randomly scaled, rotated, shifted and distorted with noise.
+    """
+    rng = np.random.default_rng(seed)
+    h, w = image_size
+    ref = arcface_src[0] - arcface_src[0].mean(axis=0)
+    scale = rng.uniform(0.3, 3., faces)
+    theta = rng.uniform(-np.pi / 3, np.pi / 3, faces)
+    rot = np.stack([np.stack([np.cos(theta), -np.sin(theta)], -1), np.stack([np.sin(theta), np.cos(theta)], -1)], 1)
+    lmks = np.einsum('nij,kj->nki', rot, ref) * scale[:, None, None]
+    lmks += rng.normal(scale=2., size=lmks.shape)
+    lmks += np.stack([rng.uniform(100, w - 100, faces), rng.uniform(100, h - 100, faces)], -1)[:, None, :]
+    return lmks.astype(np.float32)
+
+
+def timeit(func, repeats):
+    func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(repeats: int = 50, faces_counts=(1, 10, 200)):
+    img = np.random.default_rng(0).integers(0, 255, (1080, 1920, 3), dtype=np.uint8)
+
+    print(f'{"faces":>5} {"umeyama ms":>10} {"closed ms":>9} {"speedup":>8} '
+          f'{"crop loop ms":>12} {"crop new ms":>11} {"speedup":>8}')
+    for faces in faces_counts:
+        lmks = make_landmarks(faces)
+        ref = np.array(legacy_estimate_norm_batch(lmks))
+        out = face_align.estimate_norm_batch(lmks)
+        assert np.allclose(ref, out, rtol=1e-4, atol=1e-3)
+        ref_crops = np.stack(legacy_norm_crop_batched(img, lmks))
+        crops = np.stack(face_align.norm_crop_batched(img, lmks))
+        assert np.abs(ref_crops.astype(np.int16) - crops).max() <= 1
+
+        t_loop = timeit(lambda: legacy_estimate_norm_batch(lmks), repeats)
+        t_vec = timeit(lambda: face_align.estimate_norm_batch(lmks), repeats)
+        t_crop_loop = timeit(lambda: legacy_norm_crop_batched(img, lmks), repeats)
+        t_crop_vec = timeit(lambda: face_align.norm_crop_batched(img, lmks), repeats)
+        print(f'{faces:>5} {t_loop:>10.3f} {t_vec:>9.3f} {t_loop / t_vec:>7.2f}x '
+              f'{t_crop_loop:>12.3f} {t_crop_vec:>11.3f} {t_crop_loop / t_crop_vec:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Face alignment benchmark')
+    parser.add_argument('--repeats', type=int, default=50)
+    args = parser.parse_args()
+    run(args.repeats)
@@ -0,0 +1,86 @@
+"""
+Micro-benchmark for NMS.
+
+Compares per-image `nms` with batched `batched_nms` on synthetic crowd images, where every face
+produces a cluster of overlapping proposals, and checks that both keep the same boxes.
+
+Usage:
+    python benchmarks/nms.py --faces 100 --proposals-per-face 8 --repeats 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.model_zoo.detectors.common.nms import nms, batched_nms
+
+
+def make_proposals(faces, per_face, size=1920, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.random((faces, 2)) * size
+    sizes = rng.uniform(16, 128, faces)
+    centers = np.repeat(centers, per_face, axis=0) + rng.normal(scale=3, size=(faces * per_face, 2))
+    sizes = np.repeat(sizes, per_face) * rng.uniform(0.9, 1.1, faces * per_face)
+    dets = np.empty((faces * per_face, 5), dtype=np.float32)
+    dets[:, 0:2] = centers - sizes[:, None] / 2
+    dets[:, 2:4] = centers + sizes[:, None] / 2
+    dets[:, 4] = rng.uniform(0.5, 1, faces * per_face)
+    return dets
+
+
+def per_image(dets_list, thresh):
+    return [dets[np.asarray(nms(dets, thresh=thresh), dtype=np.int64)] for dets in dets_list]
+
+
+def batched(dets_list, thresh, limit=0):
+    dets = np.concatenate(dets_list)
+    counts = np.array([e.shape[0] for e in dets_list])
+    keep, kept_counts = batched_nms(dets, counts, thresh=thresh, limit=limit)
+    return np.split(dets[keep], np.cumsum(kept_counts)[:-1])
+
+
+def timeit(func, repeats):
+    func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(faces: int = 100, per_face: int = 8, repeats: int = 20, thresh: float = 0.4, batch_sizes=(1, 4, 16),
+        limit: int = 5):
+    print(f'{"batch":>5} {"props/img":>9} {"nms ms":>9} {"batched ms":>10} {"speedup":>8} '
+          f'{"limit":>5} {"limited ms":>10}')
+    for batch_size in batch_sizes:
+        dets_list = [make_proposals(faces, per_face, seed=i) for i in range(batch_size)]
+
+        ref = per_image(dets_list, thresh)
+        out = batched(dets_list, thresh)
+        for a, b in zip(ref, out):
+            assert np.array_equal(a, b)
+        limited = batched(dets_list, thresh, limit=limit)
+        for a, b in zip(ref, limited):
+            assert np.array_equal(a[:limit], b)
+
+        t_ref = timeit(lambda: per_image(dets_list, thresh), repeats)
+        t_out = timeit(lambda: batched(dets_list, thresh), repeats)
+        t_lim = timeit(lambda: batched(dets_list, thresh, limit=limit), repeats)
+        print(f'{batch_size:>5} {faces * per_face:>9} {t_ref:>9.3f} {t_out:>10.3f} {t_ref / t_out:>7.2f}x '
+              f'{limit:>5} {t_lim:>10.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='NMS benchmark')
+    parser.add_argument('--faces', type=int, default=100)
+    parser.add_argument('--proposals-per-face', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threshold', type=float, default=0.4)
+    parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+    run(args.faces, args.proposals_per_face, args.repeats, args.threshold, limit=args.limit)
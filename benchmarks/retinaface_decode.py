@@ -0,0 +1,147 @@
+"""
+Micro-benchmark for RetinaFace postprocessing.
+
+Compares per-image decoding used previously (all anchors decoded, then filtered by threshold) with
+batch-wide decoding of above-threshold anchors only in `RetinaFace.postprocess` on synthetic network
+outputs, for several batch sizes and face densities (fraction of anchors passing detection threshold).
+Densities are given per stride, so cases with some or all strides having no proposals are covered too.
+
+Usage:
+    python benchmarks/retinaface_decode.py --width 640 --height 480 --repeats 20
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.retinaface import RetinaFace, bbox_pred
+
+
+class SyntheticBackend:
+    def __init__(self, height, width):
+        self.input_shape = (1, 3, height, width)
+
+    def prepare(self):
+        pass
+
+
+def legacy_landmark_pred(boxes, landmark_deltas):
+    if boxes.shape[0] == 0:
+        return np.zeros((0, landmark_deltas.shape[1]))
+    boxes = boxes.astype(np.float64, copy=False)
+    widths = boxes[:, 2] - boxes[:, 0] + 1.0
+    heights = boxes[:, 3] - boxes[:, 1] + 1.0
+    ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
+    ctr_y = boxes[:, 1] + 0.5 * (heights - 1.0)
+    pred = landmark_deltas.copy()
+    for i in range(5):
+        pred[:, i, 0] = landmark_deltas[:, i, 0] * widths + ctr_x
+        pred[:, i, 1] = landmark_deltas[:, i, 1] * heights + ctr_y
+    return pred
+
+
+def legacy_postprocess(detector, net_out, threshold):
+    dets, lmks = [], []
+    for img in range(net_out[0].shape[0]):
+        proposals_list, scores_list, landmarks_list = [], [], []
+        for _idx, s in enumerate(detector._feat_stride_fpn):
+            idx = _idx * 3
+            A = detector._num_anchors['stride%s' % s]
+            scores = net_out[idx][img:img + 1, A:, :, :]
+            bbox_deltas = net_out[idx + 1][img:img + 1]
+            height, width = bbox_deltas.shape[2], bbox_deltas.shape[3]
+            anchors = detector._get_anchors(height, width, s)
+
+            scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+            bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1)).reshape((-1, 4))
+            order = np.where(scores.ravel() >= threshold)[0]
+            proposals_list.append(bbox_pred(anchors, bbox_deltas)[order, :])
+            scores_list.append(scores[order])
+
+            landmark_deltas = net_out[idx + 2][img:img + 1]
+            landmark_deltas = landmark_deltas.transpose((0, 2, 3, 1)).reshape((-1, 5, 2)) * detector.landmark_std
+            landmarks_list.append(legacy_landmark_pred(anchors, landmark_deltas)[order, :])
+
+        proposals = np.vstack(proposals_list)
+        if proposals.shape[0] == 0:
+            dets.append(np.zeros((0, 5)))
+            lmks.append(np.zeros((0, 5, 2)))
+            continue
+        scores = np.vstack(scores_list)
+        order = scores.ravel().argsort()[::-1]
+        pre_det = np.hstack((proposals[order, 0:4], scores[order])).astype(np.float32, copy=False)
+        keep = nms(pre_det, detector.nms_threshold)
+        dets.append(pre_det[keep, :])
+        lmks.append(np.vstack(landmarks_list)[order].astype(np.float32, copy=False)[keep])
+    return dets, lmks
+
+
+def make_outputs(detector, batch_size, height, width, densities, threshold, seed=0):
+    rng = np.random.default_rng(seed)
+    net_out = []
+    for s, density in zip(detector._feat_stride_fpn, densities):
+        A = detector._num_anchors['stride%s' % s]
+        h, w = int(np.ceil(height / s)), int(np.ceil(width / s))
+        scores = rng.random((batch_size, A, h, w), dtype=np.float32) * threshold
+        hits = rng.random((batch_size, A, h, w)) < density
+        scores[hits] = threshold + (1 - threshold) * rng.random(int(hits.sum()), dtype=np.float32)
+        net_out += [np.concatenate([1 - scores, scores], axis=1),
+                    rng.normal(scale=0.2, size=(batch_size, A * 4, h, w)).astype(np.float32),
+                    rng.normal(scale=0.5, size=(batch_size, A * 10, h, w)).astype(np.float32)]
+    return net_out
+
+
+def same(ref, out):
+    if out.shape[0] == 0 or ref.shape[0] == 0:
+        return out.shape[0] == ref.shape[0]
+    ia = np.lexsort(out.reshape(out.shape[0], -1).T[::-1])
+    ib = np.lexsort(ref.reshape(ref.shape[0], -1).T[::-1])
+    return out.shape == ref.shape and np.allclose(out[ia], ref[ib], atol=1e-3)
+
+
+def timeit(func, repeats):
+    func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(height: int = 480, width: int = 640, repeats: int = 20, threshold: float = 0.6, batch_sizes=(1, 4, 16),
+        densities=((0., 0., 0.), (0.01, 0., 0.), (0., 0., 0.001), (0.001,) * 3, (0.01,) * 3)):
+    detector = RetinaFace(inference_backend=SyntheticBackend(height, width), rac='net3l')
+    detector.prepare()
+
+    print(f'{"batch":>5} {"densities (32/16/8)":>20} {"faces/img":>9} {"loop ms":>9} {"vector ms":>9} '
+          f'{"speedup":>8}')
+    for batch_size in batch_sizes:
+        for density in densities:
+            net_out = make_outputs(detector, batch_size, height, width, density, threshold)
+            ref_dets, ref_lmks = legacy_postprocess(detector, net_out, threshold)
+            dets, lmks = detector.postprocess(net_out, threshold, batch_size)
+            assert all(e.shape[1:] == (5, 2) for e in lmks)
+            assert all(same(a, b) for a, b in zip(ref_dets, dets))
+            assert all(same(a, b) for a, b in zip(ref_lmks, lmks))
+
+            t_loop = timeit(lambda: legacy_postprocess(detector, net_out, threshold), repeats)
+            t_vec = timeit(lambda: detector.postprocess(net_out, threshold, batch_size), repeats)
+            faces = sum(len(e) for e in dets) / batch_size
+            print(f'{batch_size:>5} {"/".join(map(str, density)):>20} {faces:>9.1f} {t_loop:>9.3f} '
+                  f'{t_vec:>9.3f} {t_loop / t_vec:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='RetinaFace postprocessing benchmark')
+    parser.add_argument('--height', type=int, default=480)
+    parser.add_argument('--width', type=int, default=640)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--threshold', type=float, default=0.6)
+    args = parser.parse_args()
+    run(args.height, args.width, args.repeats, args.threshold)
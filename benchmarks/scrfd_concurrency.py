@@ -0,0 +1,97 @@
+"""
+Stress test for SCRFD postprocessing thread safety.
+
+Runs single SCRFD instance from multiple threads on synthetic network outputs and checks that results
+are identical to sequential runs.
+
+Usage:
+    python benchmarks/scrfd_concurrency.py --threads 16 --iterations 500
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.model_zoo.detectors.scrfd import SCRFD
+
+
+class SyntheticSCRFDInfer:
+    """
+    Inference backend stub returning SCRFD-like outputs derived from input content.
+    """
+
+    def __init__(self, input_shape=(1, 3, 640, 640), strides=(8, 16, 32), num_anchors=2):
+        self.input_shape = input_shape
+        self.out_shapes = None
+        self.strides = strides
+        self.num_anchors = num_anchors
+
+    def prepare(self, **kwargs):
+        pass
+
+    def run(self, blob):
+        n, _, h, w = blob.shape
+        scores, bboxes, kpss = [], [], []
+        for stride in self.strides:
+            k = (h // stride) * (w // stride) * self.num_anchors
+            s_out = np.empty((n, k, 1), dtype=np.float32)
+            b_out = np.empty((n, k, 4), dtype=np.float32)
+            p_out = np.empty((n, k, 10), dtype=np.float32)
+            for i in range(n):
+                seed = int(np.abs(blob[i, :, ::16, ::16]).sum() * 1000) % (2 ** 32) + stride
+                rng = np.random.default_rng(seed)
+                s_out[i] = rng.random((k, 1), dtype=np.float32) ** 16
+                b_out[i] = rng.random((k, 4), dtype=np.float32) * 4
+                p_out[i] = rng.normal(size=(k, 10)).astype(np.float32)
+            scores.append(s_out)
+            bboxes.append(b_out)
+            kpss.append(p_out)
+        return scores + bboxes + kpss
+
+
+def make_inputs(count, sizes, seed=0):
+    rng = np.random.default_rng(seed)
+    inputs = []
+    for i in range(count):
+        size = sizes[i % len(sizes)]
+        batch = 1 + i % 3
+        inputs.append(rng.integers(0, 255, (batch, size, size, 3), dtype=np.uint8))
+    return inputs
+
+
+def same(a, b):
+    return all(np.array_equal(x, y) for x, y in zip(a, b)) and len(a) == len(b)
+
+
+def run(threads: int = 16, iterations: int = 500, threshold: float = 0.5):
+    detector = SCRFD(inference_backend=SyntheticSCRFDInfer())
+    detector.prepare()
+
+    inputs = make_inputs(12, sizes=(640, 320, 480))
+    reference = [detector.detect(imgs, threshold=threshold) for imgs in inputs]
+
+    def task(i):
+        idx = i % len(inputs)
+        dets, kpss = detector.detect(inputs[idx], threshold=threshold)
+        ref_dets, ref_kpss = reference[idx]
+        return same(dets, ref_dets) and same(kpss, ref_kpss)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(task, range(iterations)))
+
+    mismatches = results.count(False)
+    print(f'Threads: {threads}, iterations: {iterations}, mismatches: {mismatches}')
+    return mismatches == 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCRFD concurrency stress test')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+    sys.exit(0 if run(args.threads, args.iterations, args.threshold) else 1)
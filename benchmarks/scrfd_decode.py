@@ -0,0 +1,118 @@
+"""
+Micro-benchmark for SCRFD proposal decoding.
+
+Compares per-image, per-stride numba decoding loop used previously with batch-wide vectorized
+decoding in `SCRFD._process_strides` on synthetic network outputs, for several batch sizes and
+face densities (fraction of anchors passing detection threshold).
+
+Usage:
+    python benchmarks/scrfd_decode.py --size 640 --repeats 50
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+from numba import njit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from if_rest.core.model_zoo.detectors.scrfd import SCRFD
+
+
+@njit(fastmath=True, cache=True)
+def generate_proposals(score_blob, bbox_blob, kpss_blob, stride, anchors, threshold, score_out, bbox_out, kpss_out,
+                       offset):
+    total = offset
+    for ix in range(0, anchors.shape[0]):
+        if score_blob[ix, 0] > threshold:
+            score_out[total] = score_blob[ix]
+            point = anchors[ix]
+            distance = bbox_blob[ix]
+            bbox_out[total, 0] = point[0] - distance[0] * stride
+            bbox_out[total, 1] = point[1] - distance[1] * stride
+            bbox_out[total, 2] = point[0] + distance[2] * stride
+            bbox_out[total, 3] = point[1] + distance[3] * stride
+            distance = kpss_blob[ix]
+            for k in range(0, distance.shape[0], 2):
+                kpss_out[total, k] = distance[k] * stride + point[0]
+                kpss_out[total, k + 1] = distance[k + 1] * stride + point[1]
+            total += 1
+    return score_out, bbox_out, kpss_out, total
+
+
+def legacy_process_strides(detector, net_outs, threshold, anchor_centers, batch_size):
+    max_prop_len = sum(e.shape[0] for e in anchor_centers)
+    score_list = np.zeros((max_prop_len, 1), dtype='float32')
+    bbox_list = np.zeros((max_prop_len, 4), dtype='float32')
+    kpss_list = np.zeros((max_prop_len, 10), dtype='float32')
+    bboxes_by_img, kpss_by_img, scores_by_img = [], [], []
+
+    for n_img in range(batch_size):
+        offset = 0
+        for idx, stride in enumerate(detector._feat_stride_fpn):
+            score_list, bbox_list, kpss_list, offset = generate_proposals(
+                net_outs[idx][n_img], net_outs[idx + detector.fmc][n_img], net_outs[idx + detector.fmc * 2][n_img],
+                stride, anchor_centers[idx], threshold, score_list, bbox_list, kpss_list, offset)
+        bboxes_by_img.append(np.copy(bbox_list[:offset]))
+        kpss_by_img.append(np.copy(kpss_list[:offset]))
+        scores_by_img.append(np.copy(score_list[:offset]))
+    return bboxes_by_img, kpss_by_img, scores_by_img
+
+
+def make_outputs(batch_size, size, density, threshold, strides=(8, 16, 32), num_anchors=2, seed=0):
+    rng = np.random.default_rng(seed)
+    scores, bboxes, kpss = [], [], []
+    for stride in strides:
+        k = (size // stride) ** 2 * num_anchors
+        score = rng.random((batch_size, k, 1), dtype=np.float32) * threshold
+        hits = rng.random((batch_size, k, 1)) < density
+        score[hits] = threshold + (1 - threshold) * rng.random(int(hits.sum()), dtype=np.float32)
+        scores.append(score)
+        bboxes.append(rng.random((batch_size, k, 4), dtype=np.float32) * 4)
+        kpss.append(rng.normal(size=(batch_size, k, 10)).astype(np.float32))
+    return scores + bboxes + kpss
+
+
+def timeit(func, repeats):
+    func()
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return np.median(times) * 1000
+
+
+def run(size: int = 640, repeats: int = 50, threshold: float = 0.5, batch_sizes=(1, 4, 16),
+        densities=(0.0001, 0.001, 0.01, 0.05)):
+    detector = SCRFD(inference_backend=None)
+    anchor_centers = detector._build_anchors(size, size, detector._feat_stride_fpn, detector._num_anchors)
+
+    print(f'{"batch":>5} {"density":>8} {"props/img":>9} {"loop ms":>9} {"vector ms":>9} {"speedup":>8}')
+    for batch_size in batch_sizes:
+        for density in densities:
+            net_outs = make_outputs(batch_size, size, density, threshold)
+            legacy = legacy_process_strides(detector, net_outs, threshold, anchor_centers, batch_size)
+            *batched, counts = detector._process_strides(net_outs, threshold, anchor_centers, batch_size)
+            for ref, out in zip(legacy, batched):
+                out = np.split(out, np.cumsum(counts)[:-1])
+                assert all(np.allclose(a, b, atol=1e-4) for a, b in zip(ref, out))
+
+            t_loop = timeit(lambda: legacy_process_strides(detector, net_outs, threshold, anchor_centers,
+                                                           batch_size), repeats)
+            t_vec = timeit(lambda: detector._process_strides(net_outs, threshold, anchor_centers, batch_size),
+                           repeats)
+            proposals = counts.sum() / batch_size
+            print(f'{batch_size:>5} {density:>8} {proposals:>9.1f} {t_loop:>9.3f} {t_vec:>9.3f} '
+                  f'{t_loop / t_vec:>7.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SCRFD proposal decoding benchmark')
+    parser.add_argument('--size', type=int, default=640)
+    parser.add_argument('--repeats', type=int, default=50)
+    parser.add_argument('--threshold', type=float, default=0.5)
+    args = parser.parse_args()
+    run(args.size, args.repeats, args.threshold)
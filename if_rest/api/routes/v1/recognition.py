@@ -60,6 +60,9 @@ async def extract(data: BodyExtract,
        - **extract_embedding**: Extract face embeddings (otherwise only detect faces). Default: True (*optional*)
        - **extract_ga**: Extract gender/age. Default: False (*optional*)
        - **limit_faces**: Maximum number of faces to be processed.  0 for unlimited number. Default: 0 (*optional*)
+       - **det_resolution**: Pin detector resolution, otherwise selected per image. Default: None (*optional*)
+       - **det_tiling**: Detect faces of large images in overlapping tiles. Default: False (*optional*)
+       - **det_refine**: Re-detect small faces found by coarse pass at higher resolution. Default: False (*optional*)
        - **verbose_timings**: Return all timings. Default: False (*optional*)
        - **msgpack**: Serialize output to msgpack format for transfer. Default: False (*optional*)
        \f
@@ -77,6 +80,9 @@ async def extract(data: BodyExtract,
                                             limit_faces=data.limit_faces, min_face_size=data.min_face_size,
                                             return_landmarks=data.return_landmarks,
                                             detect_masks=data.detect_masks,
+                                            det_resolution=data.det_resolution,
+                                            det_tiling=data.det_tiling,
+                                            det_refine=data.det_refine,
                                             verbose_timings=data.verbose_timings, b64_decode=b64_decode,
                                             img_req_headers=data.img_req_headers)
 
@@ -105,7 +111,10 @@ async def draw(data: BodyDraw,
                                        draw_landmarks=data.draw_landmarks, draw_scores=data.draw_scores,
                                        limit_faces=data.limit_faces, min_face_size=data.min_face_size,
                                        draw_sizes=data.draw_sizes,
-                                       detect_masks=data.detect_masks)
+                                       detect_masks=data.detect_masks,
+                                       det_resolution=data.det_resolution,
+                                       det_tiling=data.det_tiling,
+                                       det_refine=data.det_refine)
         output.seek(0)
         return StreamingResponse(output, media_type="image/png")
     except Exception as e:
@@ -168,10 +177,11 @@ async def compare(data: BodyCompare,
             raise HTTPException(status_code=400, detail='Please provide exactly two images (in urls or data)')
 
         # Use processing.extract to fetch images and compute embeddings (limit faces sufficiently high so face_index is valid)
-        # We set limit_faces to 0 (no limit) so we can pick face_index later
+        # We set limit_faces to 0 (no limit) so we can pick face_index later, overload controller must not
+        # cap faces number, since it would change face ordering
         out = await processing.extract(imgs, threshold=data.threshold, limit_faces=0,
                                        extract_embedding=True, extract_ga=False,
-                                       return_face_data=False)
+                                       return_face_data=False, degradable=False)
 
         if not out or 'data' not in out or len(out['data']) < 2:
             raise HTTPException(status_code=400, detail='Failed to process provided images')
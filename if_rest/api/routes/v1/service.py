@@ -46,7 +46,7 @@ async def check_health(processing: ProcessingDep):
     data = Images(urls=["test_images/Stallone.jpg"])
 
     try:
-        res = await processing.extract(images=data)
+        res = await processing.extract(images=data, degradable=False)
         faces = res.get('data', [{}])[0].get('faces', [])
         assert len(faces) >= 1
         return {'status': 'ok'}
@@ -54,6 +54,18 @@ async def check_health(processing: ProcessingDep):
         raise HTTPException(500, detail='self check failed')
 
 
+@router.get('/stats', tags=['Utility'])
+async def stats(processing: ProcessingDep):
+    """
+    Report runtime statistics of processing pipeline, like batch schedulers queue depth and realized batch sizes.
+
+    """
+    try:
+        return processing.stats()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.get('/', include_in_schema=False)
 async def redirect_to_docs():
     return RedirectResponse(url="/docs")
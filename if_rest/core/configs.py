@@ -18,6 +18,7 @@ class Configs(object):
         self.models_dir = self.__get_param('MODELS_DIR', models_dir)
         self.onnx_models_dir = os.path.join(self.models_dir, 'onnx')
         self.trt_engines_dir = os.path.join(self.models_dir, 'trt-engines')
+        self.onnx_cache_dir = os.path.join(self.models_dir, 'onnx-cache')
         self.models = self.__read_models_file()
         self.type2path = dict(
             onnx=self.onnx_models_dir,
@@ -0,0 +1,118 @@
+from typing import List
+
+import onnx
+from onnx import compose, helper, version_converter
+
+from if_rest.core.converters.reshape_onnx import preprocessing_nodes
+from if_rest.logger import logger
+
+
+def _load(model):
+    if isinstance(model, onnx.ModelProto):
+        return model
+    if isinstance(model, bytes):
+        return onnx.load_from_string(model)
+    return onnx.load(model)
+
+
+def _opset(model: onnx.ModelProto, domain: str = '') -> int:
+    for opset in model.opset_import:
+        if opset.domain == domain or (domain == '' and opset.domain == 'ai.onnx'):
+            return opset.version
+    return 0
+
+
+def _graph_input(model: onnx.ModelProto) -> onnx.ValueInfoProto:
+    # Models with ir_version < 4 list initializers among graph inputs
+    initializers = {e.name for e in model.graph.initializer}
+    return [e for e in model.graph.input if e.name not in initializers][0]
+
+
+def merge_heads(heads: List[dict], input_name: str = 'data', image_size: int = 112) -> onnx.ModelProto:
+    """
+    Compose face processing models into single multi-output ONNX graph with shared uint8 input.
+
+    Every head is fed with its own normalization of shared (N, image_size, image_size, 3) BGR uint8 crops,
+    cast and channel swap are computed once for all heads. Head tensors are prefixed with head name, graph
+    outputs are outputs of all heads in heads order.
+
+    Args:
+        heads (List[dict]): Heads description dicts with keys: `name` - unique head name, `model` - path,
+                            serialized model or onnx.ModelProto, `mean`, `std` - normalization parameters,
+                            `swap_rb` - feed RGB crops, `nchw` - head expects NCHW input.
+        input_name (str): Name of shared input.
+        image_size (int): Crops size.
+
+    Returns:
+        onnx.ModelProto: Merged model.
+    """
+    models = [_load(head['model']) for head in heads]
+    opset = max(_opset(model) for model in models)
+    # Initializers are no longer listed among graph inputs
+    ir_version = max([4] + [model.ir_version for model in models])
+
+    batch = None
+    nodes, initializers, value_info, outputs = [], [], [], []
+    cache = {}
+    for head, model in zip(heads, models):
+        name = head['name']
+        if _opset(model) != opset:
+            logger.info(f"Converting '{name}' head from opset {_opset(model)} to {opset}")
+            model = version_converter.convert_version(model, opset)
+        head_input = _graph_input(model)
+        if batch is None:
+            batch = head_input.type.tensor_type.shape.dim[0]
+        model = compose.add_prefix(model, f'{name}/')
+        head_input_name = f'{name}/{head_input.name}'
+
+        if head_input.type.tensor_type.elem_type == onnx.TensorProto.UINT8:
+            # Head with folded preprocessing takes crops as is
+            nodes.append(helper.make_node('Identity', [input_name], [head_input_name], name=f'{name}/input'))
+        else:
+            pre_nodes, pre_initializers = preprocessing_nodes(input_name, head_input_name,
+                                                              mean=head.get('mean', 0.), std=head.get('std', 1.),
+                                                              swap_rb=head.get('swap_rb', False),
+                                                              nchw=head.get('nchw', True), prefix=f'{name}/pre',
+                                                              cache=cache)
+            nodes += pre_nodes
+            initializers += pre_initializers
+        nodes += model.graph.node
+        initializers += model.graph.initializer
+        value_info += model.graph.value_info
+        for output in model.graph.output:
+            dims = output.type.tensor_type.shape.dim
+            if len(dims):
+                dims[0].CopyFrom(batch)
+            outputs.append(output)
+
+    shape = [None, image_size, image_size, 3]
+    graph_input = helper.make_tensor_value_info(input_name, onnx.TensorProto.UINT8, shape)
+    graph_input.type.tensor_type.shape.dim[0].CopyFrom(batch)
+    graph = helper.make_graph(nodes, 'merged_heads', [graph_input], outputs, initializer=initializers,
+                              value_info=value_info)
+    domains = {e.domain for model in models for e in model.opset_import if e.domain not in ('', 'ai.onnx')}
+    opset_imports = [helper.make_opsetid('', opset)]
+    opset_imports += [helper.make_opsetid(domain, max(_opset(model, domain) for model in models))
+                      for domain in sorted(domains)]
+    merged = helper.make_model(graph, opset_imports=opset_imports)
+    merged.ir_version = ir_version
+    onnx.checker.check_model(merged)
+    return merged
+
+
+def merge_heads_onnx(heads: List[dict], out_path: str, input_name: str = 'data', image_size: int = 112):
+    """
+    Compose face processing ONNX files into single multi-output ONNX file.
+
+    Args:
+        heads (List[dict]): Heads description, see `merge_heads`.
+        out_path (str): Path to output ONNX file
+        input_name (str): Name of shared input.
+        image_size (int): Crops size.
+
+    Returns:
+        None
+    """
+    merged = merge_heads(heads, input_name=input_name, image_size=image_size)
+    with open(out_path, "wb") as file_handle:
+        file_handle.write(merged.SerializeToString())
@@ -1,10 +1,32 @@
 import math
 from typing import List
 
+import numpy as np
 import onnx
+from onnx import helper, numpy_helper
 
 from if_rest.logger import logger
 
+# Input normalization of models by their config `function`: pixel = (pixel - mean) / std, mean and std
+# are given in model channels order after optional BGR to RGB swap. Models with None are kept unfolded.
+PREPROCESSING = {
+    'retinaface_r50_v1': dict(swap_rb=True),
+    'retinaface_mnet025_v0': dict(swap_rb=True),
+    'retinaface_mnet025_v1': dict(swap_rb=True),
+    'retinaface_mnet025_v2': dict(swap_rb=True),
+    'mnet_cov2': dict(swap_rb=True),
+    'centerface': dict(swap_rb=True),
+    'dbface': dict(mean=[104.04, 113.985, 119.85], std=[73.695, 69.87, 70.89]),
+    'scrfd': dict(mean=127.5, std=128., swap_rb=True),
+    'scrfd_v2': dict(mean=127.5, std=128., swap_rb=True),
+    'yolov5_face': dict(std=255., swap_rb=True),
+    'arcface_mxnet': dict(swap_rb=True),
+    'arcface_torch': dict(mean=127.5, std=127.5, swap_rb=True),
+    'adaface': dict(mean=127.5, std=127.5),
+    'genderage_v1': None,
+    'mask_detector': None,
+}
+
 
 def reshape(model, n: int = 1, h: int = 480, w: int = 640, mode='auto'):
     """
@@ -14,8 +36,8 @@ def reshape(model, n: int = 1, h: int = 480, w: int = 640, mode='auto'):
     Args:
         model (onnx.ModelProto): Input ONNX model object
         n (int): Batch size dimension
-        h (int): Height dimension
-        w (int): Width dimension
+        h (int): Height dimension, -1 for dynamic height
+        w (int): Width dimension, -1 for dynamic width
         mode (str): Set `retinaface` to reshape RetinaFace model, otherwise reshape Centerface
 
     Returns:
@@ -58,12 +80,13 @@ def reshape(model, n: int = 1, h: int = 480, w: int = 640, mode='auto'):
         d[3].dim_value = w
     divisor = 4
     logger.debug(f"Mode: {mode}")
+    dyn_size = h <= 0 or w <= 0
     if mode == 'yolov5-face':
         d = model.graph.output[0].type.tensor_type.shape.dim
         mx = (h * w) / 16
         s = mx - mx / 64
         d[0].dim_value = n
-        d[1].dim_value = int(s)
+        d[1].dim_value = -1 if dyn_size else int(s)
         d[2].dim_value = 16
     elif mode != 'scrfd':
         for output in model.graph.output:
@@ -72,12 +95,116 @@ def reshape(model, n: int = 1, h: int = 480, w: int = 640, mode='auto'):
             d = output.type.tensor_type.shape.dim
             d[0].dim_value = n
             if mode not in ('arcface', 'mask_detector'):
-                d[2].dim_value = math.ceil(h / divisor)
-                d[3].dim_value = math.ceil(w / divisor)
+                d[2].dim_value = -1 if dyn_size else math.ceil(h / divisor)
+                d[3].dim_value = -1 if dyn_size else math.ceil(w / divisor)
     logger.debug(f"Out shape: {d}")
     return model
 
 
+def preprocessing_nodes(input_name: str, output_name: str, mean=0., std=1., swap_rb: bool = False,
+                        nchw: bool = True, prefix: str = 'pre', cache: dict = None) -> tuple:
+    """
+    Build nodes converting uint8 BGR NHWC tensor to normalized float32 model input.
+
+    Args:
+        input_name (str): Name of uint8 input tensor.
+        output_name (str): Name of produced model input tensor.
+        mean (Union[float, List[float]]): Value subtracted from pixels, single value or one per channel.
+        std (Union[float, List[float]]): Value pixels are divided by, single value or one per channel.
+        swap_rb (bool): Reverse channels order (BGR to RGB).
+        nchw (bool): Produce (N, C, H, W) layout, otherwise (N, H, W, C).
+        prefix (str): Prefix of normalization nodes and constants names.
+        cache (dict): Names of already built cast, swap and transpose nodes, used to share them
+                      between several models fed with the same input.
+
+    Returns:
+        tuple: Lists of nodes and initializers.
+    """
+    if cache is None:
+        cache = {}
+    nodes = []
+    initializers = []
+
+    tensor = f'{input_name}/float'
+    if tensor not in cache:
+        nodes.append(helper.make_node('Cast', [input_name], [tensor], to=onnx.TensorProto.FLOAT, name=tensor))
+        cache[tensor] = True
+    if swap_rb:
+        rgb = f'{input_name}/rgb'
+        if rgb not in cache:
+            initializers.append(numpy_helper.from_array(np.array([2, 1, 0], dtype=np.int64), f'{rgb}_order'))
+            nodes.append(helper.make_node('Gather', [tensor, f'{rgb}_order'], [rgb], axis=3, name=rgb))
+            cache[rgb] = True
+        tensor = rgb
+    if nchw:
+        transposed = f'{tensor}_nchw'
+        if transposed not in cache:
+            nodes.append(helper.make_node('Transpose', [tensor], [transposed], perm=[0, 3, 1, 2], name=transposed))
+            cache[transposed] = True
+        tensor = transposed
+
+    # Per channel constants are broadcast along channels axis
+    shape = (1, -1, 1, 1) if nchw else (-1,)
+    mean = np.array(mean, dtype=np.float32)
+    scale = np.array(1. / np.array(std, dtype=np.float64), dtype=np.float32)
+    if mean.ndim:
+        mean = mean.reshape(shape)
+    if scale.ndim:
+        scale = scale.reshape(shape)
+    initializers.append(numpy_helper.from_array(mean, f'{prefix}/mean'))
+    initializers.append(numpy_helper.from_array(scale, f'{prefix}/scale'))
+    nodes.append(helper.make_node('Sub', [tensor, f'{prefix}/mean'], [f'{prefix}/centered'], name=f'{prefix}/sub'))
+    nodes.append(helper.make_node('Mul', [f'{prefix}/centered', f'{prefix}/scale'], [output_name],
+                                  name=f'{prefix}/mul'))
+    return nodes, initializers
+
+
+def fold_preprocessing(model, mean=0., std=1., swap_rb: bool = False):
+    """
+    Prepend input normalization to model graph, so it takes raw uint8 BGR images batch of (N, H, W, 3) shape
+    instead of normalized float32 (N, 3, H, W) blob. Input name is kept, batch, height and width dimensions are
+    copied from original input.
+
+    Args:
+        model (onnx.ModelProto): Input ONNX model object
+        mean (Union[float, List[float]]): Value subtracted from pixels, single value or one per channel.
+        std (Union[float, List[float]]): Value pixels are divided by, single value or one per channel.
+        swap_rb (bool): Reverse channels order (BGR to RGB).
+
+    Returns:
+        onnx.ModelProto: ONNX model with uint8 NHWC input
+    """
+    graph_input = model.graph.input[0]
+    if graph_input.type.tensor_type.elem_type == onnx.TensorProto.UINT8:
+        logger.debug('Model input is uint8 already, skipping preprocessing folding')
+        return model
+
+    input_name = graph_input.name
+    normalized = f'{input_name}/normalized'
+    for node in model.graph.node:
+        for i, name in enumerate(node.input):
+            if name == input_name:
+                node.input[i] = normalized
+    for output in model.graph.output:
+        if output.name == input_name:
+            raise ValueError('Model input is used as output, preprocessing can not be folded')
+
+    nodes, initializers = preprocessing_nodes(input_name, normalized, mean=mean, std=std, swap_rb=swap_rb,
+                                              prefix=f'{input_name}/pre')
+    dims = graph_input.type.tensor_type.shape.dim
+    new_input = helper.make_tensor_value_info(input_name, onnx.TensorProto.UINT8, [None, None, None, 3])
+    for i, src in zip((0, 1, 2), (0, 2, 3)):
+        new_input.type.tensor_type.shape.dim[i].CopyFrom(dims[src])
+
+    graph_nodes = nodes + list(model.graph.node)
+    del model.graph.node[:]
+    model.graph.node.extend(graph_nodes)
+    model.graph.initializer.extend(initializers)
+    graph_input.CopyFrom(new_input)
+    logger.debug(f'Folded preprocessing into ONNX graph, input: {new_input}')
+    return model
+
+
 def reshape_onnx_input(onnx_path: str, out_path: str, im_size: List[int] = None, batch_size: int = 1,
                        mode: str = 'auto'):
     """
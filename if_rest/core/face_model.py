@@ -1,8 +1,12 @@
 import asyncio
 import base64
 import collections
+import math
+import threading
 import time
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from functools import partial
 from typing import Dict, List
 
@@ -10,10 +14,15 @@ import cv2
 import numpy as np
 from numpy.linalg import norm
 
+from if_rest.core.configs import config
+from if_rest.core.model_zoo.exec_backends.onnxrt_backend import MergedHeads
 from if_rest.core.model_zoo.getter import get_model
 from if_rest.core.utils import fast_face_align as face_align
+from if_rest.core.utils.batching import BatchScheduler
+from if_rest.core.utils.blob import as_batch
 from if_rest.core.utils.helpers import to_chunks, colorize_log, validate_max_size
-from if_rest.core.utils.image_provider import resize_image
+from if_rest.core.utils.image_provider import resize_image, get_scale_factor
+from if_rest.core.utils.tiling import plan_tiles, plan_windows, make_tiles, merge_tiles, merge_detections
 from if_rest.logger import logger
 
 Face = collections.namedtuple("Face", ['bbox', 'landmark', 'det_score', 'embedding', 'gender', 'age', 'embedding_norm',
@@ -21,6 +30,9 @@ Face = collections.namedtuple("Face", ['bbox', 'landmark', 'det_score', 'embeddi
 
 Face.__new__.__defaults__ = (None,) * len(Face._fields)
 
+# Detectors with postprocessing independent of input shape, which can run with dynamic H/W
+dynamic_shape_detectors = ('scrfd', 'scrfd_v2', 'yolov5_face')
+
 
 def serialize_face(_face_dict: dict, return_face_data: bool, return_landmarks: bool = False):
     """
@@ -61,7 +73,7 @@ def serialize_face(_face_dict: dict, return_face_data: bool, return_landmarks: b
 class Detector:
     def __init__(self, det_name: str = 'retinaface_r50_v1', max_size=None,
                  backend_name: str = 'trt', force_fp16: bool = False, triton_uri=None, max_batch_size: int = 1,
-                 root_dir='/models'):
+                 root_dir='/models', ort_options: dict = None, dynamic_shape: bool = False):
         """
         Wrapper for face detector.
 
@@ -72,28 +84,34 @@ class Detector:
             force_fp16 (bool): Whether to force float16 precision.
             triton_uri (str): The URI of the Triton server.
             root_dir (str): The directory where the models are stored.
+            ort_options (dict): ONNX Runtime session options.
+            dynamic_shape (bool): Keep dynamic input height and width, `onnx` backend only.
         """
         if max_size is None:
             max_size = [640, 480]
 
         self.retina = get_model(det_name, backend_name=backend_name, force_fp16=force_fp16, im_size=max_size,
                                 root_dir=root_dir, download_model=False, triton_uri=triton_uri,
-                                max_batch_size=max_batch_size)
+                                max_batch_size=max_batch_size, ort_options=ort_options,
+                                dynamic_shape=dynamic_shape)
 
         self.retina.prepare(nms=0.35)
 
-    def detect(self, data, threshold=0.3):
+    def detect(self, data, threshold=0.3, min_size=None, limit: int = 0):
         """
         Detect faces in input images.
 
         Args:
            data (numpy array): The input images.
            threshold (float): The detection threshold. (Default: 0.3)
+           min_size (Union[float, List[float]]): Minimum face width in input pixels, proposals narrower than
+                                                 that are dropped before NMS. Single value or one per image.
+           limit (int): Maximum number of largest faces kept per image, 0 for unlimited.
 
         Returns:
            tuple: A tuple containing the bounding boxes, probabilities, and landmarks of the detected faces.
         """
-        bboxes, landmarks = self.retina.detect(data, threshold=threshold)
+        bboxes, landmarks = self.retina.detect(data, threshold=threshold, min_size=min_size, limit=limit)
 
         boxes = [e[:, 0:4] for e in bboxes]
         probs = [e[:, 4] for e in bboxes]
@@ -126,10 +144,29 @@ class FaceAnalysis:
                  max_size=None,
                  max_rec_batch_size: int = 1,
                  max_det_batch_size: int = 1,
+                 rec_dynamic_batching: bool = False,
+                 rec_batch_wait_ms: float = 5.,
+                 det_dynamic_batching: bool = False,
+                 det_batch_wait_ms: float = 5.,
+                 det_resolutions: List[int] = None,
+                 det_min_face_px: int = 16,
+                 det_target_face_size: int = 0,
+                 det_dynamic_shape: bool = False,
+                 det_tile_overlap: float = 0.2,
+                 det_max_tiles: int = 16,
+                 det_refine_threshold: float = 0.3,
+                 det_refine_max_rois: int = 8,
+                 det_cascade_name: str = None,
+                 det_cascade_accept: float = 0.8,
+                 det_cascade_borderline: float = 0.3,
+                 compute_threads: int = 0,
+                 concurrent_heads: bool = False,
+                 merge_heads: bool = False,
                  backend_name: str = 'trt',
                  force_fp16: bool = False,
                  triton_uri=None,
                  root_dir: str = '/models',
+                 ort_options: dict = None,
                  **kwargs):
 
         """
@@ -143,14 +180,51 @@ class FaceAnalysis:
             max_size (List[int]): The maximum size of the input image.
             max_rec_batch_size (int): The maximum batch size for the recognition model.
             max_det_batch_size (int): The maximum batch size for the detection model.
+            rec_dynamic_batching (bool): Whether to batch recognition inputs across concurrent requests.
+            rec_batch_wait_ms (float): Maximum time to wait for recognition batch to fill up.
+            det_dynamic_batching (bool): Whether to batch detector inputs across concurrent requests.
+            det_batch_wait_ms (float): Maximum time to wait for detection batch to fill up.
+            det_resolutions (List[int]): Square detector input sizes loaded side by side, each image is
+                                         detected at the smallest one satisfying face size policy. If empty
+                                         single detector with `max_size` input is used.
+            det_min_face_px (int): Smallest face size in detector input pixels detected reliably.
+            det_target_face_size (int): Default smallest face size in original image pixels which must be
+                                        detected, used when request doesn't provide `min_face_size`.
+                                        0 means images are never downscaled more than with `max_size`.
+            det_dynamic_shape (bool): Run detector with dynamic input shape, resizing images to multiples
+                                      of 32 at native aspect ratio instead of letterboxing them to `max_size`.
+                                      Supported for SCRFD and YOLOv5-face with `onnx` backend.
+            det_tile_overlap (float): Overlap of neighbouring tiles in tiled detection mode as fraction of tile size.
+            det_max_tiles (int): Maximum number of detector sized tiles per image in tiled detection mode, larger
+                                 images are downscaled to fit into this budget.
+            det_refine_threshold (float): Detection threshold of coarse pass in two-pass detection mode, faces
+                                          found by coarse pass are candidates for refinement.
+            det_refine_max_rois (int): Maximum number of regions per image re-detected in refinement pass.
+            det_cascade_name (str): The name of fast detection model run before `det_name`. Only images without
+                                    confident detections or with borderline ones are escalated to `det_name`.
+            det_cascade_accept (float): Score of confident detection in cascade mode.
+            det_cascade_borderline (float): Lowest score of borderline detection in cascade mode, used as fast
+                                            detector threshold.
+            compute_threads (int): Size of thread pool running detection, alignment and embedding outside of
+                                   event loop. 0 runs them inside event loop.
+            concurrent_heads (bool): Run recognition, gender/age and mask heads on the same crops in parallel,
+                                     each in its own worker thread.
+            merge_heads (bool): Compose heads consuming 112x112 crops into single ONNX Runtime session with
+                                shared uint8 input, used when all merged heads are requested.
+                                Supported with `onnx` backend only.
             backend_name (str): The name of the backend to use.
             force_fp16 (bool): Whether to force float16 precision.
             triton_uri (str): The URI of the Triton server.
             root_dir (str): The directory where the models are stored.
+            ort_options (dict): ONNX Runtime session options, may contain per model role overrides in `roles`
+                                dict with `det`, `rec`, `ga` and `mask` keys.
         """
 
         if max_size is None:
             max_size = [640, 640]
+        if ort_options is None:
+            ort_options = {}
+        self.ort_options = ort_options
 
         self.decode_required = True
         self.max_size = validate_max_size(max_size)
@@ -158,28 +232,124 @@ class FaceAnalysis:
         self.max_det_batch_size = max_det_batch_size
         self.det_name = det_name
         self.rec_name = rec_name
-        if backend_name not in ('trt', 'triton') and max_rec_batch_size != 1:
-            logger.warning('Batch processing supported only for TensorRT & Triton backend. Fallback to 1.')
-            self.max_rec_batch_size = 1
 
         assert det_name is not None
 
-        self.det_model = Detector(det_name=det_name, max_size=self.max_size,
-                                  max_batch_size=self.max_det_batch_size, backend_name=backend_name,
-                                  force_fp16=force_fp16, triton_uri=triton_uri, root_dir=root_dir)
+        # ONNX Runtime releases GIL during inference, so CPU heavy stages can run in thread pool
+        # while event loop keeps serving I/O.
+        self.executor = None
+        if compute_threads > 0:
+            self.executor = ThreadPoolExecutor(max_workers=compute_threads, thread_name_prefix='ifr-compute')
+        # TensorRT/Triton backends share preallocated buffers between calls, so calls to such models
+        # are serialized, while ONNX Runtime sessions and detectors postprocessing are thread-safe.
+        self._det_lock = nullcontext() if backend_name == 'onnx' else threading.Lock()
+        self._heads_lock = nullcontext() if backend_name == 'onnx' else threading.Lock()
+
+        self.det_min_face_px = det_min_face_px
+        self.det_target_face_size = det_target_face_size
+        self.det_tile_overlap = det_tile_overlap
+        self.det_max_tiles = det_max_tiles
+        self.det_refine_threshold = det_refine_threshold
+        self.det_refine_max_rois = det_refine_max_rois
+        self.det_dynamic_shape = False
+        if det_dynamic_shape:
+            if backend_name == 'onnx' and config.get_function(det_name) in dynamic_shape_detectors \
+                    and config.models[det_name].get('reshape') is True:
+                self.det_dynamic_shape = True
+            else:
+                logger.warning(f"Dynamic input shape isn't supported for '{det_name}' with '{backend_name}' "
+                               f"backend, falling back to fixed input shape.")
+
+        det_sizes = [list(self.max_size)]
+        if self.det_dynamic_shape:
+            if det_resolutions:
+                logger.warning('Detector resolutions are ignored with dynamic input shape.')
+        elif det_resolutions:
+            if config.models.get(det_name, {}).get('reshape') is True:
+                det_sizes = [[e, e] for e in sorted(set(validate_max_size([e, e])[0] for e in det_resolutions))]
+            else:
+                logger.warning(f"Model '{det_name}' has fixed input shape, ignoring detector resolutions.")
+
+        # Detector engines keyed by their input size in (W, H) form
+        self.det_models: Dict[tuple, Detector] = {}
+        for det_size in det_sizes:
+            detector = Detector(det_name=det_name, max_size=det_size,
+                                max_batch_size=self.max_det_batch_size, backend_name=backend_name,
+                                force_fp16=force_fp16, triton_uri=triton_uri, root_dir=root_dir,
+                                ort_options=self._role_ort_options('det'),
+                                dynamic_shape=self.det_dynamic_shape)
+            # If detector has input_shape attribute, use it instead of provided value
+            try:
+                if not self.det_dynamic_shape:
+                    det_size = detector.retina.input_shape[2:][::-1]
+            except:
+                pass
+            self.det_models[tuple(det_size)] = detector
+        self.det_sizes = sorted(self.det_models, key=lambda e: e[0] * e[1])
+        self.det_model = self.det_models[self.det_sizes[-1]]
+
+        # Fast detector engines of cascade mode, keyed by the same input sizes as main detector
+        self.det_cascade_accept = det_cascade_accept
+        self.det_cascade_borderline = det_cascade_borderline
+        self.cascade_det_models: Dict[tuple, Detector] = {}
+        self._cascade_stats = dict(images=0, accepted=0, escalated=0)
+        if det_cascade_name is not None:
+            if self.det_dynamic_shape and (config.get_function(det_cascade_name) not in dynamic_shape_detectors
+                                           or config.models[det_cascade_name].get('reshape') is not True):
+                logger.warning(f"Dynamic input shape isn't supported for '{det_cascade_name}', "
+                               f"detector cascade disabled.")
+            else:
+                for det_size in self.det_sizes:
+                    detector = Detector(det_name=det_cascade_name, max_size=list(det_size),
+                                        max_batch_size=self.max_det_batch_size, backend_name=backend_name,
+                                        force_fp16=force_fp16, triton_uri=triton_uri, root_dir=root_dir,
+                                        ort_options=self._role_ort_options('det'),
+                                        dynamic_shape=self.det_dynamic_shape)
+                    input_size = tuple(getattr(detector.retina, 'input_shape', (None, None) + det_size)[2:][::-1])
+                    if not self.det_dynamic_shape and input_size != det_size:
+                        logger.warning(f"Model '{det_cascade_name}' input shape {input_size} doesn't match "
+                                       f"'{det_name}' input shape {det_size}, detector cascade disabled.")
+                        self.cascade_det_models = {}
+                        break
+                    self.cascade_det_models[det_size] = detector
+
+        # Images are letterboxed to one of detector input shapes (or padded to shape bucket with dynamic
+        # input shape), so images from different requests can share one detector call as long as they
+        # use the same input shape, threshold, faces limit and cascade stage.
+        # Items are (image, min face width) pairs.
+        self.det_batcher = None
+        if det_dynamic_batching:
+            self.det_batcher = BatchScheduler(lambda items, key: self._detect([e[0] for e in items],
+                                                                              threshold=key[1], det_size=key[0],
+                                                                              min_sizes=[e[1] for e in items],
+                                                                              limit=key[2], cascade=key[3]),
+                                              max_batch_size=self.max_det_batch_size,
+                                              max_wait_ms=det_batch_wait_ms,
+                                              name='det_batcher',
+                                              executor=self.executor)
 
         if rec_name is not None:
             self.rec_model = get_model(rec_name, backend_name=backend_name, force_fp16=force_fp16,
                                        max_batch_size=self.max_rec_batch_size, root_dir=root_dir,
-                                       download_model=False, triton_uri=triton_uri)
+                                       download_model=False, triton_uri=triton_uri,
+                                       ort_options=self._role_ort_options('rec'))
             self.rec_model.prepare()
         else:
             self.rec_model = None
 
+        self.rec_batcher = None
+        if self.rec_model is not None and rec_dynamic_batching:
+            self.rec_batcher = BatchScheduler(lambda crops, key: self._get_embedding(crops),
+                                              max_batch_size=self.max_rec_batch_size,
+                                              max_wait_ms=rec_batch_wait_ms,
+                                              name='rec_batcher',
+                                              executor=self.executor)
+
         if ga_name is not None:
             self.ga_model = get_model(ga_name, backend_name=backend_name, force_fp16=force_fp16,
                                       max_batch_size=self.max_rec_batch_size, root_dir=root_dir,
-                                      download_model=False, triton_uri=triton_uri)
+                                      download_model=False, triton_uri=triton_uri,
+                                      ort_options=self._role_ort_options('ga'))
             self.ga_model.prepare()
         else:
             self.ga_model = None
@@ -187,53 +357,371 @@ class FaceAnalysis:
         if mask_detector is not None:
             self.mask_model = get_model(mask_detector, backend_name=backend_name, force_fp16=force_fp16,
                                         max_batch_size=self.max_rec_batch_size, root_dir=root_dir,
-                                        download_model=False, triton_uri=triton_uri)
+                                        download_model=False, triton_uri=triton_uri,
+                                        ort_options=self._role_ort_options('mask'))
 
             self.mask_model.prepare()
         else:
             self.mask_model = None
 
-    def sort_boxes(self, boxes, probs, landmarks, shape, max_num=0):
+        # Free uint8 crops buffers by crop size, reused between requests to avoid allocating and page
+        # faulting fresh batch for each request. Accessed from event loop only. Pooled memory is bounded,
+        # so buffers of occasional crowd or tiled requests are dropped after use instead of being kept.
+        self._crops_pool: Dict[int, List[np.ndarray]] = collections.defaultdict(list)
+        self._crops_pool_size = 8
+        self._crops_pool_bytes = 64 * 1024 * 1024
+
+        self.merged_heads = None
+        if merge_heads:
+            self.merged_heads = self._merge_heads(backend_name)
+
+        # Each head gets single worker thread, so heads of one crops batch run in parallel while calls of
+        # the same head are queued. Heads compute threads are set with per role ONNX Runtime options.
+        self.head_executors: Dict[str, ThreadPoolExecutor] = {}
+        if concurrent_heads:
+            for role, model in (('rec', self.rec_model), ('ga', self.ga_model), ('mask', self.mask_model)):
+                if model is not None:
+                    self.head_executors[role] = ThreadPoolExecutor(max_workers=1,
+                                                                   thread_name_prefix=f'ifr-{role}')
+            if self.rec_batcher is not None and 'rec' in self.head_executors:
+                self.rec_batcher.executor = self.head_executors['rec']
+
+    def _merge_heads(self, backend_name: str):
+        """
+        Build single session for heads consuming 112x112 crops.
+
+        Args:
+            backend_name (str): The name of the backend.
+
+        Returns:
+            MergedHeads: Merged heads or None if less than two heads can be merged.
+        """
+        if backend_name != 'onnx':
+            logger.warning(f"Merged heads are supported with 'onnx' backend only, ignoring for '{backend_name}'.")
+            return None
+        heads = {name: model for name, model in (('embedding', self.rec_model), ('ga', self.ga_model),
+                                                 ('mask', self.mask_model))
+                 if model is not None and getattr(model, 'input_size', 112) == 112}
+        if len(heads) < 2:
+            logger.warning('Merged heads require at least two loaded heads with 112x112 input, ignoring.')
+            return None
+        merged = MergedHeads(heads, ort_options=self._role_ort_options('rec'))
+        merged.prepare()
+        logger.info(f"Heads {', '.join(heads)} merged into single session.")
+        return merged
+
+    def _run_merged(self, crops) -> dict:
+        with self._heads_lock:
+            ret = self.merged_heads.run(crops)
+        if 'ga' in ret:
+            ret['ga'] = self.ga_model.postprocess(ret['ga'])
+        if 'mask' in ret:
+            ret['mask'] = self.mask_model.postprocess(ret['mask'])
+        return ret
+
+    def _acquire_crops(self, size: int, total: int) -> np.ndarray:
+        """
+        Take uint8 crops buffer of at least `total` crops from pool, allocating new one if none fits.
+
+        Args:
+            size (int): Crop size.
+            total (int): Number of crops.
+
+        Returns:
+            np.ndarray: Buffer of (N, size, size, 3) shape with N >= total.
+        """
+        pool = self._crops_pool[size]
+        for i, buf in enumerate(pool):
+            if buf.shape[0] >= total:
+                return pool.pop(i)
+        if pool:
+            # Replace largest free buffer with the bigger one
+            pool.pop()
+        return np.empty((max(total, self.max_rec_batch_size), size, size, 3), dtype=np.uint8)
+
+    def _release_crops(self, buffers: Dict[int, np.ndarray]):
         """
-        Sort the detected faces by confidence score.
-        Based on original InsightFace python package implementation
+        Return crops buffers to pool. Buffers must not be referenced by anything returned to caller.
+        Buffers not fitting into pool memory limit are dropped.
+
+        Args:
+            buffers (Dict[int, np.ndarray]): Buffers taken with `_acquire_crops` by crop size.
+        """
+        pooled = sum(buf.nbytes for pool in self._crops_pool.values() for buf in pool)
+        for size, buf in buffers.items():
+            pool = self._crops_pool[size]
+            if len(pool) < self._crops_pool_size and pooled + buf.nbytes <= self._crops_pool_bytes:
+                pooled += buf.nbytes
+                pool.append(buf)
+                pool.sort(key=lambda e: e.shape[0])
+
+    def _role_ort_options(self, role: str) -> dict:
+        """
+        Merge common ONNX Runtime session options with overrides for model role.
+
+        Args:
+            role (str): Model role, one of `det`, `rec`, `ga`, `mask`.
+
+        Returns:
+            dict: Session options for model role.
+        """
+        options = {k: v for k, v in self.ort_options.items() if k != 'roles'}
+        options.update(self.ort_options.get('roles', {}).get(role, {}))
+        return options
+
+    def _nms_threshold(self, det_size: tuple) -> float:
+        det_model = self.det_models.get(det_size, self.det_model)
+        return getattr(det_model.retina, 'nms_threshold', 0.4)
+
+    def select_det_input(self, shape, max_size: List[int] = None, min_face_size: int = 0,
+                         det_resolution: int = None) -> tuple:
+        """
+        Select detector input size and scale factor for image.
+
+        Image goes to the smallest detector which keeps faces of target size at least `det_min_face_px`
+        pixels large. Without target face size image is never downscaled more than with `max_size`
+        and never upscaled.
+
+        With dynamic input shape image is scaled as if letterboxed to `max_size` (or less, if faces of target
+        size stay large enough) and padded to the nearest multiple of 32 at native aspect ratio.
+
         Args:
-            boxes (numpy array): The bounding boxes of the detected faces.
-            probs (numpy array): The confidence scores of the detected faces.
-            landmarks (numpy array): The landmarks of the detected faces.
             shape (tuple): The shape of the input image.
-            max_num (int): The maximum number of faces to return.
+            max_size (List[int]): The maximum size of the input image.
+            min_face_size (int): The minimum face size to detect in original image pixels.
+            det_resolution (int): Pinned detector resolution, closest available one is used.
 
         Returns:
-            tuple: A tuple containing the sorted bounding boxes, probabilities, and landmarks.
+            tuple: Detector input size in (W, H) form and scale factor, or None if image should be
+                   letterboxed to detector input size.
         """
-        if max_num > 0 and boxes.shape[0] > max_num:
-            area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
-            img_center = shape[0] // 2, shape[1] // 2
-            offsets = np.vstack([
-                (boxes[:, 0] + boxes[:, 2]) / 2 - img_center[1],
-                (boxes[:, 1] + boxes[:, 3]) / 2 - img_center[0]
-            ])
-            offset_dist_squared = np.sum(np.power(offsets, 2.0), 0)
-            values = area  # some extra weight on the centering
-            bindex = np.argsort(values)[::-1]  # some extra weight on the centering
-            bindex = bindex[0:max_num]
+        max_size = max_size or self.max_size
+        target_face_size = min_face_size or self.det_target_face_size
+
+        if self.det_dynamic_shape:
+            if det_resolution:
+                max_size = [det_resolution, det_resolution]
+            scale_factor = get_scale_factor(shape, max_size)
+            if target_face_size > 0:
+                scale_factor = min(scale_factor, self.det_min_face_px / target_face_size)
+            h, w = shape[:2]
+            det_size = (max(32, math.ceil(w * scale_factor / 32) * 32),
+                        max(32, math.ceil(h * scale_factor / 32) * 32))
+            return det_size, scale_factor
+
+        if len(self.det_sizes) == 1:
+            return self.det_sizes[0], None
+        if det_resolution:
+            return min(self.det_sizes, key=lambda e: abs(max(e) - det_resolution)), None
+
+        if target_face_size > 0:
+            required_scale = self.det_min_face_px / target_face_size
+        else:
+            required_scale = min(1., get_scale_factor(shape, max_size))
+
+        for det_size in self.det_sizes:
+            if get_scale_factor(shape, det_size) >= required_scale:
+                return det_size, None
+        return self.det_sizes[-1], None
 
-            boxes = boxes[bindex, :]
-            probs = probs[bindex]
+    def _cascade_model(self, det_size: tuple):
+        """
+        Get fast detector of cascade mode for detector input size.
 
-            landmarks = landmarks[bindex, :]
+        Args:
+            det_size (tuple): Detector input size in (W, H) form.
 
-        return boxes, probs, landmarks
+        Returns:
+            Detector: Fast detector or None if cascade isn't available for this input size.
+        """
+        if self.det_dynamic_shape and self.cascade_det_models:
+            # Single dynamic shape detector serves every input size
+            return next(iter(self.cascade_det_models.values()))
+        return self.cascade_det_models.get(det_size)
+
+    def _detect(self, imgs, threshold: float = 0.6, det_size: tuple = None, min_sizes: List[float] = None,
+                limit: int = 0, cascade: bool = False):
+        """
+        Run detector on a batch of resized images.
+
+        Args:
+            imgs (List[np.ndarray]): A list of images resized to detector input shape.
+            threshold (float): The detection threshold.
+            det_size (tuple): Detector input size in (W, H) form, the largest detector is used if None.
+            min_sizes (List[float]): Minimum face width in resized image pixels for each image.
+            limit (int): Maximum number of largest faces per image, 0 for unlimited.
+            cascade (bool): Use fast detector of cascade mode.
+
+        Returns:
+            List[tuple]: A list of (boxes, probs, landmarks) tuples, one per image.
+        """
+        if cascade:
+            det_model = self._cascade_model(det_size)
+        else:
+            det_model = self.det_models.get(det_size, self.det_model)
+        t0 = time.perf_counter()
+        with self._det_lock:
+            predictions = list(zip(*det_model.detect(tuple(imgs), threshold=threshold, min_size=min_sizes,
+                                                     limit=limit)))
+        t1 = time.perf_counter()
+        logger.debug(f'Detection took: {(t1 - t0) * 1000:.3f} ms.')
+        return predictions
+
+    async def detect(self, imgs, threshold: float = 0.6, det_size: tuple = None, min_sizes: List[float] = None,
+                     limit: int = 0, cascade: bool = False):
+        """
+        Detect faces in resized images, batching them with images from concurrent requests if enabled.
+
+        Args:
+            imgs (List[np.ndarray]): A list of images resized to detector input shape.
+            threshold (float): The detection threshold.
+            det_size (tuple): Detector input size in (W, H) form, the largest detector is used if None.
+            min_sizes (List[float]): Minimum face width in resized image pixels for each image.
+            limit (int): Maximum number of largest faces per image, 0 for unlimited.
+            cascade (bool): Use fast detector of cascade mode.
+
+        Returns:
+            List[tuple]: A list of (boxes, probs, landmarks) tuples, one per image.
+        """
+        if min_sizes is None:
+            min_sizes = [0] * len(imgs)
+        if self.det_batcher is not None:
+            return await self.det_batcher.submit(list(zip(imgs, min_sizes)),
+                                                 key=(det_size, threshold, limit, cascade))
+        return await self._run(self._detect, imgs, threshold=threshold, det_size=det_size, min_sizes=min_sizes,
+                               limit=limit, cascade=cascade)
+
+    async def detect_cascade(self, imgs, threshold: float = 0.6, det_size: tuple = None,
+                             min_sizes: List[float] = None, limit: int = 0):
+        """
+        Detect faces with fast detector first, escalating to main detector only images without confident
+        detections or with borderline ones. Escalated images keep confident fast detections not found by
+        main detector.
+
+        Args:
+            imgs (List[np.ndarray]): A list of images resized to detector input shape.
+            threshold (float): The detection threshold.
+            det_size (tuple): Detector input size in (W, H) form.
+            min_sizes (List[float]): Minimum face width in resized image pixels for each image.
+            limit (int): Maximum number of largest faces per image, 0 for unlimited.
+
+        Returns:
+            List[tuple]: A list of (boxes, probs, landmarks) tuples, one per image.
+        """
+        if min_sizes is None:
+            min_sizes = [0] * len(imgs)
+        accept = max(threshold, self.det_cascade_accept)
+        predictions = await self.detect(imgs, threshold=min(threshold, self.det_cascade_borderline),
+                                        det_size=det_size, min_sizes=min_sizes, cascade=True)
+        escalate = [i for i, (_, probs, _) in enumerate(predictions)
+                    if probs.shape[0] == 0 or (probs < accept).any()]
+        self._cascade_stats['images'] += len(imgs)
+        self._cascade_stats['escalated'] += len(escalate)
+        self._cascade_stats['accepted'] += len(imgs) - len(escalate)
+
+        escalated = []
+        if escalate:
+            escalated = await self.detect([imgs[i] for i in escalate], threshold=threshold, det_size=det_size,
+                                          min_sizes=[min_sizes[i] for i in escalate])
+        escalated = dict(zip(escalate, escalated))
+
+        nms_threshold = self._nms_threshold(det_size)
+        results = []
+        for i, (boxes, probs, landmarks) in enumerate(predictions):
+            confident = probs >= accept
+            sources = [(boxes[confident], probs[confident], landmarks[confident])]
+            if i in escalated:
+                sources.append(escalated[i])
+            results.append(merge_detections(sources, nms_threshold=nms_threshold, limit=limit))
+        return results
+
+    async def _run(self, func, *args, **kwargs):
+        """
+        Run CPU heavy function in compute thread pool, or inline if thread pool is disabled.
+
+        Args:
+            func (Callable): Function to run.
+
+        Returns:
+            Result of function call.
+        """
+        if self.executor is None:
+            return func(*args, **kwargs)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
 
-    def process_faces(self,
-                      faces: List[dict],
-                      extract_embedding: bool = True,
-                      extract_ga: bool = True,
-                      return_face_data: bool = False,
-                      detect_masks: bool = True,
-                      mask_thresh: float = 0.89,
-                      **kwargs):
+    async def _run_head(self, role: str, func, *args):
+        """
+        Run head inference in head's own worker thread if concurrent heads are enabled.
+
+        Args:
+            role (str): Head role, one of `rec`, `ga`, `mask`.
+            func (Callable): Function to run.
+            *args: Positional arguments for the function.
+
+        Returns:
+            Result of function call.
+        """
+        executor = self.head_executors.get(role)
+        if executor is None:
+            return await self._run(func, *args)
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+    def _get_embedding(self, crops):
+        with self._heads_lock:
+            return self.rec_model.get_embedding(crops)
+
+    def _get_ga(self, crops):
+        with self._heads_lock:
+            return self.ga_model.get(crops)
+
+    def _get_masks(self, crops):
+        with self._heads_lock:
+            return self.mask_model.get(crops)
+
+    async def get_embedding(self, crops):
+        """
+        Extract embeddings for face crops, batching them with crops from concurrent requests if enabled.
+
+        Args:
+            crops (np.ndarray): Batch of aligned face crops of (N, 112, 112, 3) shape.
+
+        Returns:
+            np.ndarray: Embeddings for provided crops.
+        """
+        if self.rec_batcher is not None:
+            return await self.rec_batcher.submit(crops)
+        return await self._run_head('rec', self._get_embedding, crops)
+
+    def stats(self) -> Dict[str, dict]:
+        """
+        Collect runtime statistics of batch schedulers.
+
+        Returns:
+            Dict[str, dict]: A dictionary containing statistics for each enabled scheduler.
+        """
+        stats = {}
+        if self.det_batcher is not None:
+            stats['det_batcher'] = self.det_batcher.stats()
+        if self.rec_batcher is not None:
+            stats['rec_batcher'] = self.rec_batcher.stats()
+        if self.cascade_det_models:
+            images = self._cascade_stats['images']
+            stats['det_cascade'] = dict(self._cascade_stats,
+                                        fast_hit_rate=self._cascade_stats['accepted'] / images if images else 0.,
+                                        escalation_rate=self._cascade_stats['escalated'] / images if images else 0.)
+        return stats
+
+    async def process_faces(self,
+                            faces: List[dict],
+                            extract_embedding: bool = True,
+                            extract_ga: bool = True,
+                            return_face_data: bool = False,
+                            detect_masks: bool = True,
+                            mask_thresh: float = 0.89,
+                            crops: Dict[int, np.ndarray] = None,
+                            timings: dict = None,
+                            **kwargs):
         """
         Process the detected faces.
 
@@ -244,43 +732,70 @@ class FaceAnalysis:
             return_face_data (bool): Whether to return the facedata for each face.
             detect_masks (bool): Whether to detect masks for each face.
             mask_thresh (float): The threshold for detecting masks.
+            crops (Dict[int, np.ndarray]): Batches of aligned crops of faces in the same order by crop size,
+                                           if None 112x112 crops are gathered from faces `facedata`.
+            timings (dict): If provided, receives per-head and total heads inference time in milliseconds.
 
-        Yields:
-            dict: A dictionary containing the processed face data.
+        Returns:
+            List[dict]: A list of dictionaries containing the processed face data.
         """
+        processed = []
+        offset = 0
         chunked_faces = to_chunks(faces, self.max_rec_batch_size)
         for chunk in chunked_faces:
             chunk = list(chunk)
-            crops = [e['facedata'] for e in chunk]
-            total = len(crops)
+            total = len(chunk)
+            if crops is not None:
+                chunk_crops = {size: e[offset:offset + total] for size, e in crops.items()}
+            else:
+                chunk_crops = {112: as_batch([e['facedata'] for e in chunk])}
+            offset += total
+            mask_crops = chunk_crops.get(getattr(self.mask_model, 'input_size', 112), chunk_crops[112])
             embeddings = [None] * total
             ga = [[None, None]] * total
 
+            # Heads consume the same crops independently, with concurrent heads they are fanned out at once
+            heads = {}
             if extract_embedding:
-                t0 = time.perf_counter()
-                embeddings = self.rec_model.get_embedding(crops)
-                took = time.perf_counter() - t0
-                logger.debug(
-                    f'Embedding {total} faces took: {took * 1000:.3f} ms. ({(took / total) * 1000:.3f} ms. per face)')
-
+                heads['embedding'] = partial(self.get_embedding, chunk_crops[112])
             if extract_ga and self.ga_model:
-                t0 = time.perf_counter()
-                ga = self.ga_model.get(crops)
-                t1 = time.perf_counter()
-                took = t1 - t0
-                logger.debug(
-                    f'Extracting g/a for {total} faces took: {took * 1000:.3f} ms. ({(took / total) * 1000:.3f} ms. per face)')
-
+                heads['ga'] = partial(self._run_head, 'ga', self._get_ga, chunk_crops[112])
             if detect_masks and self.mask_model:
+                heads['mask'] = partial(self._run_head, 'mask', self._get_masks, mask_crops)
+
+            # ONNX Runtime computes all outputs of merged graph, so it pays off only when every merged
+            # head is requested. Merged call replaces them, the rest of heads run as usual.
+            merged = None
+            if self.merged_heads is not None and all(name in heads for name in self.merged_heads.heads):
+                merged = list(self.merged_heads.heads)
+                for name in merged:
+                    heads.pop(name)
+                heads['merged'] = partial(self._run_head, 'rec', self._run_merged, chunk_crops[112])
+
+            async def run_head(name, head):
                 t0 = time.perf_counter()
-                masks = self.mask_model.get(crops)
-                t1 = time.perf_counter()
-                t1 = time.perf_counter()
-                took = t1 - t0
-                logger.debug(
-                    f'Detecting masks for  {total} faces took: {took * 1000:.3f} ms. ({(took / total) * 1000:.3f} ms. per face)')
-
-            for i, crop in enumerate(crops):
+                result = await head()
+                took = time.perf_counter() - t0
+                logger.debug(f'Head `{name}` for {total} faces took: {took * 1000:.3f} ms. '
+                             f'({(took / total) * 1000:.3f} ms. per face)')
+                if timings is not None:
+                    timings[f'{name}_ms'] = timings.get(f'{name}_ms', 0.) + took * 1000
+                return result
+
+            th0 = time.perf_counter()
+            if self.head_executors:
+                results = dict(zip(heads, await asyncio.gather(*[run_head(k, v) for k, v in heads.items()])))
+            else:
+                results = {k: await run_head(k, v) for k, v in heads.items()}
+            if timings is not None:
+                timings['heads_ms'] = timings.get('heads_ms', 0.) + (time.perf_counter() - th0) * 1000
+            if merged:
+                results.update(results.pop('merged'))
+            embeddings = results.get('embedding', embeddings)
+            ga = results.get('ga', ga)
+            masks = results.get('mask')
+
+            for i in range(total):
                 embedding_norm = None
                 normed_embedding = None
                 gender = None
@@ -319,7 +834,85 @@ class FaceAnalysis:
                 face['mask'] = mask
                 face['mask_probs'] = mask_probs
 
-                yield face
+                processed.append(face)
+
+        return processed
+
+    async def _refine(self, images, coarse_results: list, threshold: float = 0.6, min_face_size: int = 0,
+                      limit_faces: int = 0) -> list:
+        """
+        Refine results of coarse detection pass.
+
+        Candidate faces too small in coarse pass input are re-detected within detector sized regions of interest
+        around them, cut from image scaled so that candidates become `4 * det_min_face_px` pixels large (never
+        upscaled). Regions of all images are batched together. Faces inside regions are replaced with refined
+        detections, other coarse detections are kept if they pass `threshold`.
+
+        Args:
+            images (List[np.ndarray]): A list of image arrays.
+            coarse_results (list): A list of (orig_id, scale, (boxes, probs, landmarks)) coarse pass results.
+            threshold (float): The detection threshold.
+            min_face_size (int): The minimum face size to detect.
+            limit_faces (int): The maximum number of faces to detect per image.
+
+        Returns:
+            list: A list of (orig_id, scale, (boxes, probs, landmarks)) refined results.
+        """
+        roi_size = self.det_sizes[0]
+        target_px = 4 * self.det_min_face_px
+        results = []
+        plans = {}
+        for orig_id, scale, pred in coarse_results:
+            boxes, probs, landmarks = pred
+            widths = boxes[:, 2] - boxes[:, 0]
+            candidates = np.flatnonzero(widths < target_px)
+            if scale >= 1. or candidates.shape[0] == 0:
+                keep = probs >= threshold
+                pred = merge_detections([(boxes[keep], probs[keep], landmarks[keep])],
+                                        nms_threshold=self._nms_threshold(None), min_size=min_face_size * scale,
+                                        limit=limit_faces)
+                results.append((orig_id, scale, pred))
+                continue
+            candidates = candidates[np.argsort(-probs[candidates], kind='stable')]
+            roi_scale = min(1., target_px * scale / widths[candidates].min())
+            h, w = images[orig_id].shape[:2]
+            image_size = (int(round(w * roi_scale)), int(round(h * roi_scale)))
+            origins = plan_windows(boxes[candidates] * (roi_scale / scale), roi_size, image_size,
+                                   max_windows=self.det_refine_max_rois)
+            plans[orig_id] = (scale, roi_scale, image_size, origins, pred)
+
+        rois = await self._run(lambda: [(orig_id, roi) for orig_id, (_, roi_scale, _, origins, _) in plans.items()
+                                        for roi in make_tiles(images[orig_id], roi_scale, origins, roi_size)])
+        chunks = [list(e) for e in to_chunks(rois, self.max_det_batch_size)]
+        predictions = await asyncio.gather(*[
+            self.detect([e[1] for e in chunk], threshold=threshold, det_size=roi_size,
+                        min_sizes=[min_face_size * plans[e[0]][1] for e in chunk])
+            for chunk in chunks])
+        predictions = [pred for chunk in predictions for pred in chunk]
+
+        nms_threshold = self._nms_threshold(roi_size)
+        offset = 0
+        for orig_id, (scale, roi_scale, image_size, origins, coarse) in plans.items():
+            boxes, probs, landmarks = merge_tiles(predictions[offset:offset + len(origins)], origins, roi_size,
+                                                  image_size, nms_threshold=nms_threshold)
+            offset += len(origins)
+            # Translate refined detections to coarse pass input coordinates
+            ratio = scale / roi_scale
+            refined = (boxes * ratio, probs, landmarks * ratio)
+
+            # Coarse detections inside regions are superseded by refined ones
+            boxes, probs, landmarks = coarse
+            windows = np.array(origins, dtype=np.float32).reshape(-1, 2) * ratio
+            window_size = np.array(roi_size, dtype=np.float32) * ratio
+            centers = (boxes[:, :2] + boxes[:, 2:4]) / 2
+            inside = ((centers[:, None, :] >= windows[None]) & (centers[:, None, :] <= windows[None] + window_size))
+            keep = (probs >= threshold) & ~inside.all(axis=2).any(axis=1)
+
+            pred = merge_detections([(boxes[keep], probs[keep], landmarks[keep]), refined],
+                                    nms_threshold=nms_threshold, min_size=min_face_size * scale, limit=limit_faces)
+            results.append((orig_id, scale, pred))
+        logger.debug(f'Refined detection of {len(plans)} images in {len(rois)} regions.')
+        return results
 
     # Process single image
     async def get(self, images,
@@ -332,6 +925,10 @@ class FaceAnalysis:
                   min_face_size: int = 0,
                   mask_thresh: float = 0.89,
                   limit_faces: int = 0,
+                  det_resolution: int = None,
+                  det_tiling: bool = False,
+                  det_refine: bool = False,
+                  timings: dict = None,
                   **kwargs):
         """
         Process a list of images using the FaceAnalysis model.
@@ -347,86 +944,154 @@ class FaceAnalysis:
             limit_faces (int, optional): The maximum number of faces to detect per image. Defaults to 0.
             min_face_size (int, optional): The minimum face size to detect. Defaults to 0.
             mask_thresh (float, optional): The mask detection threshold. Defaults to 0.89.
+            det_resolution (int, optional): Pin detector resolution instead of selecting it per image.
+                                            Defaults to None.
+            det_tiling (bool, optional): Detect faces in overlapping detector sized tiles of images larger than
+                                         detector input, instead of downscaling whole image. Defaults to False.
+            det_refine (bool, optional): Run coarse detection pass with lowered threshold and re-detect small
+                                         candidate faces within regions of interest at higher resolution.
+                                         Defaults to False.
+            timings (dict, optional): If provided, receives heads inference timings in milliseconds.
 
         Returns:
             List[dict]: A list of dictionaries containing face data and embeddings.
         """
         ts = time.perf_counter()
 
-        # If detector has input_shape attribute, use it instead of provided value
-        try:
-            max_size = self.det_model.retina.input_shape[2:][::-1]
-        except:
-            pass
-
-        # Pre-assign max_size to resize function
-        _partial_resize = partial(resize_image, max_size=max_size)
-        # Pre-assign threshold to detect function
-        _partial_detect = partial(self.det_model.detect, threshold=threshold)
-
-        # Initialize resized images iterator
-        res_images = map(_partial_resize, images)
-        batches = to_chunks(res_images, self.max_det_batch_size)
-
         faces = []
         faces_per_img = {}
 
-        for bid, batch in enumerate(batches):
-            batch_imgs, scales = zip(*batch)
+        # Group images by detector input size, so each bucket is resized and batched separately
+        buckets = collections.defaultdict(list)
+        tiled = {}
+        tile_size = self.det_sizes[-1]
+        for orig_id, image in enumerate(images):
+            if det_tiling:
+                tile_scale, origins = plan_tiles(image.shape, tile_size, overlap=self.det_tile_overlap,
+                                                 max_tiles=self.det_max_tiles)
+                if len(origins) > 1:
+                    tiled[orig_id] = (tile_scale, origins)
+                    continue
+            det_size, scale_factor = self.select_det_input(image.shape, max_size=max_size,
+                                                           min_face_size=min_face_size,
+                                                           det_resolution=det_resolution)
+            buckets[(det_size, det_refine)].append((orig_id, scale_factor))
+
+        async def _detect_bucket(det_size, coarse, entries):
+            _partial_resize = partial(resize_image, max_size=det_size)
+            resized = await self._run(lambda: [_partial_resize(images[e], scale_factor=s) for e, s in entries])
+            if coarse:
+                # Candidates for refinement are filtered after second pass
+                predictions = await self.detect([e[0] for e in resized], det_size=det_size,
+                                                threshold=min(threshold, self.det_refine_threshold))
+            elif self._cascade_model(det_size) is not None:
+                predictions = await self.detect_cascade([e[0] for e in resized], threshold=threshold,
+                                                        det_size=det_size,
+                                                        min_sizes=[min_face_size * e[1] for e in resized],
+                                                        limit=limit_faces)
+            else:
+                # Face size and count limits are applied by detector before NMS and alignment
+                predictions = await self.detect([e[0] for e in resized], threshold=threshold, det_size=det_size,
+                                                min_sizes=[min_face_size * e[1] for e in resized],
+                                                limit=limit_faces)
+            return [(orig_id, resized[i][1], pred) for i, ((orig_id, _), pred) in enumerate(zip(entries, predictions))]
+
+        async def _detect_tiled():
+            # Tiles of all images are packed together into detector batches
+            tiles = await self._run(lambda: [(orig_id, tile) for orig_id, (tile_scale, origins) in tiled.items()
+                                             for tile in make_tiles(images[orig_id], tile_scale, origins, tile_size)])
+            chunks = [list(e) for e in to_chunks(tiles, self.max_det_batch_size)]
+            predictions = await asyncio.gather(*[
+                self.detect([e[1] for e in chunk], threshold=threshold, det_size=tile_size,
+                            min_sizes=[min_face_size * tiled[e[0]][0] for e in chunk])
+                for chunk in chunks])
+            predictions = [pred for chunk in predictions for pred in chunk]
+
+            nms_threshold = self._nms_threshold(tile_size)
+            results = []
+            offset = 0
+            for orig_id, (tile_scale, origins) in tiled.items():
+                h, w = images[orig_id].shape[:2]
+                pred = merge_tiles(predictions[offset:offset + len(origins)], origins, tile_size,
+                                   image_size=(int(round(w * tile_scale)), int(round(h * tile_scale))),
+                                   nms_threshold=nms_threshold, min_size=min_face_size * tile_scale,
+                                   limit=limit_faces)
+                offset += len(origins)
+                results.append((orig_id, tile_scale, pred))
+            logger.debug(f'Tiled detection of {len(tiled)} images in {len(tiles)} tiles.')
+            return results
+
+        det_tasks = [_detect_bucket(det_size, coarse, list(entries))
+                     for (det_size, coarse), bucket in buckets.items()
+                     for entries in to_chunks(bucket, self.max_det_batch_size)]
+        if tiled:
+            det_tasks.append(_detect_tiled())
+        det_results = await asyncio.gather(*det_tasks)
+        det_results = [e for chunk in det_results for e in chunk]
+        if det_refine:
+            refined = [e for e in det_results if e[0] not in tiled]
+            det_results = [e for e in det_results if e[0] in tiled]
+            det_results += await self._refine(images, refined, threshold=threshold, min_face_size=min_face_size,
+                                              limit_faces=limit_faces)
+        det_results = sorted(det_results, key=lambda e: e[0])
+
+        # Crop faces from original image instead of resized to improve quality. All faces of request are
+        # warped straight into single crops batch per input size of used heads, consumed without further copies.
+        # Batches are views of pooled buffers, so crops returned as `facedata` are copied out before release.
+        crops = None
+        buffers = {}
+        if extract_ga or extract_embedding or return_face_data or detect_masks:
+            total = sum(len(pred[0]) for _, _, pred in det_results)
+            sizes = {112}
+            if detect_masks and self.mask_model:
+                sizes.add(getattr(self.mask_model, 'input_size', 112))
+            buffers = {size: self._acquire_crops(size, total) for size in sorted(sizes)}
+            crops = {size: buf[:total] for size, buf in buffers.items()}
+        to_align = []
+        for orig_id, scale, pred in det_results:
+            await asyncio.sleep(0)
+            boxes, probs, landmarks = pred
+            faces_per_img[orig_id] = len(boxes)
+
+            # Translate points to original image size
+            boxes = reproject_points(boxes, scale)
+            landmarks = reproject_points(landmarks, scale)
+            to_align.append((images[orig_id], landmarks, len(faces)))
+            for i in range(len(boxes)):
+                face = dict(
+                    bbox=boxes[i], landmarks=landmarks[i], prob=probs[i],
+                    num_det=i, scale=scale, facedata=crops[112][len(faces)] if crops is not None else None
+                )
+                faces.append(face)
+
+        if crops is not None and len(faces):
+            def align():
+                for img, landmarks, start in to_align:
+                    face_align.norm_crop_multisize(img, landmarks, {size: out[start:start + len(landmarks)]
+                                                                    for size, out in crops.items()})
+
             t0 = time.perf_counter()
-            det_predictions = zip(*_partial_detect(batch_imgs))
+            await self._run(align)
             t1 = time.perf_counter()
-            logger.debug(f'Detection took: {(t1 - t0) * 1000:.3f} ms.')
-
-            for idx, pred in enumerate(det_predictions):
-                await asyncio.sleep(0)
-                orig_id = (bid * self.max_det_batch_size) + idx
-                boxes, probs, landmarks = pred
-                faces_per_img[orig_id] = len(boxes)
-
-                if not isinstance(boxes, type(None)):
-                    t0 = time.perf_counter()
-                    if limit_faces > 0:
-                        boxes, probs, landmarks = self.sort_boxes(boxes, probs, landmarks,
-                                                                  shape=batch_imgs[idx].shape,
-                                                                  max_num=limit_faces)
-                        faces_per_img[orig_id] = len(boxes)
-
-                    # Translate points to original image size
-                    boxes = reproject_points(boxes, scales[idx])
-                    logger.debug(landmarks.shape)
-                    landmarks = reproject_points(landmarks, scales[idx])
-                    # Crop faces from original image instead of resized to improve quality
-                    if extract_ga or extract_embedding or return_face_data or detect_masks:
-                        crops = face_align.norm_crop_batched(images[orig_id], landmarks)
-                    else:
-                        crops = [None] * len(boxes)
-
-                    for i, _crop in enumerate(crops):
-                        face = dict(
-                            bbox=boxes[i], landmarks=landmarks[i], prob=probs[i],
-                            num_det=i, scale=scales[idx], facedata=_crop
-                        )
-                        if min_face_size > 0:
-                            w = boxes[i][2] - boxes[i][0]
-                            if w >= min_face_size:
-                                faces.append(face)
-                        else:
-                            faces.append(face)
-
-                    t1 = time.perf_counter()
-                    logger.debug(f'Cropping {len(boxes)} faces took: {(t1 - t0) * 1000:.3f} ms.')
+            logger.debug(f'Cropping {len(faces)} faces took: {(t1 - t0) * 1000:.3f} ms.')
 
         # Process detected faces
         tps = time.perf_counter()
         if extract_ga or extract_embedding or detect_masks:
-            faces = list(self.process_faces(faces,
-                                            extract_embedding=extract_embedding,
-                                            extract_ga=extract_ga,
-                                            return_face_data=return_face_data,
-                                            detect_masks=detect_masks, mask_thresh=mask_thresh))
+            faces = await self.process_faces(faces,
+                                             extract_embedding=extract_embedding,
+                                             extract_ga=extract_ga,
+                                             return_face_data=return_face_data,
+                                             detect_masks=detect_masks, mask_thresh=mask_thresh,
+                                             crops=crops, timings=timings)
         tpf = time.perf_counter()
         logger.debug(colorize_log(f'Processing faces took: {(tpf - tps) * 1000:.3f} ms.', 'green'))
+        for face in faces:
+            if face['facedata'] is not None:
+                face['facedata'] = face['facedata'].copy() if return_face_data else None
+        # Buffers are released only after successful processing, since on failure crops may still be used
+        # by inference running in worker threads.
+        self._release_crops(buffers)
         faces_by_img = []
         offset = 0
 
@@ -477,10 +1142,11 @@ class FaceAnalysis:
 
         iterator = self.__iterate_images(images)
         iterator = ({'facedata': e} for e in iterator)
-        faces = self.process_faces(iterator, extract_embedding=extract_embedding, extract_ga=extract_ga,
-                                   return_face_data=False, detect_masks=detect_masks)
 
         try:
+            faces = iter(await self.process_faces(iterator, extract_embedding=extract_embedding,
+                                                  extract_ga=extract_ga, return_face_data=False,
+                                                  detect_masks=detect_masks))
             for image in images:
                 if image.get('traceback') is not None:
                     _face_dict = dict(status='failed',
@@ -513,7 +1179,11 @@ class FaceAnalysis:
                     extract_embedding: bool = True,
                     extract_ga: bool = True,
                     return_landmarks: bool = False,
-                    detect_masks: bool = False):
+                    detect_masks: bool = False,
+                    det_resolution: int = None,
+                    det_tiling: bool = False,
+                    det_refine: bool = False,
+                    verbose_timings: bool = False):
         """
         Embed a list of images using the FaceAnalysis model.
 
@@ -528,6 +1198,12 @@ class FaceAnalysis:
             extract_ga (bool, optional): Whether to extract gender and age information from faces. Defaults to True.
             return_landmarks (bool, optional): Whether to return detected face landmarks. Defaults to False.
             detect_masks (bool, optional): Whether to detect masks on faces. Defaults to False.
+            det_resolution (int, optional): Pin detector resolution instead of selecting it per image.
+                                            Defaults to None.
+            det_tiling (bool, optional): Detect faces of large images in overlapping tiles. Defaults to False.
+            det_refine (bool, optional): Re-detect small faces found by coarse pass at higher resolution.
+                                         Defaults to False.
+            verbose_timings (bool, optional): Add per-head inference timings to output. Defaults to False.
 
         Returns:
            dict: A dictionary containing the embedded images and their corresponding embeddings.
@@ -537,16 +1213,22 @@ class FaceAnalysis:
                        extract_embedding=extract_embedding, extract_ga=extract_ga,
                        limit_faces=limit_faces,
                        min_face_size=min_face_size,
-                       detect_masks=detect_masks)
+                       detect_masks=detect_masks,
+                       det_resolution=det_resolution,
+                       det_tiling=det_tiling,
+                       det_refine=det_refine)
 
         _serialize = partial(serialize_face, return_face_data=return_face_data,
                              return_landmarks=return_landmarks)
 
         output = dict(took={}, data=[])
+        timings = {} if verbose_timings else None
 
         imgs_iterable = self.__iterate_images(images)
 
-        faces_by_img = (e for e in await _get([img for img in imgs_iterable]))
+        faces_by_img = (e for e in await _get([img for img in imgs_iterable], timings=timings))
+        if timings:
+            output['took'].update(timings)
 
         for img in images:
             _faces_dict = dict(status='failed', took_ms=0., faces=[])
@@ -11,5 +11,5 @@ class AbstractDetector(ABC):
         ...
 
     @abstractmethod
-    def detect(self, imgs, threshold=0.5):
+    def detect(self, imgs, threshold=0.5, min_size=None, limit: int = 0):
         ...
@@ -1,10 +1,11 @@
 import time
 from typing import Union
 
+import cv2
 import numpy as np
 
 from if_rest.core.model_zoo.detectors.abstract import AbstractDetector
-from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractDetectorInfer
 from if_rest.logger import logger
 
@@ -16,6 +17,7 @@ class CenterFace(AbstractDetector):
         self.nms_threshold = 0.3
         self.masks = False
         self.input_shape = (1, 3, 480, 640)
+        self.raw_input = False
 
     def __call__(self, img, threshold=0.5):
         return self.detect(img, threshold)
@@ -24,81 +26,99 @@ class CenterFace(AbstractDetector):
         self.nms_threshold = nms_threshold
         self.net.prepare()
         self.input_shape = self.net.input_shape
+        # Backend model with folded preprocessing takes raw images
+        self.raw_input = getattr(self.net, 'raw_input', False)
 
-    def detect(self, imgs: Union[list, tuple], threshold: float = 0.4):
+    def detect(self, imgs: Union[list, tuple], threshold: float = 0.4, min_size=None, limit: int = 0):
 
-        if not isinstance(imgs, tuple):
-            imgs = (imgs)
+        if isinstance(imgs, (list, tuple)):
+            imgs = np.stack(imgs)
+        elif len(imgs.shape) == 3:
+            imgs = np.expand_dims(imgs, 0)
 
-        det_list = []
-        lmk_list = []
-
-        for img in imgs:
-            h, w = img.shape[:2]
-            blob = np.expand_dims(img[:, :, (2, 1, 0)].transpose(2, 0, 1), axis=0).astype("float32")
-            t0 = time.time()
+        h, w = imgs[0].shape[:2]
+        if self.raw_input:
+            blob = np.ascontiguousarray(imgs)
+        else:
+            blob = cv2.dnn.blobFromImages(imgs, 1.0, (w, h), (0, 0, 0), swapRB=True)
+        t0 = time.time()
+        if self.input_shape[0] == 1 and blob.shape[0] > 1:
+            # Model exported with fixed batch size, run images one by one and merge outputs
+            outs = [self.net.run(blob[i:i + 1]) for i in range(blob.shape[0])]
+            heatmap, scale, offset, lms = [np.concatenate(e) for e in zip(*outs)]
+        else:
             heatmap, scale, offset, lms = self.net.run(blob)
-            t1 = time.time()
-            logger.debug(f"Inference took: {(t1 - t0) * 1000:.3f} ms.")
-            det, landmarks = self.postprocess(heatmap, lms, offset, scale, (h, w), threshold)
-            det_list.append(det)
-            lmk_list.append(landmarks)
+        t1 = time.time()
+        logger.debug(f"Inference took: {(t1 - t0) * 1000:.3f} ms.")
+        return self.postprocess(heatmap, lms, offset, scale, (h, w), threshold, min_size=min_size, limit=limit)
 
-        return det_list, lmk_list
+    def postprocess(self, heatmap, lms, offset, scale, size, threshold, min_size=None, limit: int = 0):
+        """
+        Decode network outputs of whole batch and filter them with NMS.
 
-    def postprocess(self, heatmap, lms, offset, scale, size, threshold):
+        :param heatmap: Face centers heatmap of shape (N, 1, H/4, W/4)
+        :param lms: Landmark offsets of shape (N, 10, H/4, W/4)
+        :param offset: Center offsets of shape (N, 2, H/4, W/4)
+        :param scale: Log box sizes of shape (N, 2, H/4, W/4)
+        :param size: Input image size (h, w)
+        :param threshold: Confidence threshold
+        :param min_size: Minimum face width, single value or one per image
+        :param limit: Maximum number of largest faces per image, 0 for unlimited
+        :return: Lists of face bboxes with scores [x1,y1,x2,y2,score], and key points for each image
+        """
         t0 = time.time()
+        batch_size = heatmap.shape[0]
+        dets, landmarks, counts = self.decode(heatmap, scale, offset, lms if self.landmarks else None, size,
+                                              threshold=threshold)
+        keep, kept_counts = filter_faces(dets, counts, thresh=self.nms_threshold, min_size=min_size, limit=limit)
+        splits = np.cumsum(kept_counts)[:-1]
+        det_list = np.split(dets[keep], splits)
+        lmk_list = [None] * batch_size
         if self.landmarks:
-            dets, lms = self.decode(heatmap, scale, offset, lms, size, threshold=threshold)
-        else:
-            dets = self.decode(heatmap, scale, offset, None, size, threshold=threshold)
-        if len(dets) > 0:
-            dets[:, 0:4:2], dets[:, 1:4:2] = dets[:, 0:4:2], dets[:, 1:4:2]
-            if self.landmarks:
-                lms[:, 0:10:2], lms[:, 1:10:2] = lms[:, 0:10:2], lms[:, 1:10:2]
-        else:
-            dets = np.empty(shape=[0, 5], dtype=np.float32)
-            if self.landmarks:
-                lms = np.empty(shape=[0, 10], dtype=np.float32)
+            lmk_list = np.split(landmarks[keep], splits)
         t1 = time.time()
         logger.debug(f"Postprocess took: {(t1 - t0) * 1000:.3f} ms.")
-
-        if self.landmarks:
-            return dets, lms
-        else:
-            return dets
+        return det_list, lmk_list
 
     def decode(self, heatmap, scale, offset, landmark, size, threshold=0.1):
-        heatmap = np.squeeze(heatmap)
-        scale0, scale1 = scale[0, 0, :, :], scale[0, 1, :, :]
-        offset0, offset1 = offset[0, 0, :, :], offset[0, 1, :, :]
-        c0, c1 = np.where(heatmap > threshold)
-        if self.landmarks:
-            boxes, lms = [], []
-        else:
-            boxes = []
-        if len(c0) > 0:
-            for i in range(len(c0)):
-                s0, s1 = np.exp(scale0[c0[i], c1[i]]) * 4, np.exp(scale1[c0[i], c1[i]]) * 4
-                o0, o1 = offset0[c0[i], c1[i]], offset1[c0[i], c1[i]]
-                s = heatmap[c0[i], c1[i]]
-                x1, y1 = max(0, (c1[i] + o1 + 0.5) * 4 - s1 / 2), max(0, (c0[i] + o0 + 0.5) * 4 - s0 / 2)
-                x1, y1 = min(x1, size[1]), min(y1, size[0])
-                boxes.append([x1, y1, min(x1 + s1, size[1]), min(y1 + s0, size[0]), s])
-                if self.landmarks:
-                    lm = []
-                    for j in range(5):
-                        lm.append(landmark[0, j * 2 + 1, c0[i], c1[i]] * s1 + x1)
-                        lm.append(landmark[0, j * 2, c0[i], c1[i]] * s0 + y1)
-                    lms.append(lm)
-            boxes = np.asarray(boxes, dtype=np.float32)
-            keep = nms(boxes, self.nms_threshold)
-            boxes = boxes[keep, :]
-            if self.landmarks:
-                lms = np.asarray(lms, dtype=np.float32)
-                lms = lms[keep, :]
-                lms = lms.reshape((-1, 5, 2))
-        if self.landmarks:
-            return boxes, lms
-        else:
-            return boxes
+        """
+        Convert heatmap peaks above threshold to boxes and landmarks for all images at once.
+
+        :return: Boxes with scores of shape (K, 5), landmarks of shape (K, 5, 2) or None,
+                 grouped by image, and number of proposals for each image
+        """
+        batch_size = heatmap.shape[0]
+        height, width = heatmap.shape[2:]
+        plane = height * width
+        scores = heatmap.reshape(-1)
+        flat_idx = np.flatnonzero(scores > threshold)
+        img_ids = flat_idx // plane
+        pos = flat_idx % plane
+        c0 = (pos // width).astype(np.float32)
+        c1 = (pos % width).astype(np.float32)
+        counts = np.bincount(img_ids, minlength=batch_size)
+
+        scale = scale.reshape((batch_size, 2, plane))
+        offset = offset.reshape((batch_size, 2, plane))
+        s0 = np.exp(scale[img_ids, 0, pos]) * 4
+        s1 = np.exp(scale[img_ids, 1, pos]) * 4
+        o0 = offset[img_ids, 0, pos]
+        o1 = offset[img_ids, 1, pos]
+
+        boxes = np.empty((flat_idx.shape[0], 5), dtype=np.float32)
+        x1 = np.clip((c1 + o1 + 0.5) * 4 - s1 / 2, 0, size[1])
+        y1 = np.clip((c0 + o0 + 0.5) * 4 - s0 / 2, 0, size[0])
+        boxes[:, 0] = x1
+        boxes[:, 1] = y1
+        boxes[:, 2] = np.minimum(x1 + s1, size[1])
+        boxes[:, 3] = np.minimum(y1 + s0, size[0])
+        boxes[:, 4] = scores[flat_idx]
+
+        lms = None
+        if landmark is not None:
+            # Landmark channels are stored as (y, x) pairs
+            landmark = landmark.reshape((batch_size, 5, 2, plane))
+            lms = np.empty((flat_idx.shape[0], 5, 2), dtype=np.float32)
+            lms[:, :, 0] = landmark[img_ids, :, 1, pos] * s1[:, None] + x1[:, None]
+            lms[:, :, 1] = landmark[img_ids, :, 0, pos] * s0[:, None] + y1[:, None]
+        return boxes, lms, counts
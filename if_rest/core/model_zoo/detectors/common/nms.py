@@ -31,3 +31,103 @@ def nms(dets, thresh=0.4):
         order = order[inds + 1]
 
     return keep
+
+
+@njit(cache=True)
+def batched_nms(dets, counts, thresh=0.4, limit=0, min_sizes=None):
+    """
+    Greedy NMS for proposals of multiple images in a single call.
+
+    Proposals of each image occupy contiguous region of `dets`, with sizes given by `counts`.
+    Boxes are visited in descending score order, so with `limit` > 0 suppression for image stops
+    as soon as `limit` boxes are kept, which yields the same boxes as full NMS followed by taking
+    `limit` most confident ones.
+
+    :param dets: Proposals as array of [x1, y1, x2, y2, score, ...] rows
+    :param counts: Number of proposals for each image
+    :param thresh: IoU threshold
+    :param limit: Maximum number of kept boxes per image, 0 for unlimited
+    :param min_sizes: Minimum box width for each image, narrower proposals are dropped before NMS
+    :return: Indices of kept proposals into `dets` grouped by image, and number of kept boxes per image
+    """
+    total = dets.shape[0]
+    keep = np.empty(total, dtype=np.int64)
+    kept_counts = np.zeros(counts.shape[0], dtype=np.int64)
+    suppressed = np.zeros(total, dtype=np.bool_)
+    areas = (dets[:, 2] - dets[:, 0] + 1) * (dets[:, 3] - dets[:, 1] + 1)
+
+    kept = 0
+    start = 0
+    for img in range(counts.shape[0]):
+        end = start + counts[img]
+        if min_sizes is not None and min_sizes[img] > 0:
+            idx = np.flatnonzero(dets[start:end, 2] - dets[start:end, 0] >= min_sizes[img]) + start
+            order = idx[dets[idx, 4].argsort()[::-1]]
+        else:
+            order = dets[start:end, 4].argsort()[::-1] + start
+        for _i in range(order.shape[0]):
+            i = order[_i]
+            if suppressed[i]:
+                continue
+            keep[kept] = i
+            kept += 1
+            kept_counts[img] += 1
+            if limit > 0 and kept_counts[img] >= limit:
+                break
+            for _j in range(_i + 1, order.shape[0]):
+                j = order[_j]
+                if suppressed[j]:
+                    continue
+                w = max(0.0, min(dets[i, 2], dets[j, 2]) - max(dets[i, 0], dets[j, 0]) + 1)
+                h = max(0.0, min(dets[i, 3], dets[j, 3]) - max(dets[i, 1], dets[j, 1]) + 1)
+                inter = w * h
+                if inter / (areas[i] + areas[j] - inter) > thresh:
+                    suppressed[j] = True
+        start = end
+
+    return keep[:kept], kept_counts
+
+
+def largest(dets, keep, kept_counts, limit=0):
+    """
+    Keep at most `limit` largest boxes for each image among boxes kept by NMS.
+    Images with more boxes than `limit` have them ordered by descending area.
+
+    :param dets: Proposals as array of [x1, y1, x2, y2, score, ...] rows
+    :param keep: Indices of boxes into `dets` grouped by image
+    :param kept_counts: Number of boxes for each image
+    :param limit: Maximum number of boxes per image, 0 for unlimited
+    :return: Indices of kept boxes into `dets` grouped by image, and number of kept boxes per image
+    """
+    if limit <= 0 or kept_counts.max(initial=0) <= limit:
+        return keep, kept_counts
+    out = []
+    start = 0
+    for count in kept_counts:
+        idx = keep[start:start + count]
+        if count > limit:
+            boxes = dets[idx]
+            area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+            idx = idx[np.argsort(area)[::-1][:limit]]
+        out.append(idx)
+        start += count
+    return np.concatenate(out), np.minimum(kept_counts, limit)
+
+
+def filter_faces(dets, counts, thresh=0.4, min_size=None, limit=0):
+    """
+    Run NMS over proposals of multiple images, dropping boxes narrower than `min_size` beforehand and
+    keeping at most `limit` largest faces per image afterwards.
+
+    :param dets: Proposals as array of [x1, y1, x2, y2, score, ...] rows grouped by image
+    :param counts: Number of proposals for each image
+    :param thresh: IoU threshold
+    :param min_size: Minimum face width in detector input pixels, either single value or one per image
+    :param limit: Maximum number of faces per image, 0 for unlimited
+    :return: Indices of kept proposals into `dets` grouped by image, and number of kept boxes per image
+    """
+    min_sizes = None
+    if min_size is not None and np.any(np.asarray(min_size) > 0):
+        min_sizes = np.broadcast_to(np.asarray(min_size, dtype=np.float64), counts.shape).copy()
+    keep, kept_counts = batched_nms(dets, counts, thresh=thresh, min_sizes=min_sizes)
+    return largest(dets, keep, kept_counts, limit)
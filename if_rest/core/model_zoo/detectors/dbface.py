@@ -7,84 +7,80 @@ import numpy as np
 from numba import njit
 
 from if_rest.core.model_zoo.detectors.abstract import AbstractDetector
-from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractDetectorInfer
 from if_rest.logger import logger
 
+MEAN = np.array([0.408, 0.447, 0.47], dtype=np.float32)
+STD = np.array([0.289, 0.274, 0.278], dtype=np.float32)
+
 
-@njit()
 def _exp(v):
-    gate: int = 1
-    base = np.exp(1)
-
-    def a(v):
-        if abs(v) < gate:
-            return v * base
-        if v > 0:
-            return np.exp(v)
-        else:
-            return -np.exp(-v)
+    """
+    DBFace landmark activation: linear with slope e inside (-1, 1), symmetric exponent outside.
+    """
+    return np.where(np.abs(v) < 1, v * np.e, np.sign(v) * np.exp(np.abs(v))).astype(v.dtype, copy=False)
 
-    return np.array([a(item) for item in v], v.dtype)
 
+@njit(cache=True)
+def find_peaks(hm, threshold):
+    """
+    Find local maximums of heatmaps in 3x3 window (zero padded) with score above threshold.
 
-def max_pool2d(A, kernel_size=3, stride=1, padding=1):
-    """2D Max Pooling
-    Parameters:
-        A: input 2D array
-        kernel_size: int, the size of the window
-        stride: int, the stride of the window
-        padding: int, implicit zero paddings on both sides of the input
+    :param hm: Heatmaps of shape (N, H, W)
+    :param threshold: Confidence threshold
+    :return: Flat indices of peaks into (N, H, W) heatmaps, in ascending order
     """
-    A = np.pad(A, padding, mode='constant')
-    output_shape = ((A.shape[0] - kernel_size) // stride + 1, (A.shape[1] - kernel_size) // stride + 1)
-    kernel_size = (kernel_size, kernel_size)
-    A_w = np.lib.stride_tricks.as_strided(A,
-                                          shape=output_shape + kernel_size,
-                                          strides=(stride * A.strides[0], stride * A.strides[1]) + A.strides)
-    A_w = A_w.reshape(-1, *kernel_size)
-    return A_w.max(axis=(1, 2)).reshape(output_shape)
-
-
-def get_topk_score_indices(hm_pool, hm, k):
-    ary = ((hm_pool == hm).astype(np.bool) * hm).reshape(-1)
-    indices = ary.argsort()[::-1][:k]
-    scores = ary[indices]
-    return scores, indices
-
-
-@njit()
-def bx_lm(box, landmark, scores, threshold, xs, ys):
-    size = xs.shape[0]
-    stride = 4
-    lms = np.zeros((size, 5, 2))
-    boxes = np.zeros((size, 5))
+    n, height, width = hm.shape
+    out = np.empty(n * height * width, dtype=np.int64)
     count = 0
-    for i in range(size):
-        if scores[i] < threshold:
-            break
-        x, y, r, b = box[:, ys[i], xs[i]]
-        xyrbs = (np.array([xs[i], ys[i], xs[i], ys[i], 0]) + np.array([-x, -y, r, b, 0])) * stride
-        xyrbs[4] = scores[i]
-        x5y5 = landmark[:, ys[i], xs[i]]
-        x5y5s = (_exp(x5y5 * 4) + np.array([xs[i]] * 5 + [ys[i]] * 5)) * stride
-        box_landmark = np.dstack((x5y5s[:5], x5y5s[5:]))[0]
-        boxes[count] = xyrbs
-        lms[count] = box_landmark
-        count += 1
-    return boxes[:count], lms[:count]
-
-
-@njit()
-def prepare_image(img):
-    mean = np.array([0.408, 0.447, 0.47], dtype=np.float32)
-    std = np.array([0.289, 0.274, 0.278], dtype=np.float32)
-    img = ((img / 255.0 - mean) / std).astype(np.float32)
-    # img = ((img / 255.0)).astype(np.float32)
-    img = img.transpose((2, 0, 1))
-    img = np.expand_dims(img, 0)
-
-    return img
+    for b in range(n):
+        for y in range(height):
+            for x in range(width):
+                v = hm[b, y, x]
+                if v < threshold:
+                    continue
+                peak = True
+                for dy in range(-1, 2):
+                    yy = y + dy
+                    for dx in range(-1, 2):
+                        xx = x + dx
+                        if 0 <= yy < height and 0 <= xx < width:
+                            if hm[b, yy, xx] > v:
+                                peak = False
+                        elif v < 0:
+                            peak = False
+                if peak:
+                    out[count] = (b * height + y) * width + x
+                    count += 1
+    return out[:count]
+
+
+def topk_peaks(flat_idx, scores, plane, batch_size, k):
+    """
+    Keep at most `k` most confident peaks for each image.
+
+    :return: Flat indices of kept peaks grouped by image, and number of peaks for each image
+    """
+    img_ids = flat_idx // plane
+    counts = np.bincount(img_ids, minlength=batch_size)
+    if counts.max(initial=0) <= k:
+        return flat_idx, counts
+    starts = np.cumsum(counts) - counts
+    kept = []
+    for img in range(batch_size):
+        idx = flat_idx[starts[img]:starts[img] + counts[img]]
+        if idx.shape[0] > k:
+            top = np.argsort(-scores[idx], kind='stable')[:k]
+            idx = np.sort(idx[top])
+        kept.append(idx)
+    flat_idx = np.concatenate(kept)
+    return flat_idx, np.minimum(counts, k)
+
+
+def prepare_images(imgs):
+    blob = (imgs.astype(np.float32) * (1 / 255.) - MEAN) / STD
+    return np.ascontiguousarray(blob.transpose((0, 3, 1, 2)))
 
 
 class DBFace(AbstractDetector):
@@ -94,51 +90,77 @@ class DBFace(AbstractDetector):
         self.masks = False
         self.nms_threshold = 0.45
         self.input_shape = (1, 3, 480, 640)
+        self.top_k = 1000
+        self.raw_input = False
 
     def prepare(self, nms_threshold: float = 0.45, **kwargs):
         self.nms_threshold = nms_threshold
         self.net.prepare()
         self.input_shape = self.net.input_shape
+        # Backend model with folded preprocessing takes raw images
+        self.raw_input = getattr(self.net, 'raw_input', False)
 
-    def detect(self, imgs: Union[list, tuple], threshold: float = 0.4):
-        if not isinstance(imgs, tuple):
-            imgs = (imgs)
-
-        det_list = []
-        lmk_list = []
-        for img in imgs:
-            img = prepare_image(img)
-            t0 = time.time()
-            hm, box, landmark = self.net.run(img)
-            t1 = time.time()
-            logger.debug(f"DBFace inference took: {t1 - t0}")
-            det, landmarks = self.postprocess(hm, box, landmark, threshold=threshold)
-            det_list.append(det)
-            lmk_list.append(landmarks)
-        return det_list, lmk_list
-
-    def postprocess(self, hm, box, landmark, threshold=0.35):
-        t0 = time.time()
-        hm_pool = max_pool2d(hm[0, 0, :, :], 3, 1, 1)
-        hm_pool = np.expand_dims(np.expand_dims(hm_pool, 0), 0)
-        scores, indices = get_topk_score_indices(hm_pool, hm, k=1000)
+    def detect(self, imgs: Union[list, tuple], threshold: float = 0.4, min_size=None, limit: int = 0):
+        if isinstance(imgs, (list, tuple)):
+            imgs = np.stack(imgs)
+        elif len(imgs.shape) == 3:
+            imgs = np.expand_dims(imgs, 0)
 
+        blob = np.ascontiguousarray(imgs) if self.raw_input else prepare_images(imgs)
+        t0 = time.time()
+        if self.input_shape[0] == 1 and blob.shape[0] > 1:
+            # Model exported with fixed batch size, run images one by one and merge outputs
+            outs = [self.net.run(blob[i:i + 1]) for i in range(blob.shape[0])]
+            hm, box, landmark = [np.concatenate(e) for e in zip(*outs)]
+        else:
+            hm, box, landmark = self.net.run(blob)
+        t1 = time.time()
+        logger.debug(f"DBFace inference took: {t1 - t0}")
+        return self.postprocess(hm, box, landmark, threshold=threshold, min_size=min_size, limit=limit)
+
+    def postprocess(self, hm, box, landmark, threshold=0.35, min_size=None, limit: int = 0):
+        """
+        Decode network outputs of whole batch and filter them with NMS.
+
+        :param hm: Face centers heatmap of shape (N, 1, H/4, W/4)
+        :param box: Box distances of shape (N, 4, H/4, W/4)
+        :param landmark: Landmark offsets of shape (N, 10, H/4, W/4)
+        :param threshold: Confidence threshold
+        :param min_size: Minimum face width, single value or one per image
+        :param limit: Maximum number of largest faces per image, 0 for unlimited
+        :return: Lists of face bboxes with scores [x1,y1,x2,y2,score], and key points for each image
+        """
+        t0 = time.time()
+        stride = 4
+        batch_size = hm.shape[0]
         hm_height, hm_width = hm.shape[2:]
-        ys = indices // hm_width
-        xs = indices % hm_width
-        box = box.reshape(box.shape[1:])
-        landmark = landmark.reshape(landmark.shape[1:])
-
-        boxes, landmarks = bx_lm(box, landmark, scores, threshold, xs, ys)
-
-        # tn0 = time.time()
-        boxes = np.asarray(boxes, dtype=np.float32)
-        keep = nms(boxes, self.nms_threshold)
-        boxes = boxes[keep, :]
-        lms = np.asarray(landmarks, dtype=np.float32)
-        lms = lms[keep, :]
-        # tn1 = time.time()
-        # logger.debug(f"NMS took: {tn1 - tn0} ({1 / (tn1 - tn0)} im/sec)")
+        plane = hm_height * hm_width
+
+        scores = hm.reshape(-1)
+        flat_idx = find_peaks(hm.reshape((batch_size, hm_height, hm_width)), threshold)
+        flat_idx, counts = topk_peaks(flat_idx, scores, plane, batch_size, self.top_k)
+
+        img_ids = flat_idx // plane
+        pos = flat_idx % plane
+        ys = (pos // hm_width).astype(np.float32)
+        xs = (pos % hm_width).astype(np.float32)
+
+        box = box.reshape((batch_size, 4, plane))[img_ids, :, pos]
+        boxes = np.empty((flat_idx.shape[0], 5), dtype=np.float32)
+        boxes[:, 0] = (xs - box[:, 0]) * stride
+        boxes[:, 1] = (ys - box[:, 1]) * stride
+        boxes[:, 2] = (xs + box[:, 2]) * stride
+        boxes[:, 3] = (ys + box[:, 3]) * stride
+        boxes[:, 4] = scores[flat_idx]
+
+        landmark = landmark.reshape((batch_size, 2, 5, plane))[img_ids, :, :, pos]
+        landmark = _exp(landmark * 4)
+        lms = np.empty((flat_idx.shape[0], 5, 2), dtype=np.float32)
+        lms[:, :, 0] = (landmark[:, 0] + xs[:, None]) * stride
+        lms[:, :, 1] = (landmark[:, 1] + ys[:, None]) * stride
+
+        keep, kept_counts = filter_faces(boxes, counts, thresh=self.nms_threshold, min_size=min_size, limit=limit)
+        splits = np.cumsum(kept_counts)[:-1]
         t1 = time.time()
         logger.debug(f"DBFace postprocess took: {t1 - t0}")
-        return boxes, lms
+        return np.split(boxes[keep], splits), np.split(lms[keep], splits)
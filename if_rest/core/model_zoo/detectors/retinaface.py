@@ -1,5 +1,6 @@
 from __future__ import division
 
+import math
 import time
 from typing import Union
 
@@ -7,7 +8,7 @@ import cv2
 import numpy as np
 
 from if_rest.core.model_zoo.detectors.abstract import AbstractDetector
-from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractDetectorInfer
 from if_rest.logger import logger
 
@@ -67,7 +68,6 @@ def _scale_enum(anchor, scales):
     return anchors
 
 
-# @jit()
 def anchors_plane(height, width, stride, base_anchors):
     """
     Parameters
@@ -80,17 +80,9 @@ def anchors_plane(height, width, stride, base_anchors):
     -------
     all_anchors: (height, width, A, 4) ndarray of anchors spreading over the plane
     """
-    A = base_anchors.shape[0]
-    all_anchors = np.zeros((height, width, A, 4), dtype=np.float32)
-    for iw in range(width):
-        sw = iw * stride
-        for ih in range(height):
-            sh = ih * stride
-            for k in range(A):
-                all_anchors[ih, iw, k, 0] = base_anchors[k, 0] + sw
-                all_anchors[ih, iw, k, 1] = base_anchors[k, 1] + sh
-                all_anchors[ih, iw, k, 2] = base_anchors[k, 2] + sw
-                all_anchors[ih, iw, k, 3] = base_anchors[k, 3] + sh
+    shift_y, shift_x = np.mgrid[:height, :width] * stride
+    shifts = np.stack((shift_x, shift_y, shift_x, shift_y), axis=-1).astype(np.float32)
+    all_anchors = shifts[:, :, np.newaxis, :] + base_anchors[np.newaxis, np.newaxis, :, :].astype(np.float32)
     return all_anchors
 
 
@@ -161,7 +153,7 @@ def bbox_pred(boxes, box_deltas):
     if boxes.shape[0] == 0:
         return np.zeros((0, box_deltas.shape[1]))
 
-    boxes = boxes.astype(np.float, copy=False)
+    boxes = boxes.astype(np.float64, copy=False)
     widths = boxes[:, 2] - boxes[:, 0] + 1.0
     heights = boxes[:, 3] - boxes[:, 1] + 1.0
     ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
@@ -195,16 +187,16 @@ def bbox_pred(boxes, box_deltas):
 
 def landmark_pred(boxes, landmark_deltas):
     if boxes.shape[0] == 0:
-        return np.zeros((0, landmark_deltas.shape[1]))
-    boxes = boxes.astype(np.float, copy=False)
+        # Keep (0, 5, 2) shape, so empty strides can be stacked with non-empty ones
+        return np.zeros((0,) + landmark_deltas.shape[1:], dtype=landmark_deltas.dtype)
+    boxes = boxes.astype(np.float64, copy=False)
     widths = boxes[:, 2] - boxes[:, 0] + 1.0
     heights = boxes[:, 3] - boxes[:, 1] + 1.0
     ctr_x = boxes[:, 0] + 0.5 * (widths - 1.0)
     ctr_y = boxes[:, 1] + 0.5 * (heights - 1.0)
-    pred = landmark_deltas.copy()
-    for i in range(5):
-        pred[:, i, 0] = landmark_deltas[:, i, 0] * widths + ctr_x
-        pred[:, i, 1] = landmark_deltas[:, i, 1] * heights + ctr_y
+    sizes = np.stack((widths, heights), axis=-1)[:, np.newaxis, :]
+    centers = np.stack((ctr_x, ctr_y), axis=-1)[:, np.newaxis, :]
+    pred = (landmark_deltas * sizes + centers).astype(landmark_deltas.dtype, copy=False)
     return pred
 
 
@@ -214,10 +206,13 @@ class RetinaFace(AbstractDetector):
         self.masks = masks
         self.model = inference_backend
         self.input_shape = (1, 3, 480, 640)
+        self.raw_input = False
 
     def prepare(self, nms_threshold: float = 0.4, **kwargs):
         self.model.prepare()
         self.input_shape = self.model.input_shape
+        # Backend model with folded preprocessing takes raw images
+        self.raw_input = getattr(self.model, 'raw_input', False)
         self.nms_threshold = nms_threshold
         self.landmark_std = 1.0
 
@@ -253,35 +248,76 @@ class RetinaFace(AbstractDetector):
 
         self._num_anchors = dict(zip(self.fpn_keys, [anchors.shape[0] for anchors in self._anchors_fpn.values()]))
 
-    def detect(self, imgs: Union[list, tuple], threshold: float = 0.6):
-
-        if not isinstance(imgs, tuple):
-            imgs = (imgs)
+        # Precompute anchor planes for configured input shape
+        height, width = self.input_shape[2:]
+        if isinstance(height, int) and isinstance(width, int):
+            for s in self._feat_stride_fpn:
+                self._get_anchors(math.ceil(height / s), math.ceil(width / s), s)
+
+    def _get_anchors(self, height, width, stride):
+        """
+        Get anchors for feature map of stride, computing and caching them if required.
+
+        Returns:
+            np.ndarray: (height * width * A, 4) array of anchors.
+        """
+        key = (height, width, stride)
+        anchors = self.anchor_plane_cache.get(key)
+        if anchors is None:
+            anchors_fpn = self._anchors_fpn['stride%s' % stride]
+            anchors = anchors_plane(height, width, stride, anchors_fpn)
+            anchors = anchors.reshape((-1, 4))
+            if len(self.anchor_plane_cache) < 100:
+                self.anchor_plane_cache[key] = anchors
+        return anchors
+
+    def detect(self, imgs: Union[list, tuple], threshold: float = 0.6, min_size=None, limit: int = 0):
+
+        if isinstance(imgs, (list, tuple)):
+            imgs = np.stack(imgs)
+        elif len(imgs.shape) == 3:
+            imgs = np.expand_dims(imgs, 0)
+
+        if self.raw_input:
+            input_blob = np.ascontiguousarray(imgs)
+        else:
+            input_size = tuple(imgs[0].shape[0:2][::-1])
+            input_blob = cv2.dnn.blobFromImages(imgs, 1.0, input_size, (0, 0, 0), swapRB=True)
 
-        det_list = []
-        lmk_list = []
-        for im in imgs:
-            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-            im = np.transpose(im, (2, 0, 1))
-            input_blob = np.expand_dims(im, axis=0).astype(np.float32)
-            t0 = time.time()
+        t0 = time.time()
+        if self.input_shape[0] == 1 and input_blob.shape[0] > 1:
+            # Model exported with fixed batch size, run images one by one and merge outputs
+            outs = [self.model.run(input_blob[i:i + 1]) for i in range(input_blob.shape[0])]
+            net_out = [np.concatenate(e) for e in zip(*outs)]
+        else:
             net_out = self.model.run(input_blob)
-            t1 = time.time()
-            logger.debug(f"Inference took: {(t1 - t0) * 1000:.3f} ms.")
-            det, landmarks = self.postprocess(net_out, threshold)
-            det_list.append(det)
-            lmk_list.append(landmarks)
-
-        return det_list, lmk_list
-
-    def postprocess(self, net_out, threshold):
+        t1 = time.time()
+        logger.debug(f"Inference took: {(t1 - t0) * 1000:.3f} ms.")
+
+        return self.postprocess(net_out, threshold, input_blob.shape[0], min_size=min_size, limit=limit)
+
+    def postprocess(self, net_out, threshold, batch_size: int = 1, min_size=None, limit: int = 0):
+        """
+        Decode proposals of all images in batch and filter them with NMS.
+        Scores of the whole batch are filtered at once and only survivors are decoded.
+
+        Args:
+            net_out (List[np.ndarray]): Network outputs.
+            threshold (float): Confidence threshold.
+            batch_size (int): Number of images in batch.
+            min_size (Union[float, np.ndarray]): Minimum face width, single value or one per image.
+            limit (int): Maximum number of largest faces per image, 0 for unlimited.
+
+        Returns:
+            tuple: Lists of detections and landmarks for each image.
+        """
+        img_ids_list = []
         proposals_list = []
         scores_list = []
         mask_scores_list = []
         landmarks_list = []
         t0 = time.time()
         for _idx, s in enumerate(self._feat_stride_fpn):
-            _key = 'stride%s' % s
             stride = int(s)
             if self.use_landmarks:
                 idx = _idx * 3
@@ -297,44 +333,27 @@ class RetinaFace(AbstractDetector):
             idx += 1
             bbox_deltas = net_out[idx]
             height, width = bbox_deltas.shape[2], bbox_deltas.shape[3]
-
-            K = height * width
-            key = (height, width, stride)
-            if key in self.anchor_plane_cache:
-                anchors = self.anchor_plane_cache[key]
-            else:
-
-                anchors_fpn = self._anchors_fpn['stride%s' % s]
-                anchors = anchors_plane(height, width, stride, anchors_fpn)
-                anchors = anchors.reshape((K * A, 4))
-                if len(self.anchor_plane_cache) < 100:
-                    self.anchor_plane_cache[key] = anchors
+            anchors = self._get_anchors(height, width, stride)
 
             scores = clip_pad(scores, (height, width))
-            scores = scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
+            scores = scores.transpose((0, 2, 3, 1)).reshape(-1)
+            flat_idx = np.flatnonzero(scores >= threshold)
+            anchor_idx = flat_idx % anchors.shape[0]
+            img_ids_list.append(flat_idx // anchors.shape[0])
+            scores_list.append(scores[flat_idx].reshape((-1, 1)))
 
             bbox_deltas = clip_pad(bbox_deltas, (height, width))
             bbox_deltas = bbox_deltas.transpose((0, 2, 3, 1))
             bbox_pred_len = bbox_deltas.shape[3] // A
-            bbox_deltas = bbox_deltas.reshape((-1, bbox_pred_len))
-
-            proposals = bbox_pred(anchors, bbox_deltas)
-
-            scores_ravel = scores.ravel()
-            order = np.where(scores_ravel >= threshold)[0]
-            proposals = proposals[order, :]
-            scores = scores[order]
-
-            proposals_list.append(proposals)
-            scores_list.append(scores)
+            bbox_deltas = bbox_deltas.reshape((-1, bbox_pred_len))[flat_idx]
+            proposals_list.append(bbox_pred(anchors[anchor_idx], bbox_deltas))
 
             if self.masks:
                 type_scores = net_out[idx + 2]
                 mask_scores = type_scores[:, A * 2:, :, :]
                 mask_scores = clip_pad(mask_scores, (height, width))
                 mask_scores = mask_scores.transpose((0, 2, 3, 1)).reshape((-1, 1))
-                mask_scores = mask_scores[order]
-                mask_scores_list.append(mask_scores)
+                mask_scores_list.append(mask_scores[flat_idx])
 
             if self.use_landmarks:
                 idx += 1
@@ -342,39 +361,30 @@ class RetinaFace(AbstractDetector):
                 landmark_deltas = clip_pad(landmark_deltas, (height, width))
                 landmark_pred_len = landmark_deltas.shape[1] // A
                 landmark_deltas = landmark_deltas.transpose((0, 2, 3, 1)).reshape((-1, 5, landmark_pred_len // 5))
-                landmark_deltas *= self.landmark_std
-                landmarks = landmark_pred(anchors, landmark_deltas)
-                landmarks = landmarks[order, :]
-                landmarks_list.append(landmarks)
-
-        proposals = np.vstack(proposals_list)
-        landmarks = None
-        if proposals.shape[0] == 0:
-            if self.use_landmarks:
-                landmarks = np.zeros((0, 5, 2))
-            return np.zeros((0, 5)), landmarks
-
-        scores = np.vstack(scores_list)
+                landmark_deltas = landmark_deltas[flat_idx] * self.landmark_std
+                landmarks_list.append(landmark_pred(anchors[anchor_idx], landmark_deltas))
 
-        scores_ravel = scores.ravel()
-        order = scores_ravel.argsort()[::-1]
-        proposals = proposals[order, :]
-        scores = scores[order]
+        # Group proposals by image, NMS orders them by score
+        img_ids = np.concatenate(img_ids_list)
+        order = np.argsort(img_ids, kind='stable')
+        counts = np.bincount(img_ids, minlength=batch_size)
 
-        if self.use_landmarks:
-            landmarks = np.vstack(landmarks_list)
-            landmarks = landmarks[order].astype(np.float32, copy=False)
+        proposals = np.vstack(proposals_list)[order]
+        scores = np.vstack(scores_list)[order]
         if self.masks:
-            mask_scores = np.vstack(mask_scores_list)
-            mask_scores = mask_scores[order]
+            mask_scores = np.vstack(mask_scores_list)[order]
             pre_det = np.hstack((proposals[:, 0:4], scores, mask_scores)).astype(np.float32, copy=False)
         else:
             pre_det = np.hstack((proposals[:, 0:4], scores)).astype(np.float32, copy=False)
-        keep = nms(pre_det, thresh=self.nms_threshold)
-        det = np.hstack((pre_det, proposals[:, 4:]))
-        det = det[keep, :]
+        keep, kept_counts = filter_faces(pre_det, counts, thresh=self.nms_threshold, min_size=min_size, limit=limit)
+        splits = np.cumsum(kept_counts)[:-1]
+
+        det = np.hstack((pre_det, proposals[:, 4:]))[keep, :]
+        det_list = np.split(det, splits)
+        lmk_list = [None] * batch_size
         if self.use_landmarks:
-            landmarks = landmarks[keep]
+            landmarks = np.vstack(landmarks_list)[order].astype(np.float32, copy=False)
+            lmk_list = np.split(landmarks[keep], splits)
         t1 = time.time()
         logger.debug(f"Postprocess took: {(t1 - t0) * 1000:.3f} ms.")
-        return det, landmarks
+        return det_list, lmk_list
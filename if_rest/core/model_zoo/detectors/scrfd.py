@@ -13,7 +13,7 @@ import numpy as np
 from numba import njit
 
 from if_rest.core.model_zoo.detectors.abstract import AbstractDetector
-from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractDetectorInfer
 from if_rest.logger import logger
 
@@ -37,92 +37,65 @@ def timing(f):
 
 
 @njit(fastmath=True, cache=True)
-def single_distance2bbox(point, distance, stride):
+def decode_proposals(flat_idx, score_blob, bbox_blob, kpss_blob, anchors, stride, cursor, score_out, bbox_out,
+                     kpss_out):
     """
-    Fast conversion of single bbox distances to coordinates
+    Convert distances from anchors to actual coordinates on source image for proposals
+    which passed confidence threshold, writing them to per-image regions of preallocated outputs.
 
-    :param point: Anchor point
-    :param distance: Bbox distances from anchor point
-    :param stride: Current stride scale
-    :return: bbox
-    """
-    distance[0] = point[0] - distance[0] * stride
-    distance[1] = point[1] - distance[1] * stride
-    distance[2] = point[0] + distance[2] * stride
-    distance[3] = point[1] + distance[3] * stride
-    return distance
-
-
-@njit(fastmath=True, cache=True)
-def single_distance2kps(point, distance, stride):
-    """
-    Fast conversion of single keypoint distances to coordinates
-
-    :param point: Anchor point
-    :param distance: Keypoint distances from anchor point
-    :param stride: Current stride scale
-    :return: keypoint
-    """
-    for ix in range(0, distance.shape[0], 2):
-        distance[ix] = distance[ix] * stride + point[0]
-        distance[ix + 1] = distance[ix + 1] * stride + point[1]
-    return distance
-
-
-@njit(fastmath=True, cache=True)
-def generate_proposals(score_blob, bbox_blob, kpss_blob, stride, anchors, threshold, score_out, bbox_out, kpss_out,
-                       offset):
-    """
-    Convert distances from anchors to actual coordinates on source image
-    and filter proposals by confidence threshold.
-    Uses preallocated np.ndarrays for output.
-
-    :param score_blob: Raw scores for stride
-    :param bbox_blob: Raw bbox distances for stride
-    :param kpss_blob: Raw keypoints distances for stride
-    :param stride: Stride scale
+    :param flat_idx: Indices of proposals in flattened (N, anchors) stride outputs
+    :param score_blob: Raw scores for stride of shape (N * anchors)
+    :param bbox_blob: Raw bbox distances for stride of shape (N * anchors, 4)
+    :param kpss_blob: Raw keypoints distances for stride of shape (N * anchors, 10)
     :param anchors: Precomputed anchors for stride
-    :param threshold: Confidence threshold
+    :param stride: Stride scale
+    :param cursor: Next write position for each image, updated in place
     :param score_out: Output scores np.ndarray
     :param bbox_out: Output bbox np.ndarray
     :param kpss_out: Output key points np.ndarray
-    :param offset: Write offset for output arrays
-    :return:
     """
 
-    total = offset
-
-    for ix in range(0, anchors.shape[0]):
-        if score_blob[ix, 0] > threshold:
-            score_out[total] = score_blob[ix]
-            bbox_out[total] = single_distance2bbox(anchors[ix], bbox_blob[ix], stride)
-            kpss_out[total] = single_distance2kps(anchors[ix], kpss_blob[ix], stride)
-            total += 1
-
-    return score_out, bbox_out, kpss_out, total
+    num_anchors = anchors.shape[0]
+    for j in range(flat_idx.shape[0]):
+        ix = flat_idx[j]
+        img = ix // num_anchors
+        point = anchors[ix - img * num_anchors]
+        pos = cursor[img]
+        score_out[pos, 0] = score_blob[ix]
+        bbox_out[pos, 0] = point[0] - bbox_blob[ix, 0] * stride
+        bbox_out[pos, 1] = point[1] - bbox_blob[ix, 1] * stride
+        bbox_out[pos, 2] = point[0] + bbox_blob[ix, 2] * stride
+        bbox_out[pos, 3] = point[1] + bbox_blob[ix, 3] * stride
+        for k in range(0, kpss_blob.shape[1], 2):
+            kpss_out[pos, k] = kpss_blob[ix, k] * stride + point[0]
+            kpss_out[pos, k + 1] = kpss_blob[ix, k + 1] * stride + point[1]
+        cursor[img] = pos + 1
 
 
 # @timing
-@njit(fastmath=True, cache=True)
 def filter(bboxes_list: np.ndarray, kpss_list: np.ndarray,
-           scores_list: np.ndarray, nms_threshold: float = 0.4):
+           scores_list: np.ndarray, counts: np.ndarray, nms_threshold: float = 0.4, min_size=None, limit: int = 0):
     """
-    Filter postprocessed network outputs with NMS
-
-    :param bboxes_list: List of bboxes (np.ndarray)
-    :param kpss_list: List of keypoints (np.ndarray)
-    :param scores_list: List of scores (np.ndarray)
-    :return: Face bboxes with scores [t,l,b,r,score], and key points
+    Filter postprocessed network outputs of whole batch with NMS
+
+    :param bboxes_list: Bboxes of all images (np.ndarray)
+    :param kpss_list: Keypoints of all images (np.ndarray)
+    :param scores_list: Scores of all images (np.ndarray)
+    :param counts: Number of proposals for each image
+    :param nms_threshold: Threshold for NMS IoU
+    :param min_size: Minimum face width, narrower proposals are dropped before NMS
+    :param limit: Maximum number of largest faces per image, 0 for unlimited
+    :return: Lists of face bboxes with scores [t,l,b,r,score], and key points for each image
     """
 
     pre_det = np.hstack((bboxes_list, scores_list))
-    keep = nms(pre_det, thresh=nms_threshold)
-    keep = np.asarray(keep)
+    keep, kept_counts = filter_faces(pre_det, counts, thresh=nms_threshold, min_size=min_size, limit=limit)
     det = pre_det[keep, :]
     kpss = kpss_list[keep, :]
     kpss = kpss.reshape((kpss.shape[0], -1, 2))
 
-    return det, kpss
+    splits = np.cumsum(kept_counts)[:-1]
+    return np.split(det, splits), np.split(kpss, splits)
 
 
 def _normalize_on_device(input, stream, out):
@@ -160,6 +133,7 @@ class SCRFD(AbstractDetector):
         self._num_anchors = 2
         self.stream = None
         self.input_ptr = None
+        self.raw_input = False
 
     def prepare(self, nms_threshold: float = 0.4, **kwargs):
         """
@@ -172,15 +146,8 @@ class SCRFD(AbstractDetector):
         self.session.prepare()
         self.out_shapes = self.session.out_shapes
         self.input_shape = self.session.input_shape
-        self.infer_shape = self.input_shape
-
-        # Preallocate reusable arrays for proposals
-        max_prop_len = self._get_max_prop_len(self.input_shape,
-                                              self._feat_stride_fpn,
-                                              self._num_anchors)
-        self.score_list = np.zeros((max_prop_len, 1), dtype='float32')
-        self.bbox_list = np.zeros((max_prop_len, 4), dtype='float32')
-        self.kpss_list = np.zeros((max_prop_len, 10), dtype='float32')
+        # Backend model with folded preprocessing takes raw images
+        self.raw_input = getattr(self.session, 'raw_input', False)
 
         # Check if exec backend provides CUDA stream
         try:
@@ -190,12 +157,14 @@ class SCRFD(AbstractDetector):
             pass
 
     # @timing
-    def detect(self, imgs, threshold=0.5):
+    def detect(self, imgs, threshold=0.5, min_size=None, limit: int = 0):
         """
         Run detection pipeline for provided image
 
         :param img: Raw image as nd.ndarray with HWC shape
         :param threshold: Confidence threshold
+        :param min_size: Minimum face width in input pixels, single value or one per image
+        :param limit: Maximum number of largest faces per image, 0 for unlimited
         :return: Face bboxes with scores [t,l,b,r,score], and key points
         """
 
@@ -209,40 +178,16 @@ class SCRFD(AbstractDetector):
 
         input_height = imgs[0].shape[0]
         input_width = imgs[0].shape[1]
-        blob = self._preprocess(imgs)
-        net_outs = self._forward(blob)
-
-        dets_list = []
-        kpss_list = []
-
-        bboxes_by_img, kpss_by_img, scores_by_img = self._postprocess(net_outs, input_height, input_width, threshold)
+        blob, infer_shape = self._preprocess(imgs)
+        net_outs = self._forward(blob, infer_shape)
 
-        for e in range(self.infer_shape[0]):
-            det, kpss = filter(
-                bboxes_by_img[e], kpss_by_img[e], scores_by_img[e], self.nms_threshold)
-
-            dets_list.append(det)
-            kpss_list.append(kpss)
+        bboxes, kpss, scores, counts = self._postprocess(net_outs, input_height, input_width, threshold,
+                                                         infer_shape[0])
+        dets_list, kpss_list = filter(bboxes, kpss, scores, counts, self.nms_threshold, min_size=min_size,
+                                      limit=limit)
 
         return dets_list, kpss_list
 
-    @staticmethod
-    def _get_max_prop_len(input_shape, feat_strides, num_anchors):
-        """
-        Estimate maximum possible number of proposals returned by network
-
-        :param input_shape: maximum input shape of model (i.e (1, 3, 640, 640))
-        :param feat_strides: model feature strides (i.e. [8, 16, 32])
-        :param num_anchors: model number of anchors (i.e 2)
-        :return:
-        """
-
-        ln = 0
-        pixels = input_shape[2] * input_shape[3]
-        for e in feat_strides:
-            ln += pixels / (e * e) * num_anchors
-        return int(ln)
-
     # @timing
     @staticmethod
     def _build_anchors(input_height, input_width, strides, num_anchors):
@@ -272,34 +217,40 @@ class SCRFD(AbstractDetector):
     def _preprocess(self, img):
         """
         Normalize image on CPU if backend can't provide CUDA stream,
-        otherwise preprocess image on GPU using CuPy
+        otherwise preprocess image on GPU using CuPy. Images are passed as is
+        if model has preprocessing folded into graph.
 
         :param img: Raw image as np.ndarray with HWC shape
-        :return: Preprocessed image or None if image was processed on device
+        :return: Preprocessed image or None if image was processed on device, and inference shape
         """
 
         blob = None
         if self.stream:
-            self.infer_shape = _normalize_on_device(
+            infer_shape = _normalize_on_device(
                 img, self.stream, self.input_ptr)
+        elif self.raw_input:
+            blob = np.ascontiguousarray(img)
+            infer_shape = (img.shape[0], img.shape[3], img.shape[1], img.shape[2])
         else:
             input_size = tuple(img[0].shape[0:2][::-1])
             blob = cv2.dnn.blobFromImages(
                 img, 1.0 / 128, input_size, (127.5, 127.5, 127.5), swapRB=True)
-        return blob
+            infer_shape = blob.shape
+        return blob, infer_shape
 
-    def _forward(self, blob):
+    def _forward(self, blob, infer_shape):
         """
         Send input data to inference backend.
 
-        :param blob: Preprocessed image of shape NCHW or None
+        :param blob: Preprocessed image of shape NCHW, raw NHWC images or None
+        :param infer_shape: Shape of preprocessed input
         :return: network outputs
         """
 
         t0 = time.time()
         if self.stream:
             net_outs = self.session.run(
-                from_device=True, infer_shape=self.infer_shape)
+                from_device=True, infer_shape=infer_shape)
         else:
             net_outs = self.session.run(blob)
         t1 = time.time()
@@ -307,7 +258,7 @@ class SCRFD(AbstractDetector):
         return net_outs
 
     # @timing
-    def _postprocess(self, net_outs, input_height, input_width, threshold):
+    def _postprocess(self, net_outs, input_height, input_width, threshold, batch_size):
         """
         Precompute anchor points for provided image size and process network outputs
 
@@ -315,7 +266,8 @@ class SCRFD(AbstractDetector):
         :param input_height: Input image height
         :param input_width: Input image width
         :param threshold: Confidence threshold
-        :return: filtered bboxes, keypoints and scores
+        :param batch_size: Number of images in batch
+        :return: filtered bboxes, keypoints and scores of all images, and number of proposals for each image
         """
 
         key = (input_height, input_width)
@@ -324,41 +276,44 @@ class SCRFD(AbstractDetector):
             self.center_cache[key] = self._build_anchors(input_height, input_width, self._feat_stride_fpn,
                                                          self._num_anchors)
         anchor_centers = self.center_cache[key]
-        bboxes, kpss, scores = self._process_strides(net_outs, threshold, anchor_centers)
-        return bboxes, kpss, scores
+        return self._process_strides(net_outs, threshold, anchor_centers, batch_size)
 
-    def _process_strides(self, net_outs, threshold, anchor_centers):
+    def _process_strides(self, net_outs, threshold, anchor_centers, batch_size):
         """
-        Process network outputs by strides and return results proposals filtered by threshold
+        Process network outputs by strides and return results proposals filtered by threshold.
+        Scores of the whole batch are filtered at once and only survivors are decoded.
 
         :param net_outs: Network outputs
         :param threshold: Confidence threshold
         :param anchor_centers: Precomputed anchor centers for all strides
-        :return: filtered bboxes, keypoints and scores
+        :param batch_size: Number of images in batch
+        :return: filtered bboxes, keypoints and scores of all images grouped by image,
+                 and number of proposals for each image
         """
 
-        batch_size = self.infer_shape[0]
-        bboxes_by_img = []
-        kpss_by_img = []
-        scores_by_img = []
-
-        for n_img in range(batch_size):
-            offset = 0
-            for idx, stride in enumerate(self._feat_stride_fpn):
-                score_blob = net_outs[idx][n_img]
-                bbox_blob = net_outs[idx + self.fmc][n_img]
-                kpss_blob = net_outs[idx + self.fmc * 2][n_img]
-                stride_anchors = anchor_centers[idx]
-                self.score_list, self.bbox_list, self.kpss_list, total = generate_proposals(score_blob, bbox_blob,
-                                                                                            kpss_blob, stride,
-                                                                                            stride_anchors, threshold,
-                                                                                            self.score_list,
-                                                                                            self.bbox_list,
-                                                                                            self.kpss_list, offset)
-                offset = total
-
-            bboxes_by_img.append(np.copy(self.bbox_list[:offset]))
-            kpss_by_img.append(np.copy(self.kpss_list[:offset]))
-            scores_by_img.append(np.copy(self.score_list[:offset]))
-
-        return bboxes_by_img, kpss_by_img, scores_by_img
+        strides = []
+        counts = np.zeros(batch_size, dtype=np.int64)
+        for idx, stride in enumerate(self._feat_stride_fpn):
+            score_blob = net_outs[idx].reshape(-1)
+            # Flat indices over (N, anchors) are much cheaper to obtain than 2D nonzero
+            flat_idx = np.flatnonzero(score_blob > threshold)
+            if flat_idx.shape[0] == 0:
+                continue
+            counts += np.bincount(flat_idx // anchor_centers[idx].shape[0], minlength=batch_size)
+            strides.append((idx, stride, score_blob, flat_idx))
+
+        total = int(counts.sum())
+        score_list = np.empty((total, 1), dtype=np.float32)
+        bbox_list = np.empty((total, 4), dtype=np.float32)
+        kpss_list = np.empty((total, 10), dtype=np.float32)
+
+        # Proposals of each image occupy contiguous region of outputs, ordered by stride
+        starts = np.cumsum(counts) - counts
+        cursor = starts.copy()
+        for idx, stride, score_blob, flat_idx in strides:
+            decode_proposals(flat_idx, score_blob,
+                             net_outs[idx + self.fmc].reshape(-1, 4),
+                             net_outs[idx + self.fmc * 2].reshape(-1, 10),
+                             anchor_centers[idx], stride, cursor, score_list, bbox_list, kpss_list)
+
+        return bbox_list, kpss_list, score_list, counts
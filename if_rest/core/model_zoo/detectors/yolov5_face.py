@@ -5,7 +5,7 @@ import numpy as np
 from numba import njit
 
 from if_rest.core.model_zoo.detectors.abstract import AbstractDetector
-from if_rest.core.model_zoo.detectors.common.nms import nms
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractDetectorInfer
 from if_rest.logger import logger
 
@@ -26,19 +26,31 @@ def xywh2xyxy(x):
     return x
 
 
-@njit(cache=True, fastmath=True)
-def _filter(dets, threshold, nms_threshold):
-    order = np.where(dets[:, 4] >= threshold)[0]
-    dets = dets[order, :]
-    pre_det = dets[:, 0:5]
+def _filter(dets, threshold, nms_threshold, min_size=None, limit=0):
+    """
+    Filter network outputs of whole batch by threshold and NMS
+
+    :param dets: Network outputs of shape (N, proposals, 16)
+    :param threshold: Confidence threshold
+    :param nms_threshold: Threshold for NMS IoU
+    :param min_size: Minimum face width, narrower proposals are dropped before NMS
+    :param limit: Maximum number of largest faces per image, 0 for unlimited
+    :return: Lists of face bboxes with scores and key points for each image
+    """
+    batch_size, num_proposals = dets.shape[0], dets.shape[1]
+    flat_idx = np.flatnonzero(dets[:, :, 4] >= threshold)
+    counts = np.bincount(flat_idx // num_proposals, minlength=batch_size)
+    dets = dets.reshape((-1, dets.shape[2]))[flat_idx]
+    pre_det = xywh2xyxy(np.ascontiguousarray(dets[:, 0:5]))
     lmks = dets[:, 5:15]
-    pre_det = xywh2xyxy(pre_det)
-    keep = nms(pre_det, thresh=nms_threshold)
-    keep = np.asarray(keep)
+
+    keep, kept_counts = filter_faces(pre_det, counts, thresh=nms_threshold, min_size=min_size, limit=limit)
     det_out = pre_det[keep, :]
     lmks = lmks[keep, :]
     lmks = lmks.reshape((lmks.shape[0], -1, 2))
-    return det_out, lmks
+
+    splits = np.cumsum(kept_counts)[:-1]
+    return np.split(det_out, splits), np.split(lmks, splits)
 
 
 def _normalize_on_device(input, stream, out):
@@ -70,6 +82,7 @@ class YoloV5(AbstractDetector):
         self.out_shapes = None
         self.stream = None
         self.input_ptr = None
+        self.raw_input = False
 
     def prepare(self, nms_threshold: float = 0.4, **kwargs):
         """
@@ -83,7 +96,8 @@ class YoloV5(AbstractDetector):
         self.session.prepare()
         self.out_shapes = self.session.out_shapes
         self.input_shape = self.session.input_shape
-        self.infer_shape = self.input_shape
+        # Backend model with folded preprocessing takes raw images
+        self.raw_input = getattr(self.session, 'raw_input', False)
 
         # Check if exec backend provides CUDA stream
         try:
@@ -92,12 +106,14 @@ class YoloV5(AbstractDetector):
         except BaseException:
             pass
 
-    def detect(self, imgs, threshold=0.5):
+    def detect(self, imgs, threshold=0.5, min_size=None, limit: int = 0):
         """
         Run detection pipeline for provided image
 
         :param img: Raw image as nd.ndarray with HWC shape
         :param threshold: Confidence threshold
+        :param min_size: Minimum face width in input pixels, single value or one per image
+        :param limit: Maximum number of largest faces per image, 0 for unlimited
         :return: Face bboxes with scores [t,l,b,r,score], and key points
         """
 
@@ -109,68 +125,71 @@ class YoloV5(AbstractDetector):
         elif len(imgs.shape) == 3:
             imgs = np.expand_dims(imgs, 0)
 
-        blob = self._preprocess(imgs)
-        net_outs = self._forward(blob)
+        blob, infer_shape = self._preprocess(imgs)
+        net_outs = self._forward(blob, infer_shape)
 
-        dets_list, kpss_list = self._postprocess(net_outs, threshold)
+        dets_list, kpss_list = self._postprocess(net_outs, infer_shape[0], threshold, min_size=min_size,
+                                                 limit=limit)
 
         return dets_list, kpss_list
 
     def _preprocess(self, img):
         """
         Normalize image on CPU if backend can't provide CUDA stream,
-        otherwise preprocess image on GPU using CuPy
+        otherwise preprocess image on GPU using CuPy. Images are passed as is
+        if model has preprocessing folded into graph.
 
         :param img: Raw image as np.ndarray with HWC shape
-        :return: Preprocessed image or None if image was processed on device
+        :return: Preprocessed image or None if image was processed on device, and inference shape
         """
 
         blob = None
         if self.stream:
-            self.infer_shape = _normalize_on_device(
+            infer_shape = _normalize_on_device(
                 img, self.stream, self.input_ptr)
+        elif self.raw_input:
+            blob = np.ascontiguousarray(img)
+            infer_shape = (img.shape[0], img.shape[3], img.shape[1], img.shape[2])
         else:
             input_size = tuple(img[0].shape[0:2][::-1])
             blob = cv2.dnn.blobFromImages(
                 img, 1.0 / 255., input_size, 0., swapRB=True
             )
-        return blob
+            infer_shape = blob.shape
+        return blob, infer_shape
 
-    def _forward(self, blob):
+    def _forward(self, blob, infer_shape):
         """
         Send input data to inference backend.
 
-        :param blob: Preprocessed image of shape NCHW or None
+        :param blob: Preprocessed image of shape NCHW, raw NHWC images or None
+        :param infer_shape: Shape of preprocessed input
         :return: network outputs
         """
 
         t0 = time.time()
         if self.stream:
             net_outs = self.session.run(
-                from_device=True, infer_shape=self.infer_shape)
+                from_device=True, infer_shape=infer_shape)
         else:
             net_outs = self.session.run(blob)
         t1 = time.time()
         logger.debug(f'Inference cost: {(t1 - t0) * 1000:.3f} ms.')
         return net_outs
 
-    def _postprocess(self, net_outs, threshold=0.6):
+    def _postprocess(self, net_outs, batch_size, threshold=0.6, min_size=None, limit=0):
         """
         Process network outputs
 
         :param net_outs: Network outputs
+        :param batch_size: Number of images in batch
         :param threshold: Confidence threshold
+        :param min_size: Minimum face width
+        :param limit: Maximum number of largest faces per image
         :return: filtered bboxes, keypoints and scores
         """
 
-        batch_size = self.infer_shape[0]
-        dets_list = []
-        kpss_list = []
-
-        for i in range(batch_size):
-            dets = net_outs[0][i]
-            det_out, lmks = _filter(dets, threshold, self.nms_threshold)
-            dets_list.append(det_out)
-            kpss_list.append(lmks)
+        dets = net_outs[0].reshape((batch_size, -1, net_outs[0].shape[-1]))
+        dets_list, kpss_list = _filter(dets, threshold, self.nms_threshold, min_size=min_size, limit=limit)
 
         return dets_list, kpss_list
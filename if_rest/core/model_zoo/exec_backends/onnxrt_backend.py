@@ -1,38 +1,141 @@
+import os
+
 import cv2
 import numpy as np
 import onnxruntime
 
+from if_rest.core.converters.merge_heads import merge_heads
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractArcFace, AbstractFaceGenderAge, \
     AbstractMaskDetection, AbstractDetectorInfer
+from if_rest.core.utils.blob import as_batch, to_blob
 from if_rest.logger import logger
 
+graph_optimization_levels = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+
+execution_modes = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def _option(values: dict, name: str, value: str):
+    if value not in values:
+        raise ValueError(f"Invalid ONNX Runtime {name} '{value}', allowed values: {', '.join(values)}")
+    return values[value]
+
+
+def _session_options(ort_options: dict, graph_optimization: str = None):
+    sess_options = onnxruntime.SessionOptions()
+    sess_options.intra_op_num_threads = ort_options.get('intra_op_threads', 0)
+    sess_options.inter_op_num_threads = ort_options.get('inter_op_threads', 0)
+    sess_options.execution_mode = _option(execution_modes, 'execution_mode',
+                                          ort_options.get('execution_mode', 'sequential'))
+    sess_options.graph_optimization_level = _option(graph_optimization_levels, 'graph_optimization',
+                                                    graph_optimization or ort_options.get('graph_optimization', 'all'))
+    sess_options.enable_cpu_mem_arena = ort_options.get('enable_mem_arena', True)
+    return sess_options
+
+
+def get_optimized_model(model_path: str, ort_options: dict, providers: list):
+    """
+    Returns path to ORT-optimized copy of the model stored next to it, optimizing and saving it on first call.
+
+    Layout optimizations of `all` level depend on the host CPU, so they are not saved and are applied
+    on session creation instead.
+
+    Args:
+        model_path (str): Path to ONNX model.
+        ort_options (dict): Session options.
+        providers (list): Execution providers used for the session.
+
+    Returns:
+        str: Path to optimized model, or original path if it can't be optimized.
+    """
+    level = ort_options.get('graph_optimization', 'all')
+    offline_level = 'extended' if level == 'all' else level
+    if offline_level == 'disable':
+        return model_path
+
+    providers_tag = '-'.join(e.replace('ExecutionProvider', '').lower() for e in providers)
+    optimized_path = f'{os.path.splitext(model_path)[0]}.ort{onnxruntime.__version__}_{offline_level}_{providers_tag}.onnx'
+    if os.path.exists(optimized_path):
+        return optimized_path
+
+    tmp_path = f'{optimized_path}.{os.getpid()}.tmp'
+    try:
+        sess_options = _session_options(ort_options, offline_level)
+        sess_options.optimized_model_filepath = tmp_path
+        onnxruntime.InferenceSession(model_path, sess_options=sess_options, providers=providers)
+        os.replace(tmp_path, optimized_path)
+    except Exception as e:
+        logger.warning(f'Failed saving optimized ONNX model to `{optimized_path}`: {e}')
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return model_path
+    logger.info(f'Saved optimized ONNX model: {optimized_path}')
+    return optimized_path
+
+
+def create_session(model, ort_options: dict = None):
+    """
+    Creates ONNX Runtime inference session with provided session options.
+
+    Args:
+        model (Union[str, bytes]): Path to ONNX model or serialized model.
+        ort_options (dict): Session options: `intra_op_threads`, `inter_op_threads`, `execution_mode`,
+                            `graph_optimization`, `enable_mem_arena`, `providers` and `model_cache`.
+
+    Returns:
+        onnxruntime.InferenceSession: Inference session.
+    """
+    if ort_options is None:
+        ort_options = {}
+
+    available = onnxruntime.get_available_providers()
+    providers = [e for e in ort_options.get('providers') or [] if e in available]
+    for e in set(ort_options.get('providers') or []) - set(providers):
+        logger.warning(f"Execution provider '{e}' is not available, skipping.")
+    if not providers:
+        providers = ['CPUExecutionProvider']
+
+    if ort_options.get('model_cache') and isinstance(model, str):
+        model = get_optimized_model(model, ort_options, providers)
+
+    logger.debug(f'Creating ONNX Runtime session with options: {ort_options}')
+    return onnxruntime.InferenceSession(model, sess_options=_session_options(ort_options), providers=providers)
+
 
 class Arcface(AbstractArcFace):
     def __init__(self, rec_name='/models/onnx/arcface_r100_v1/arcface_r100_v1.onnx',
                  input_mean: float = 0.,
                  input_std: float = 1.,
                  swapRB=True,
+                 ort_options: dict = None,
                  **kwargs):
-        self.rec_model = onnxruntime.InferenceSession(rec_name)
+        self.model_path = rec_name
+        self.rec_model = create_session(rec_name, ort_options)
         self.input_mean = input_mean
         self.input_std = input_std
         self.swapRB = swapRB
+        self.preprocessing = dict(mean=input_mean, std=input_std, swap_rb=swapRB, nchw=True)
         self.outputs = [e.name for e in self.rec_model.get_outputs()]
+        # Model with folded preprocessing takes uint8 crops as is
+        self.raw_input = self.rec_model.get_inputs()[0].type == 'tensor(uint8)'
 
     # warmup
     def prepare(self, **kwargs):
         logger.info("Warming up ArcFace ONNX Runtime engine...")
-        self.rec_model.run(self.outputs, {self.rec_model.get_inputs()[0].name: [np.zeros((3, 112, 112), np.float32)]})
+        warmup = np.zeros((1, 112, 112, 3), np.uint8) if self.raw_input else np.zeros((1, 3, 112, 112), np.float32)
+        self.rec_model.run(self.outputs, {self.rec_model.get_inputs()[0].name: warmup})
 
     def get_embedding(self, face_img):
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-
-        face_img = np.stack(face_img)
-
-        input_size = tuple(face_img[0].shape[0:2][::-1])
-        blob = cv2.dnn.blobFromImages(face_img, 1.0 / self.input_std, input_size,
-                                      (self.input_mean, self.input_mean, self.input_mean), swapRB=self.swapRB)
+        face_img = as_batch(face_img)
+        blob = face_img if self.raw_input else to_blob(face_img, **self.preprocessing)
 
         net_out = self.rec_model.run(self.outputs, {self.rec_model.get_inputs()[0].name: blob})
         return net_out[0]
@@ -40,9 +143,12 @@ class Arcface(AbstractArcFace):
 
 class FaceGenderage(AbstractFaceGenderAge):
 
-    def __init__(self, rec_name='/models/onnx/genderage_v1/genderage_v1.onnx', outputs=None, **kwargs):
-        self.rec_model = onnxruntime.InferenceSession(rec_name)
+    def __init__(self, rec_name='/models/onnx/genderage_v1/genderage_v1.onnx', outputs=None,
+                 ort_options: dict = None, **kwargs):
+        self.model_path = rec_name
+        self.rec_model = create_session(rec_name, ort_options)
         self.input = self.rec_model.get_inputs()[0]
+        self.preprocessing = dict(mean=0., std=1., swap_rb=True, nchw=True)
         if outputs is None:
             outputs = [e.name for e in self.rec_model.get_outputs()]
         self.outputs = outputs
@@ -54,20 +160,18 @@ class FaceGenderage(AbstractFaceGenderAge):
                            {self.rec_model.get_inputs()[0].name: [np.zeros(tuple(self.input.shape[1:]), np.float32)]})
 
     def get(self, face_img):
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-
-        face_img = np.stack(face_img)
-        imgs = face_img.copy()
+        face_img = as_batch(face_img)
+        imgs = face_img
 
         if not face_img[0].shape == (3, 112, 112):
-            input_size = tuple(face_img[0].shape[0:2][::-1])
-            imgs = cv2.dnn.blobFromImages(face_img, 1.0, input_size,
-                                          (0., 0., 0.), swapRB=True)
-
-        _ga = []
+            imgs = to_blob(face_img, **self.preprocessing)
 
         ret = self.rec_model.run(self.outputs, {self.input.name: imgs})[0]
+        return self.postprocess(ret)
+
+    @staticmethod
+    def postprocess(ret):
+        _ga = []
         for e in ret:
             e = np.expand_dims(e, axis=0)
             g = e[:, 0:2].flatten()
@@ -81,9 +185,13 @@ class FaceGenderage(AbstractFaceGenderAge):
 
 class MaskDetection(AbstractMaskDetection):
 
-    def __init__(self, rec_name='/models/onnx/genderage_v1/genderage_v1.onnx', outputs=None, **kwargs):
-        self.rec_model = onnxruntime.InferenceSession(rec_name)
+    def __init__(self, rec_name='/models/onnx/genderage_v1/genderage_v1.onnx', outputs=None,
+                 ort_options: dict = None, **kwargs):
+        self.model_path = rec_name
+        self.rec_model = create_session(rec_name, ort_options)
         self.input = self.rec_model.get_inputs()[0]
+        self.input_size = 112 if self.input.shape[1:3] == [112, 112] else 224
+        self.preprocessing = dict(mean=127.5, std=127.5, swap_rb=False, nchw=False)
         if outputs is None:
             outputs = [e.name for e in self.rec_model.get_outputs()]
         self.outputs = outputs
@@ -95,18 +203,19 @@ class MaskDetection(AbstractMaskDetection):
                            {self.rec_model.get_inputs()[0].name: [np.zeros(tuple(self.input.shape[1:]), np.float32)]})
 
     def get(self, face_img):
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-        if not self.input.shape[1:3] == [112, 112]:
-            for i, img in enumerate(face_img):
-                img = cv2.resize(img, (224, 224))
-                face_img[i] = img
-            face_img = np.stack(face_img)
-
-        face_img = np.multiply(face_img, 1 / 127.5, dtype='float32') - 1.
-        _mask = []
+        # Crops aligned at model input size are used as is, other crops are resized
+        face_img = as_batch(face_img)
+        if face_img.shape[1] != self.input_size:
+            face_img = np.stack([cv2.resize(img, (self.input_size, self.input_size)) for img in face_img])
+
+        face_img = to_blob(face_img, **self.preprocessing)
 
         ret = self.rec_model.run(self.outputs, {self.input.name: face_img})[0]
+        return self.postprocess(ret)
+
+    @staticmethod
+    def postprocess(ret):
+        _mask = []
         for e in ret:
             mask = e[0]
             no_mask = e[1]
@@ -114,12 +223,49 @@ class MaskDetection(AbstractMaskDetection):
         return _mask
 
 
+class MergedHeads:
+
+    def __init__(self, heads: dict, ort_options: dict = None, **kwargs):
+        """
+        Run several face processing heads sharing 112x112 crops as single ONNX Runtime session.
+
+        Args:
+            heads (dict): Loaded heads (`Arcface`, `FaceGenderage`, `MaskDetection`) by name.
+            ort_options (dict): ONNX Runtime session options.
+        """
+        self.heads = heads
+        merged = merge_heads([dict(name=name, model=head.model_path, **head.preprocessing)
+                              for name, head in heads.items()])
+        self.rec_model = create_session(merged.SerializeToString(), ort_options)
+        self.input = self.rec_model.get_inputs()[0]
+        # First output of each head, in heads order
+        self.outputs = [f'{name}/{head.rec_model.get_outputs()[0].name}' for name, head in heads.items()]
+
+    # warmup
+    def prepare(self, **kwargs):
+        logger.info("Warming up merged heads ONNX Runtime engine...")
+        self.rec_model.run(self.outputs, {self.input.name: np.zeros((1, 112, 112, 3), np.uint8)})
+
+    def run(self, face_img) -> dict:
+        """
+        Run all heads on uint8 BGR crops batch in one call.
+
+        Args:
+            face_img (np.ndarray): Crops batch of (N, 112, 112, 3) shape.
+
+        Returns:
+            dict: Raw output of each head by head name.
+        """
+        ret = self.rec_model.run(self.outputs, {self.input.name: as_batch(face_img)})
+        return dict(zip(self.heads, ret))
+
+
 class DetectorInfer(AbstractDetectorInfer):
 
     def __init__(self, model='/models/onnx/centerface/centerface.onnx',
-                 output_order=None, **kwargs):
+                 output_order=None, ort_options: dict = None, **kwargs):
 
-        self.rec_model = onnxruntime.InferenceSession(model)
+        self.rec_model = create_session(model, ort_options)
         logger.info('Detector started')
         self.input = self.rec_model.get_inputs()[0]
         self.input_dtype = self.input.type
@@ -131,6 +277,10 @@ class DetectorInfer(AbstractDetectorInfer):
         self.output_order = output_order
         self.out_shapes = None
         self.input_shape = tuple(self.input.shape)
+        # Model with folded preprocessing takes uint8 NHWC images, its shape is reported in NCHW form
+        self.raw_input = self.input_dtype == np.uint8 and self.input_shape[-1] == 3
+        if self.raw_input:
+            self.input_shape = (self.input_shape[0], 3) + self.input_shape[1:3]
 
     # warmup
     def prepare(self, **kwargs):
@@ -138,9 +288,11 @@ class DetectorInfer(AbstractDetectorInfer):
         if self.output_order is None:
             self.output_order = [e.name for e in self.rec_model.get_outputs()]
         self.out_shapes = [e.shape for e in self.rec_model.get_outputs()]
+        # Dynamic height and width are warmed up with 640x640 input
+        warmup_shape = tuple(e if isinstance(e, int) else 640 for e in self.input.shape[1:])
         self.rec_model.run(self.output_order,
                            {self.rec_model.get_inputs()[0].name: [
-                               np.zeros(tuple(self.input.shape[1:]), self.input_dtype)]})
+                               np.zeros(warmup_shape, self.input_dtype)]})
 
     def run(self, input):
         net_out = self.rec_model.run(self.output_order, {self.input.name: input})
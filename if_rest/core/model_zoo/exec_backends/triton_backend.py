@@ -1,7 +1,6 @@
 import os
 import sys
 
-import cv2
 import numpy as np
 # from tritonclient.grpc import service_pb2, service_pb2_grpc
 import tritonclient.grpc as grpcclient
@@ -12,6 +11,7 @@ from tritonclient.utils import InferenceServerException
 from tritonclient.utils import triton_to_np_dtype
 
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractArcFace, AbstractDetectorInfer
+from if_rest.core.utils.blob import as_batch, to_blob
 from if_rest.logger import logger
 
 # import tritonclient.grpc.model_config_pb2 as mc
@@ -134,14 +134,8 @@ class Arcface(AbstractArcFace):
             self.out_bytesize)
 
     def get_embedding(self, face_img):
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-
-        face_img = np.stack(face_img)
-
-        input_size = tuple(face_img[0].shape[0:2][::-1])
-        blob = cv2.dnn.blobFromImages(face_img, 1.0 / self.input_std, input_size,
-                                      (self.input_mean, self.input_mean, self.input_mean), swapRB=True)
+        face_img = as_batch(face_img)
+        blob = to_blob(face_img, self.input_mean, self.input_std, swap_rb=True)
 
         blob = blob.astype(triton_to_np_dtype(self.dtype))
 
@@ -8,6 +8,7 @@ import numpy as np
 from if_rest.core.model_zoo.exec_backends.abstract import AbstractArcFace, AbstractFaceGenderAge, \
     AbstractMaskDetection, AbstractDetectorInfer
 from if_rest.core.model_zoo.exec_backends.trt_loader import TrtModel
+from if_rest.core.utils.blob import as_batch
 from if_rest.logger import logger
 
 
@@ -125,9 +126,7 @@ class Arcface(AbstractArcFace):
         Returns:
             np.ndarray: The embedding vector for the given face image(s).
         """
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-        face_img = np.stack(face_img)
+        face_img = as_batch(face_img)
 
         t0 = time.perf_counter()
         infer_shape = _normalize_on_device(face_img, self.stream, self.input_ptr, mean=self.input_mean,
@@ -185,11 +184,8 @@ class FaceGenderage(AbstractFaceGenderAge):
         Returns:
             list of tuples: A list containing tuples of gender and age for each input face image.
         """
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-
-        face_img = np.stack(face_img)
-        imgs = face_img.copy()
+        face_img = as_batch(face_img)
+        imgs = face_img
 
         if not face_img[0].shape == (3, 112, 112):
             imgs = imgs[..., ::-1]
@@ -218,6 +214,7 @@ class MaskDetection(AbstractMaskDetection):
     Attributes:
         rec_model (TrtModel): The TensorRT model instance.
         input_shape (tuple): The shape of the expected input images.
+        input_size (int): Side of square input crops.
 
     Methods:
         prepare(): Warm up the mask detection TensorRT engine by running a dummy inference.
@@ -227,6 +224,7 @@ class MaskDetection(AbstractMaskDetection):
     def __init__(self, rec_name: str = '/models/trt-engines/mask_detection/mask_detection.plan', **kwargs):
         self.rec_model = TrtModel(rec_name)
         self.input_shape = None
+        self.input_size = 112
 
     # warmup
     def prepare(self, **kwargs):
@@ -242,6 +240,7 @@ class MaskDetection(AbstractMaskDetection):
 
         if self.input_shape[0] == -1:
             self.input_shape = (1,) + self.input_shape[1:]
+        self.input_size = 112 if self.input_shape[1:3] == (112, 112) else 224
 
         self.rec_model.run(np.zeros(self.input_shape, np.float32))
         logger.info(
@@ -257,15 +256,10 @@ class MaskDetection(AbstractMaskDetection):
         Returns:
             list of tuples: A list containing tuples of mask and no-mask probabilities for each input face image.
         """
-        if not isinstance(face_img, list):
-            face_img = [face_img]
-
-        if not self.input_shape[1:3] == (112, 112):
-            for i, img in enumerate(face_img):
-                img = cv2.resize(img, (224, 224))
-                face_img[i] = img
-
-        face_img = np.stack(face_img)
+        # Crops aligned at model input size are used as is, other crops are resized
+        face_img = as_batch(face_img)
+        if face_img.shape[1] != self.input_size:
+            face_img = np.stack([cv2.resize(img, (self.input_size, self.input_size)) for img in face_img])
 
         _mask = []
         infer_shape = _normalize_on_device_masks(face_img, self.stream, self.input_ptr)
@@ -8,12 +8,12 @@ from tenacity import retry, wait_exponential, stop_after_attempt, before_sleep_l
 
 from if_rest.core.configs import Configs, config
 from if_rest.core.converters.remove_initializer_from_input import remove_initializer_from_input
-from if_rest.core.converters.reshape_onnx import reshape
+from if_rest.core.converters.reshape_onnx import reshape, fold_preprocessing, PREPROCESSING
 from if_rest.core.model_zoo.exec_backends import onnxrt_backend as onnx_backend
 from if_rest.core.model_zoo.face_detectors import *
 from if_rest.core.model_zoo.face_processors import *
 from if_rest.core.utils.download import download
-from if_rest.core.utils.download_google import download_from_gdrive, check_hash
+from if_rest.core.utils.download_google import download_from_gdrive, check_hash, get_hash
 from if_rest.core.utils.helpers import prepare_folders
 from if_rest.logger import logger
 
@@ -96,7 +96,7 @@ def download_onnx(src, dst, dl_type='google', md5=None):
             download_from_gdrive(src, dst)
         else:
             download(src, dst)
-        hashes_match = check_hash(dst, md5, algo='md5')
+        hashes_match = check_hash(dst, md5, algo='md5', use_cache=True)
         if hashes_match:
             return dst
         else:
@@ -111,7 +111,10 @@ def prepare_backend(model_name, backend_name, im_size: List[int] = None,
                     max_batch_size: int = 1,
                     force_fp16: bool = False,
                     download_model: bool = True,
-                    config: Configs = config):
+                    config: Configs = config,
+                    onnx_cache: bool = False,
+                    dynamic_shape: bool = False,
+                    fold_input: bool = False):
     """
     Prepares the backend for a model.
 
@@ -123,6 +126,11 @@ def prepare_backend(model_name, backend_name, im_size: List[int] = None,
         force_fp16 (bool): Whether to force use of FP16 precision.
         download_model (bool): Whether to download the model if it doesn't exist.
         config (Configs): The configuration object.
+        onnx_cache (bool): Store reshaped ONNX model in `onnx-cache` dir and reuse it on next start,
+                           used by `onnx` backend only.
+        dynamic_shape (bool): Keep input height and width dynamic, used by `onnx` backend only.
+        fold_input (bool): Fold input normalization into model graph, so it takes raw uint8 images,
+                           used by `onnx` backend only.
 
     Returns:
         str: The path to the prepared backend model.
@@ -144,7 +152,7 @@ def prepare_backend(model_name, backend_name, im_size: List[int] = None,
 
     if onnx_exists and onnx_hash:
         logger.info(f"Checking model hash...")
-        hashes_match = check_hash(onnx_path, onnx_hash, algo='md5')
+        hashes_match = check_hash(onnx_path, onnx_hash, algo='md5', use_cache=True)
         if not hashes_match:
             logger.warning('ONNX model hash mismatch, trying to download it again. ')
             onnx_exists = False
@@ -175,11 +183,59 @@ def prepare_backend(model_name, backend_name, im_size: List[int] = None,
         return model_name
 
     if backend_name == 'onnx':
+        preprocessing = None
+        if fold_input:
+            function = config.models[model_name].get('function')
+            if function not in PREPROCESSING:
+                logger.warning(f"Input preprocessing of '{model_name}' model with '{function}' function is unknown, "
+                               f"keeping it unfolded.")
+            preprocessing = PREPROCESSING.get(function)
+        onnx_batch_size = 1
+        if max_batch_size != 1:
+            onnx_batch_size = -1
+
+        cache_path = None
+        if onnx_cache:
+            model_hash = onnx_hash or get_hash(onnx_path, algo='md5', use_cache=True)
+            batch_mode = 'dynamic' if onnx_batch_size == -1 else 'batch1'
+            input_shape = f'{shape[3]}x{shape[2]}' if shape else 'orig'
+            if dynamic_shape and reshape_allowed is True:
+                input_shape = 'dynamic'
+            input_mode = '_u8' if preprocessing is not None else ''
+            cache_dir = os.path.join(config.onnx_cache_dir, model_name)
+            cache_path = os.path.join(cache_dir, f'{model_name}_{model_hash[:12]}_{input_shape}_{batch_mode}'
+                                                 f'{input_mode}.onnx')
+            if os.path.exists(cache_path):
+                logger.info(f'Using cached ONNX model: {cache_path}')
+                return cache_path
+
         model = onnx.load(onnx_path)
-        if reshape_allowed is True:
+        if reshape_allowed is True and dynamic_shape:
+            logger.info(f'Reshaping ONNX inputs to dynamic height and width')
+            model = reshape(model, n=onnx_batch_size, h=-1, w=-1)
+        elif reshape_allowed is True:
             logger.info(f'Reshaping ONNX inputs to: {shape}')
-            model = reshape(model, h=im_size[1], w=im_size[0])
-        return model.SerializeToString()
+            model = reshape(model, n=onnx_batch_size, h=im_size[1], w=im_size[0])
+        elif max_batch_size != 1:
+            logger.info(f'Reshaping ONNX inputs to dynamic batch size')
+            model = reshape(model, n=onnx_batch_size, h=shape[2], w=shape[3])
+        if preprocessing is not None:
+            logger.info(f'Folding input preprocessing into ONNX graph: {preprocessing}')
+            model = fold_preprocessing(model, **preprocessing)
+        serialized = model.SerializeToString()
+
+        if cache_path:
+            tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+            try:
+                prepare_folders([cache_dir])
+                with open(tmp_path, mode='wb') as fl:
+                    fl.write(serialized)
+                os.replace(tmp_path, cache_path)
+                logger.info(f'Saved ONNX model to cache: {cache_path}')
+                return cache_path
+            except OSError as e:
+                logger.warning(f'Failed saving ONNX model to cache: {e}')
+        return serialized
 
     if backend_name == "trt":
         has_fp16 = check_fp16()
@@ -222,7 +278,8 @@ def prepare_backend(model_name, backend_name, im_size: List[int] = None,
 
 def get_model(model_name: str, backend_name: str, im_size: List[int] = None, max_batch_size: int = 1,
               force_fp16: bool = False,
-              root_dir: str = "/models", download_model: bool = True, triton_uri=None, **kwargs):
+              root_dir: str = "/models", download_model: bool = True, triton_uri=None, ort_options: dict = None,
+              dynamic_shape: bool = False, **kwargs):
     """
     Returns an inference backend instance with a loaded model.
 
@@ -235,6 +292,8 @@ def get_model(model_name: str, backend_name: str, im_size: List[int] = None, max
         root_dir (str): The root directory where models will be stored.
         download_model (bool): Whether to download the model if it doesn't exist.
         triton_uri (str): The URI of the Triton server.
+        ort_options (dict): ONNX Runtime session options, used by `onnx` backend only.
+        dynamic_shape (bool): Keep input height and width dynamic, used by `onnx` backend only.
 
     Returns:
         object: An inference backend instance with a loaded model.
@@ -261,7 +320,10 @@ def get_model(model_name: str, backend_name: str, im_size: List[int] = None, max
 
     model_path = prepare_backend(model_name, backend_name, im_size=im_size, max_batch_size=max_batch_size,
                                  config=config, force_fp16=force_fp16,
-                                 download_model=download_model)
+                                 download_model=download_model,
+                                 onnx_cache=bool(ort_options and ort_options.get('model_cache')),
+                                 dynamic_shape=dynamic_shape,
+                                 fold_input=bool(ort_options and ort_options.get('fold_preprocessing')))
 
     outputs = config.get_outputs_order(model_name)
     if not outputs and backend_name == 'trt':
@@ -270,5 +332,6 @@ def get_model(model_name: str, backend_name: str, im_size: List[int] = None, max
         outputs = read_outputs_order(trt_dir)
 
     func = func_map[config.models[model_name].get('function')]
-    model = func(model_path=model_path, backend=backend, outputs=outputs, triton_uri=triton_uri)
+    model = func(model_path=model_path, backend=backend, outputs=outputs, triton_uri=triton_uri,
+                 ort_options=ort_options)
     return model
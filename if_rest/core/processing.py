@@ -16,6 +16,7 @@ import numpy as np
 from fastapi import Depends
 
 from if_rest.core.utils.image_provider import get_images
+from if_rest.core.utils.overload import OverloadController
 from if_rest.logger import logger
 from if_rest.schemas import Images
 from if_rest.settings import Settings
@@ -37,9 +38,32 @@ class Processing:
                  backend_name: str = 'trt',
                  max_rec_batch_size: int = 1,
                  max_det_batch_size: int = 1,
+                 rec_dynamic_batching: bool = False,
+                 rec_batch_wait_ms: float = 5.,
+                 det_dynamic_batching: bool = False,
+                 det_batch_wait_ms: float = 5.,
+                 det_resolutions: List[int] = None,
+                 det_min_face_px: int = 16,
+                 det_target_face_size: int = 0,
+                 det_dynamic_shape: bool = False,
+                 det_tile_overlap: float = 0.2,
+                 det_max_tiles: int = 16,
+                 det_refine_threshold: float = 0.3,
+                 det_refine_max_rois: int = 8,
+                 det_cascade_name: str = None,
+                 det_cascade_accept: float = 0.8,
+                 det_cascade_borderline: float = 0.3,
+                 overload_p95_ms: float = 0.,
+                 overload_max_inflight: int = 0,
+                 overload_det_resolution: int = 0,
+                 overload_max_faces: int = 0,
+                 compute_threads: int = 0,
+                 concurrent_heads: bool = False,
+                 merge_heads: bool = False,
                  force_fp16: bool = False,
                  triton_uri=None,
                  root_dir: str = '/models',
+                 ort_options: dict = None,
                  **kwargs):
         """
         Processing class for detecting faces, extracting embeddings and drawing faces from images.
@@ -53,9 +77,46 @@ class Processing:
             backend_name (str): The backend name to use. Defaults to 'trt'.
             max_rec_batch_size (int): The maximum batch size for recognition. Defaults to 1.
             max_det_batch_size (int): The maximum batch size for detection. Defaults to 1.
+            rec_dynamic_batching (bool): Whether to batch recognition inputs across concurrent requests.
+                                         Defaults to False.
+            rec_batch_wait_ms (float): Maximum time to wait for recognition batch to fill up. Defaults to 5.
+            det_dynamic_batching (bool): Whether to batch detector inputs across concurrent requests.
+                                         Defaults to False.
+            det_batch_wait_ms (float): Maximum time to wait for detection batch to fill up. Defaults to 5.
+            det_resolutions (List[int]): Square detector input sizes loaded side by side. Defaults to None.
+            det_min_face_px (int): Smallest face size in detector input pixels detected reliably. Defaults to 16.
+            det_target_face_size (int): Default smallest face size in original image pixels used to select
+                                        detector resolution. Defaults to 0.
+            det_dynamic_shape (bool): Run detector with dynamic input shape, resizing images at native aspect
+                                      ratio. Defaults to False.
+            det_tile_overlap (float): Overlap of neighbouring tiles in tiled detection mode. Defaults to 0.2.
+            det_max_tiles (int): Maximum number of tiles per image in tiled detection mode. Defaults to 16.
+            det_refine_threshold (float): Coarse pass threshold in two-pass detection mode. Defaults to 0.3.
+            det_refine_max_rois (int): Maximum number of re-detected regions per image in two-pass detection mode.
+                                       Defaults to 8.
+            det_cascade_name (str): Fast detection model run before main detector, None disables detector
+                                    cascade. Defaults to None.
+            det_cascade_accept (float): Score of confident detection in detector cascade. Defaults to 0.8.
+            det_cascade_borderline (float): Lowest score of borderline detection in detector cascade.
+                                            Defaults to 0.3.
+            overload_p95_ms (float): p95 request latency triggering degraded processing, 0 disables check.
+                                     Defaults to 0.
+            overload_max_inflight (int): Number of concurrent requests triggering degraded processing,
+                                         0 disables check. Defaults to 0.
+            overload_det_resolution (int): Detector resolution under heavy overload, 0 for the smallest
+                                           loaded one. Ignored with single fixed detector input shape.
+                                           Defaults to 0.
+            overload_max_faces (int): Faces per image limit under heavy overload, 0 keeps requested limit.
+                                      Defaults to 0.
+            compute_threads (int): Size of thread pool for detection, alignment and embedding. 0 runs them
+                                   inside event loop. Defaults to 0.
+            concurrent_heads (bool): Run recognition, gender/age and mask heads in parallel. Defaults to False.
+            merge_heads (bool): Run heads consuming 112x112 crops as single ONNX Runtime session.
+                                Defaults to False.
             force_fp16 (bool): Whether to force FP16 mode. Defaults to False.
             triton_uri (str): The URI for Triton server. Defaults to None.
             root_dir (str): The root directory for models. Defaults to '/models'.
+            ort_options (dict): ONNX Runtime session options. Defaults to None.
             dl_client (aiohttp.ClientSession): An asynchronous HTTP client session. Defaults to None.
         """
 
@@ -64,6 +125,27 @@ class Processing:
 
         self.max_rec_batch_size = max_rec_batch_size
         self.max_det_batch_size = max_det_batch_size
+        self.rec_dynamic_batching = rec_dynamic_batching
+        self.rec_batch_wait_ms = rec_batch_wait_ms
+        self.det_dynamic_batching = det_dynamic_batching
+        self.det_batch_wait_ms = det_batch_wait_ms
+        self.det_resolutions = det_resolutions
+        self.det_min_face_px = det_min_face_px
+        self.det_target_face_size = det_target_face_size
+        self.det_dynamic_shape = det_dynamic_shape
+        self.det_tile_overlap = det_tile_overlap
+        self.det_max_tiles = det_max_tiles
+        self.det_refine_threshold = det_refine_threshold
+        self.det_refine_max_rois = det_refine_max_rois
+        self.det_cascade_name = det_cascade_name
+        self.det_cascade_accept = det_cascade_accept
+        self.det_cascade_borderline = det_cascade_borderline
+        self.overload = OverloadController(p95_ms=overload_p95_ms, max_inflight=overload_max_inflight,
+                                           det_resolution=overload_det_resolution or None,
+                                           max_faces=overload_max_faces)
+        self.compute_threads = compute_threads
+        self.concurrent_heads = concurrent_heads
+        self.merge_heads = merge_heads
         self.det_name = det_name
         self.rec_name = rec_name
         self.ga_name = ga_name
@@ -73,6 +155,7 @@ class Processing:
         self.backend_name = backend_name
         self.triton_uri = triton_uri
         self.root_dir = root_dir
+        self.ort_options = ort_options
         self.dl_client = None
         self.model: FaceAnalysis = None
 
@@ -85,11 +168,38 @@ class Processing:
                                   max_size=self.max_size,
                                   max_rec_batch_size=self.max_rec_batch_size,
                                   max_det_batch_size=self.max_det_batch_size,
+                                  rec_dynamic_batching=self.rec_dynamic_batching,
+                                  rec_batch_wait_ms=self.rec_batch_wait_ms,
+                                  det_dynamic_batching=self.det_dynamic_batching,
+                                  det_batch_wait_ms=self.det_batch_wait_ms,
+                                  det_resolutions=self.det_resolutions,
+                                  det_min_face_px=self.det_min_face_px,
+                                  det_target_face_size=self.det_target_face_size,
+                                  det_dynamic_shape=self.det_dynamic_shape,
+                                  det_tile_overlap=self.det_tile_overlap,
+                                  det_max_tiles=self.det_max_tiles,
+                                  det_refine_threshold=self.det_refine_threshold,
+                                  det_refine_max_rois=self.det_refine_max_rois,
+                                  det_cascade_name=self.det_cascade_name,
+                                  det_cascade_accept=self.det_cascade_accept,
+                                  det_cascade_borderline=self.det_cascade_borderline,
+                                  compute_threads=self.compute_threads,
+                                  concurrent_heads=self.concurrent_heads,
+                                  merge_heads=self.merge_heads,
                                   backend_name=self.backend_name,
                                   force_fp16=self.force_fp16,
                                   triton_uri=self.triton_uri,
-                                  root_dir=self.root_dir
+                                  root_dir=self.root_dir,
+                                  ort_options=self.ort_options
                                   )
+        # Detector resolution can be lowered only with several detector sizes or dynamic input shape
+        selectable = len(self.model.det_sizes) > 1 or self.model.det_dynamic_shape
+        if self.overload.det_resolution is None and len(self.model.det_sizes) > 1:
+            self.overload.det_resolution = min(self.model.det_sizes[0])
+        elif self.overload.det_resolution and not selectable:
+            logger.warning('Overload detector resolution is ignored, since single detector input shape is used. '
+                           'Set DET_RESOLUTIONS or DET_DYNAMIC_SHAPE to enable it.')
+            self.overload.det_resolution = None
 
     async def extract(self,
                       images: Images,
@@ -103,6 +213,10 @@ class Processing:
                       extract_ga: bool = True,
                       return_landmarks: bool = False,
                       detect_masks: bool = False,
+                      det_resolution: int = None,
+                      det_tiling: bool = False,
+                      det_refine: bool = False,
+                      degradable: bool = True,
                       verbose_timings=True,
                       b64_decode=True,
                       img_req_headers=None,
@@ -122,10 +236,16 @@ class Processing:
             extract_ga (bool): Whether to extract gender and age. Defaults to True.
             return_landmarks (bool): Whether to return landmarks. Defaults to False.
             detect_masks (bool): Whether to detect masks. Defaults to False.
+            det_resolution (int): Pin detector resolution instead of selecting it per image. Defaults to None.
+            det_tiling (bool): Detect faces of large images in overlapping tiles. Defaults to False.
+            det_refine (bool): Re-detect small faces found by coarse pass at higher resolution. Defaults to False.
+            degradable (bool): Let overload controller override request parameters and account request latency.
+                               Disable for callers relying on exact parameters. Defaults to True.
             verbose_timings (bool): Whether to print verbose timings. Defaults to True.
 
         Returns:
             Dict[str, Union[List[Dict], bytes]]: A dictionary containing extracted faces and timing information.
+                With overload controller enabled `degraded` lists request parameters overridden to shed load.
         """
 
         if img_req_headers is None:
@@ -134,6 +254,51 @@ class Processing:
         if not max_size:
             max_size = self.max_size
 
+        if not self.overload.enabled or not degradable:
+            return await self._extract(images, max_size=max_size, threshold=threshold, limit_faces=limit_faces,
+                                       min_face_size=min_face_size, embed_only=embed_only,
+                                       return_face_data=return_face_data, extract_embedding=extract_embedding,
+                                       extract_ga=extract_ga, return_landmarks=return_landmarks,
+                                       detect_masks=detect_masks, det_resolution=det_resolution,
+                                       det_tiling=det_tiling, det_refine=det_refine,
+                                       verbose_timings=verbose_timings, b64_decode=b64_decode,
+                                       img_req_headers=img_req_headers)
+
+        params, degraded = self.overload.degrade(extract_ga=extract_ga, detect_masks=detect_masks,
+                                                 limit_faces=limit_faces, det_resolution=det_resolution)
+        t0 = time.time()
+        self.overload.begin()
+        try:
+            output = await self._extract(images, max_size=max_size, threshold=threshold,
+                                         min_face_size=min_face_size, embed_only=embed_only,
+                                         return_face_data=return_face_data, extract_embedding=extract_embedding,
+                                         return_landmarks=return_landmarks, det_tiling=det_tiling,
+                                         det_refine=det_refine, verbose_timings=verbose_timings,
+                                         b64_decode=b64_decode, img_req_headers=img_req_headers, **params)
+        finally:
+            self.overload.end((time.time() - t0) * 1000)
+        # Let clients know which requested parameters were overridden to shed load
+        output['degraded'] = degraded
+        return output
+
+    async def _extract(self,
+                       images: Images,
+                       max_size: List[int],
+                       threshold: float,
+                       limit_faces: int,
+                       min_face_size: int,
+                       embed_only: bool,
+                       return_face_data: bool,
+                       extract_embedding: bool,
+                       extract_ga: bool,
+                       return_landmarks: bool,
+                       detect_masks: bool,
+                       det_resolution: int,
+                       det_tiling: bool,
+                       det_refine: bool,
+                       verbose_timings: bool,
+                       b64_decode: bool,
+                       img_req_headers: dict):
         t0 = time.time()
 
         tl0 = time.time()
@@ -162,7 +327,11 @@ class Processing:
                                             extract_embedding=extract_embedding,
                                             extract_ga=extract_ga,
                                             return_landmarks=return_landmarks,
-                                            detect_masks=detect_masks
+                                            detect_masks=detect_masks,
+                                            det_resolution=det_resolution,
+                                            det_tiling=det_tiling,
+                                            det_refine=det_refine,
+                                            verbose_timings=verbose_timings
                                             )
             took_embed = time.time() - te0
             took = time.time() - t0
@@ -182,6 +351,9 @@ class Processing:
                    limit_faces=0,
                    min_face_size: int = 0,
                    detect_masks: bool = False,
+                   det_resolution: int = None,
+                   det_tiling: bool = False,
+                   det_refine: bool = False,
                    multipart=False,
                    dl_client: aiohttp.ClientSession = None,
                    **kwargs):
@@ -198,6 +370,9 @@ class Processing:
             limit_faces (int): The maximum number of faces to detect. Defaults to 0.
             min_face_size (int): The minimum size of a face to detect. Defaults to 0.
             detect_masks (bool): Whether to detect masks. Defaults to False.
+            det_resolution (int): Pin detector resolution instead of selecting it per image. Defaults to None.
+            det_tiling (bool): Detect faces of large images in overlapping tiles. Defaults to False.
+            det_refine (bool): Re-detect small faces found by coarse pass at higher resolution. Defaults to False.
             multipart (bool): Whether the input is multipart data. Defaults to False.
             dl_client (aiohttp.ClientSession): An asynchronous HTTP client session. Defaults to None.
 
@@ -219,7 +394,10 @@ class Processing:
                                      extract_ga=False,
                                      limit_faces=limit_faces,
                                      min_face_size=min_face_size,
-                                     detect_masks=detect_masks)
+                                     detect_masks=detect_masks,
+                                     det_resolution=det_resolution,
+                                     det_tiling=det_tiling,
+                                     det_refine=det_refine)
 
         image = np.ascontiguousarray(image)
         image = self.model.draw_faces(image, faces[0],
@@ -231,6 +409,20 @@ class Processing:
         io_buf = io.BytesIO(buffer)
         return io_buf
 
+    def stats(self) -> Dict[str, dict]:
+        """
+        Collects runtime statistics of processing pipeline.
+
+        Returns:
+            Dict[str, dict]: A dictionary containing statistics of pipeline components.
+        """
+        if self.model is None:
+            return {}
+        stats = self.model.stats()
+        if self.overload.enabled:
+            stats['overload'] = self.overload.stats()
+        return stats
+
 
 processing: Processing | None = None
 
@@ -245,10 +437,41 @@ async def get_processing() -> Processing:
                                 max_size=settings.models.max_size,
                                 max_rec_batch_size=settings.models.rec_batch_size,
                                 max_det_batch_size=settings.models.det_batch_size,
+                                rec_dynamic_batching=settings.models.rec_dynamic_batching,
+                                rec_batch_wait_ms=settings.models.rec_batch_wait_ms,
+                                det_dynamic_batching=settings.models.det_dynamic_batching,
+                                det_batch_wait_ms=settings.models.det_batch_wait_ms,
+                                det_resolutions=settings.models.det_resolutions,
+                                det_min_face_px=settings.models.det_min_face_px,
+                                det_target_face_size=settings.models.det_target_face_size,
+                                det_dynamic_shape=settings.models.det_dynamic_shape,
+                                det_tile_overlap=settings.models.det_tile_overlap,
+                                det_max_tiles=settings.models.det_max_tiles,
+                                det_refine_threshold=settings.models.det_refine_threshold,
+                                det_refine_max_rois=settings.models.det_refine_max_rois,
+                                det_cascade_name=settings.models.det_cascade_name,
+                                det_cascade_accept=settings.models.det_cascade_accept,
+                                det_cascade_borderline=settings.models.det_cascade_borderline,
+                                overload_p95_ms=settings.models.overload_p95_ms,
+                                overload_max_inflight=settings.models.overload_max_inflight,
+                                overload_det_resolution=settings.models.overload_det_resolution,
+                                overload_max_faces=settings.models.overload_max_faces,
+                                compute_threads=settings.models.compute_threads,
+                                concurrent_heads=settings.models.concurrent_heads,
+                                merge_heads=settings.models.merge_heads,
                                 backend_name=settings.models.inference_backend,
                                 force_fp16=settings.models.force_fp16,
                                 triton_uri=settings.models.triton_uri,
-                                root_dir='/models'
+                                root_dir='/models',
+                                ort_options=dict(intra_op_threads=settings.models.ort_intra_op_threads,
+                                                 inter_op_threads=settings.models.ort_inter_op_threads,
+                                                 execution_mode=settings.models.ort_execution_mode,
+                                                 graph_optimization=settings.models.ort_graph_optimization,
+                                                 enable_mem_arena=settings.models.ort_enable_mem_arena,
+                                                 providers=settings.models.ort_providers,
+                                                 model_cache=settings.models.ort_model_cache,
+                                                 fold_preprocessing=settings.models.ort_fold_preprocessing,
+                                                 roles=settings.models.ort_role_options)
                                 )
     return processing
 
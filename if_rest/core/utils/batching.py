@@ -0,0 +1,156 @@
+import asyncio
+import time
+from concurrent.futures import Executor
+from itertools import chain
+from typing import Callable, Dict, Hashable, List
+
+from if_rest.logger import logger
+
+
+class BatchScheduler:
+    def __init__(self, func: Callable, max_batch_size: int = 1, max_wait_ms: float = 5., name: str = 'batcher',
+                 executor: Executor = None):
+        """
+        Per-process dynamic micro-batcher.
+
+        Collects items submitted by concurrent requests and runs them through a single call of `func`.
+        Batch is flushed when `max_batch_size` items are queued or `max_wait_ms` has passed since the
+        first item was queued, after that each caller receives only its own rows of the output.
+        Items submitted with different keys are never mixed in one batch.
+
+        Args:
+            func (Callable): Function accepting list of items and batch key, returning sequence of results
+                             with the same length as input.
+            max_batch_size (int): Maximum number of items in a single call of `func`.
+            max_wait_ms (float): Maximum time in milliseconds an item waits for batch to fill up.
+            name (str): Name used in logs and stats.
+            executor (Executor): Executor to run `func` in, if None `func` is called inside event loop.
+        """
+        self.func = func
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self.executor = executor
+        self._queues: Dict[Hashable, List[tuple]] = {}
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+
+    @property
+    def queue_depth(self) -> int:
+        """
+        Number of items waiting to be batched.
+        """
+        return sum(len(items) for queue in self._queues.values() for items, _ in queue)
+
+    def stats(self) -> dict:
+        """
+        Report current queue depth and realized batch sizes.
+
+        Returns:
+            dict: Batcher statistics.
+        """
+        avg_batch_size = self._items / self._batches if self._batches else 0.
+        return dict(name=self.name,
+                    max_batch_size=self.max_batch_size,
+                    max_wait_ms=self.max_wait * 1000,
+                    queue_depth=self.queue_depth,
+                    pending_requests=sum(len(queue) for queue in self._queues.values()),
+                    batches=self._batches,
+                    items=self._items,
+                    last_batch_size=self._last_batch_size,
+                    avg_batch_size=avg_batch_size)
+
+    async def submit(self, items: list, key: Hashable = None):
+        """
+        Queue items for batched processing and wait for results.
+
+        Args:
+            items (list): Items to be processed.
+            key (Hashable): Batch key, only items with equal keys are processed together.
+
+        Returns:
+            Results for submitted items in the same order.
+        """
+        items = list(items)
+        if not items:
+            return []
+        if len(items) <= self.max_batch_size:
+            return await self._enqueue(items, key)
+
+        chunks = [items[i:i + self.max_batch_size] for i in range(0, len(items), self.max_batch_size)]
+        results = await asyncio.gather(*[self._enqueue(chunk, key) for chunk in chunks])
+        return list(chain.from_iterable(results))
+
+    def _enqueue(self, items: list, key: Hashable) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues.setdefault(key, [])
+        queue.append((items, future))
+
+        if sum(len(e) for e, _ in queue) >= self.max_batch_size:
+            self._flush(key, full_only=True)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return future
+
+    def _flush(self, key: Hashable, full_only: bool = False):
+        """
+        Dispatch queued items for key.
+
+        Args:
+            key (Hashable): Batch key.
+            full_only (bool): Dispatch only batches filled up to `max_batch_size`, leaving the rest queued.
+        """
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+
+        queue = self._queues.get(key, [])
+        while queue:
+            size = 0
+            taken = 0
+            for items, _ in queue:
+                if size + len(items) > self.max_batch_size:
+                    break
+                size += len(items)
+                taken += 1
+
+            if full_only and size < self.max_batch_size and taken == len(queue):
+                break
+
+            batch, queue[:] = queue[:taken], queue[taken:]
+            asyncio.ensure_future(self._dispatch(batch, key))
+
+        if queue:
+            self._timers[key] = asyncio.get_running_loop().call_later(self.max_wait, self._flush, key)
+        else:
+            self._queues.pop(key, None)
+
+    async def _dispatch(self, batch: List[tuple], key: Hashable):
+        items = list(chain.from_iterable(e for e, _ in batch))
+        self._batches += 1
+        self._items += len(items)
+        self._last_batch_size = len(items)
+
+        try:
+            t0 = time.perf_counter()
+            if self.executor is not None:
+                results = await asyncio.get_running_loop().run_in_executor(self.executor, self.func, items, key)
+            else:
+                results = self.func(items, key)
+            took = time.perf_counter() - t0
+            logger.debug(f'{self.name}: batch of {len(items)} items from {len(batch)} requests '
+                         f'took: {took * 1000:.3f} ms.')
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        offset = 0
+        for chunk, future in batch:
+            if not future.done():
+                future.set_result(results[offset:offset + len(chunk)])
+            offset += len(chunk)
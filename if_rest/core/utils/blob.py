@@ -0,0 +1,84 @@
+import threading
+
+import numba as nb
+import numpy as np
+
+# Float input buffers are reused by all heads called from the same thread, since model input is consumed
+# synchronously by inference call before next head fills the buffer.
+_local = threading.local()
+
+
+@nb.njit(cache=True, fastmath=True)
+def _normalize_nchw(crops, mean, scale, swap_rb, out):
+    n, h, w, c = crops.shape
+    for i in range(n):
+        for ch in range(c):
+            src = c - 1 - ch if swap_rb else ch
+            for y in range(h):
+                for x in range(w):
+                    out[i, ch, y, x] = (crops[i, y, x, src] - mean) * scale
+
+
+@nb.njit(cache=True, fastmath=True)
+def _normalize_nhwc(crops, mean, scale, swap_rb, out):
+    n, h, w, c = crops.shape
+    for i in range(n):
+        for y in range(h):
+            for x in range(w):
+                for ch in range(c):
+                    src = c - 1 - ch if swap_rb else ch
+                    out[i, y, x, ch] = (crops[i, y, x, src] - mean) * scale
+
+
+def as_batch(face_img) -> np.ndarray:
+    """
+    Convert single crop, list of crops or crops batch to contiguous (N, H, W, C) array.
+
+    Args:
+        face_img: A crop of (H, W, C) shape, list of such crops or batch of (N, H, W, C) shape.
+
+    Returns:
+        np.ndarray: Crops batch, input batch is returned without copying.
+    """
+    if isinstance(face_img, list):
+        return np.stack(face_img)
+    if face_img.ndim == 3:
+        face_img = face_img[None]
+    return np.ascontiguousarray(face_img)
+
+
+def _buffer(size: int) -> np.ndarray:
+    buf = getattr(_local, 'buffer', None)
+    if buf is None or buf.size < size:
+        buf = np.empty(size, dtype=np.float32)
+        _local.buffer = buf
+    return buf[:size]
+
+
+def to_blob(crops: np.ndarray, mean: float = 0., std: float = 1., swap_rb: bool = False,
+            nchw: bool = True) -> np.ndarray:
+    """
+    Normalize uint8 crops batch to float32 model input in a single pass, optionally swapping
+    red and blue channels and transposing to NCHW layout.
+
+    Result is written to reusable per-thread buffer and stays valid only until next call from the
+    same thread, so it should be consumed right away.
+
+    Args:
+        crops (np.ndarray): Crops batch of (N, H, W, C) shape.
+        mean (float): Value subtracted from every pixel.
+        std (float): Value pixels are divided by after mean subtraction.
+        swap_rb (bool): Reverse channels order (BGR to RGB).
+        nchw (bool): Output (N, C, H, W) layout, otherwise (N, H, W, C).
+
+    Returns:
+        np.ndarray: Float32 model input.
+    """
+    n, h, w, c = crops.shape
+    shape = (n, c, h, w) if nchw else (n, h, w, c)
+    out = _buffer(n * h * w * c).reshape(shape)
+    if nchw:
+        _normalize_nchw(crops, float(mean), 1. / std, swap_rb, out)
+    else:
+        _normalize_nhwc(crops, float(mean), 1. / std, swap_rb, out)
+    return out
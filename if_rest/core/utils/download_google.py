@@ -1,25 +1,28 @@
 import hashlib
+import json
+import os
 import re
 
 import requests
 from tqdm import tqdm
 
 
-def check_hash(filename, hash, algo='md5'):
-    """Check whether hash of the file content matches the expected hash.
+def get_hash(filename, algo='md5', use_cache=False):
+    """Compute hash of the file content.
     Parameters
     ----------
     filename : str
         Path to the file.
-    hash : str
-        Expected hash in hexadecimal digits.
     algo: str
         Hashing algorithm (md5, sha1, sha256, sha512)
+    use_cache: bool
+        Reuse hash stored in `<filename>.<algo>.json` sidecar if file size and
+        modification time haven't changed since it was computed.
 
     Returns
     -------
-    bool
-        Whether the file content matches the expected hash.
+    str
+        Hash of the file content in hexadecimal digits.
     """
     algos = {
         'md5': hashlib.md5,
@@ -27,6 +30,17 @@ def check_hash(filename, hash, algo='md5'):
         'sha256': hashlib.sha256,
         'sha512': hashlib.sha512,
     }
+    stat = os.stat(filename)
+    sidecar = f'{filename}.{algo}.json'
+    if use_cache and os.path.exists(sidecar):
+        try:
+            with open(sidecar, mode='r') as fl:
+                cached = json.load(fl)
+            if cached.get('size') == stat.st_size and cached.get('mtime_ns') == stat.st_mtime_ns:
+                return cached['hash']
+        except (OSError, ValueError, KeyError):
+            pass
+
     hasher = algos[algo]()
     with open(filename, 'rb') as f:
         while True:
@@ -34,10 +48,38 @@ def check_hash(filename, hash, algo='md5'):
             if not data:
                 break
             hasher.update(data)
-
     file_hash = hasher.hexdigest()
+
+    if use_cache:
+        try:
+            with open(sidecar, mode='w') as fl:
+                json.dump(dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, hash=file_hash), fl)
+        except OSError:
+            pass
+    return file_hash
+
+
+def check_hash(filename, hash, algo='md5', use_cache=False):
+    """Check whether hash of the file content matches the expected hash.
+    Parameters
+    ----------
+    filename : str
+        Path to the file.
+    hash : str
+        Expected hash in hexadecimal digits.
+    algo: str
+        Hashing algorithm (md5, sha1, sha256, sha512)
+    use_cache: bool
+        Skip hashing if file is unchanged since last check, see `get_hash`.
+
+    Returns
+    -------
+    bool
+        Whether the file content matches the expected hash.
+    """
+    file_hash = get_hash(filename, algo=algo, use_cache=use_cache)
     l = min(len(file_hash), len(hash))
-    return hasher.hexdigest()[0:l] == hash[0:l]
+    return file_hash[0:l] == hash[0:l]
 
 
 # Script taken from https://stackoverflow.com/a/39225039
@@ -4,6 +4,7 @@ Improvements:
  - Removed SciPy dependency
  - Removed parts of code not used for ArcFace alignment
  - Added Numba NJIT to speed up computations
+ - Replaced per-face Umeyama estimation with batched closed-form similarity transform
  - Added batch processing support
 """
 
@@ -51,115 +52,79 @@ def np_mean(array, axis):
 
 
 @nb.njit(cache=True, fastmath=True)
-def np_var(array, axis):
+def _similarity_batch(src, dst):
     """
-    Compute variance of a 2D array along axis 0 or 1.
-    """
-    assert array.ndim == 2
-    assert axis in (0, 1)
-    if axis == 0:
-        mean = np_mean(array, 0)
-        out = np.empty(array.shape[1], dtype=np.double)
-        n = array.shape[0]
-        for j in range(array.shape[1]):
-            s = 0.0
-            m = mean[j]
-            for i in range(n):
-                d = array[i, j] - m
-                s += d * d
-            out[j] = s / n
-        return out
-    else:
-        mean = np_mean(array, 1)
-        out = np.empty(array.shape[0], dtype=np.double)
-        n = array.shape[1]
-        for i in range(array.shape[0]):
-            s = 0.0
-            m = mean[i]
-            for j in range(n):
-                d = array[i, j] - m
-                s += d * d
-            out[i] = s / n
-        return out
+    Least-squares similarity transforms mapping each set of source points to destination points.
 
+    Args:
+        src: Source points of (N, K, 2) shape.
+        dst: Destination points of (K, 2) shape.
 
-@nb.njit(cache=True, fastmath=True)
-def np_std(array, axis):
-    """
-    Compute standard deviation of a 2D array along axis 0 or 1.
+    Returns:
+        An array of 2x3 transformation matrices of (N, 2, 3) shape.
     """
-    v = np_var(array, axis)
-    out = np.empty(v.shape[0], dtype=np.double)
-    for i in range(v.shape[0]):
-        out[i] = np.sqrt(v[i])
-    return out
+    num = src.shape[1]
+    dst_mean = np_mean(dst, 0)
+    M = np.empty((src.shape[0], 2, 3), dtype=np.double)
+    for n in range(src.shape[0]):
+        sx = 0.0
+        sy = 0.0
+        for k in range(num):
+            sx += src[n, k, 0]
+            sy += src[n, k, 1]
+        sx /= num
+        sy /= num
+
+        # dst ~ [[a, -b], [b, a]] @ src for demeaned points, a = s * cos(theta), b = s * sin(theta)
+        var = 0.0
+        dot = 0.0
+        cross = 0.0
+        for k in range(num):
+            x0 = src[n, k, 0] - sx
+            x1 = src[n, k, 1] - sy
+            y0 = dst[k, 0] - dst_mean[0]
+            y1 = dst[k, 1] - dst_mean[1]
+            var += x0 * x0 + x1 * x1
+            dot += x0 * y0 + x1 * y1
+            cross += x0 * y1 - x1 * y0
+        if var == 0:
+            M[n] = np.nan
+            continue
+        a = dot / var
+        b = cross / var
+        M[n, 0, 0] = a
+        M[n, 0, 1] = -b
+        M[n, 0, 2] = dst_mean[0] - (a * sx - b * sy)
+        M[n, 1, 0] = b
+        M[n, 1, 1] = a
+        M[n, 1, 2] = dst_mean[1] - (b * sx + a * sy)
+    return M
 
 
-@nb.njit(fastmath=True, cache=True)
-def _umeyama(src, dst, estimate_scale):
+def estimate_norm_batch(lmks, image_size=112, mode='arcface'):
     """
-    Estimates the transformation matrix using the Umeyama algorithm.
+    Estimates the norms of multiple landmarks in batch mode.
+
+    Least-squares 2D similarity transform for 5 point pairs has closed-form solution, equal to Umeyama
+    estimate with scaling, so matrices for all faces are computed in a single pass without SVD.
+    Matrices for sizes other than 112 are scaled 112 matrices, so crops of different sizes are identically
+    aligned.
 
     Args:
-        src: The source points.
-        dst: The destination points.
-        estimate_scale: Whether to estimate the scale factor.
+        lmks: An array of landmark points of (N, 5, 2) shape.
+        image_size: The size of the output images (default is 112).
+        mode: The alignment mode (default is 'arcface').
 
     Returns:
-        A 3x3 transformation matrix.
+        An array of 2x3 transformation matrices of (N, 2, 3) shape representing the estimated norms.
     """
-    num = src.shape[0]
-    dim = src.shape[1]
-
-    # Compute mean of src and dst.
-    src_mean = np_mean(src, 0)
-    dst_mean = np_mean(dst, 0)
-
-    # Subtract mean from src and dst.
-    src_demean = src - src_mean
-    dst_demean = dst - dst_mean
-
-    # Eq. (38).
-    A = dst_demean.T @ src_demean / num
-
-    # Eq. (39).
-    d = np.ones((dim,), dtype=np.double)
-    if np.linalg.det(A) < 0:
-        d[dim - 1] = -1
-
-    T = np.eye(dim + 1, dtype=np.double)
-
-    U, S, V = np.linalg.svd(A)
-
-    # Eq. (40) and (43).
-    rank = np.linalg.matrix_rank(A)
-    if rank == 0:
-        return np.nan * T
-    elif rank == dim - 1:
-        if np.linalg.det(U) * np.linalg.det(V) > 0:
-            T[:dim, :dim] = U @ V
-        else:
-            s = d[dim - 1]
-            d[dim - 1] = -1
-            T[:dim, :dim] = U @ np.diag(d) @ V
-            d[dim - 1] = s
-    else:
-        T[:dim, :dim] = U @ np.diag(d) @ V
-
-    scale = 1.0
-    if estimate_scale:
-        # Eq. (41) and (42).
-        div = np_var(src_demean, 0)
-        div = np.sum(div)
-        scale = scale / div * (S @ d)
-
-    T[:dim, dim] = dst_mean - scale * (np.ascontiguousarray(T[:dim, :dim]) @ np.ascontiguousarray(src_mean.T))
-    T[:dim, :dim] *= scale
-
-    return T
+    lmks = np.ascontiguousarray(lmks, dtype=np.double).reshape(-1, 5, 2)
+    M = _similarity_batch(lmks, arcface_src[0].astype(np.double))
+    if image_size != 112:
+        M *= image_size / 112
+    return M
 
 
-@nb.njit(cache=True, fastmath=True)
 def estimate_norm(lmk, image_size=112, mode='arcface'):
     """
     Estimates the norm of a given landmarks.
@@ -173,35 +138,7 @@ def estimate_norm(lmk, image_size=112, mode='arcface'):
         A 2x3 transformation matrix representing the estimated norm.
     """
     assert lmk.shape == (5, 2)
-
-    lmk_tran = np.ones((5, 3))
-    lmk_tran[:, :2] = lmk
-
-    assert image_size == 112
-    src = arcface_src
-
-    params = _umeyama(lmk, src[0], True)
-    M = params[0:2, :]
-    return M
-
-
-@nb.njit(cache=True, fastmath=True)
-def estimate_norm_batch(lmks, image_size=112, mode='arcface'):
-    """
-    Estimates the norms of multiple landmarks in batch mode.
-
-    Args:
-        lmks: A list of landmark points.
-        image_size: The size of the output images (default is 112).
-        mode: The alignment mode (default is 'arcface').
-
-    Returns:
-        A list of 2x3 transformation matrices representing the estimated norms.
-    """
-    Ms = []
-    for lmk in lmks:
-        Ms.append(estimate_norm(lmk, image_size, mode))
-    return Ms
+    return estimate_norm_batch(lmk[None], image_size, mode)[0]
 
 
 def norm_crop(img, landmark, image_size=112, mode='arcface'):
@@ -222,22 +159,45 @@ def norm_crop(img, landmark, image_size=112, mode='arcface'):
     return warped
 
 
-def norm_crop_batched(img, landmarks, image_size=112, mode='arcface'):
+def norm_crop_batched(img, landmarks, image_size=112, mode='arcface', out=None):
     """
     Crops multiple images to a specified size using the estimated norms.
 
     Args:
         img: The input image.
-        landmarks: A list of landmark points.
+        landmarks: An array of landmark points of (N, 5, 2) shape.
         image_size: The size of the output images (default is 112).
         mode: The alignment mode (default is 'arcface').
+        out: Preallocated uint8 array of (N, image_size, image_size, 3) shape crops are warped into.
 
     Returns:
-        A list of cropped images.
+        An array of cropped images of (N, image_size, image_size, 3) shape.
     """
     Ms = estimate_norm_batch(landmarks, image_size, mode)
-    crops = []
-    for M in Ms:
-        warped = cv2.warpAffine(img, M, (image_size, image_size), borderValue=0.0)
-        crops.append(warped)
-    return crops
+    if out is None:
+        out = np.empty((len(Ms), image_size, image_size, 3), dtype=np.uint8)
+    for M, crop in zip(Ms, out):
+        cv2.warpAffine(img, M, (image_size, image_size), dst=crop, borderValue=0.0)
+    return out
+
+
+def norm_crop_multisize(img, landmarks, outs, mode='arcface'):
+    """
+    Crops faces at several sizes with a single alignment estimate, each size is warped directly from
+    the input image.
+
+    Args:
+        img: The input image.
+        landmarks: An array of landmark points of (N, 5, 2) shape.
+        outs: A dict mapping crop size to preallocated uint8 array of (N, size, size, 3) shape.
+        mode: The alignment mode (default is 'arcface').
+
+    Returns:
+        The `outs` dict filled with cropped images.
+    """
+    Ms = estimate_norm_batch(landmarks, 112, mode)
+    for image_size, out in outs.items():
+        scale = image_size / 112
+        for M, crop in zip(Ms, out):
+            cv2.warpAffine(img, M * scale, (image_size, image_size), dst=crop, borderValue=0.0)
+    return outs
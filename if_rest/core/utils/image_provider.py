@@ -37,19 +37,25 @@ settings = Settings()
 def_headers = settings.defaults.img_req_headers
 
 
-def resize_image(image, max_size: list = None):
+def get_scale_factor(shape, max_size: list):
+    h, w = shape[:2]
+    scale_factor = min(max_size[0] / w, max_size[1] / h)
+    # If image is too small, it may contain only single face, which leads to decreased detection accuracy,
+    # so we reduce scale factor by some factor
+    if scale_factor > 2:
+        scale_factor = scale_factor * 0.7
+    return scale_factor
+
+
+def resize_image(image, max_size: list = None, scale_factor: float = None):
     if max_size is None:
         max_size = [640, 640]
 
     cw = max_size[0]
     ch = max_size[1]
-    h, w, _ = image.shape
 
-    scale_factor = min(cw / w, ch / h)
-    # If image is too small, it may contain only single face, which leads to decreased detection accuracy,
-    # so we reduce scale factor by some factor
-    if scale_factor > 2:
-        scale_factor = scale_factor * 0.7
+    if scale_factor is None:
+        scale_factor = get_scale_factor(image.shape, max_size)
 
     if scale_factor <= 1.:
         interp = cv2.INTER_AREA
@@ -0,0 +1,142 @@
+import collections
+from typing import List, Tuple
+
+import numpy as np
+
+from if_rest.logger import logger
+
+
+class OverloadController:
+    # Degradation levels: 1 - skip optional heads, 2 - additionally use cheaper detection
+    max_level = 2
+
+    def __init__(self, p95_ms: float = 0., max_inflight: int = 0, det_resolution: int = None,
+                 max_faces: int = 0, window: int = 100, recover_ratio: float = 0.5):
+        """
+        Per-process load-adaptive quality controller.
+
+        Tracks latency of recent requests and number of requests in flight. When p95 latency exceeds
+        `p95_ms` or more than `max_inflight` requests are processed concurrently, degradation level is raised
+        by one step, it's lowered back when both metrics fall below `recover_ratio` of their limits.
+        Level is changed at most once per `window // 5` finished requests, latency window is reset on change.
+
+        Args:
+            p95_ms (float): p95 request latency limit in milliseconds, 0 disables latency check.
+            max_inflight (int): Limit of concurrently processed requests, 0 disables check.
+            det_resolution (int): Detector resolution used on level 2, None keeps requested resolution.
+            max_faces (int): Faces per image limit used on level 2, 0 keeps requested limit.
+            window (int): Number of recent requests used for p95 latency estimation.
+            recover_ratio (float): Fraction of limits metrics should fall below to lower degradation level.
+        """
+        self.p95_limit = p95_ms
+        self.max_inflight = max_inflight
+        self.det_resolution = det_resolution
+        self.max_faces = max_faces
+        self.recover_ratio = recover_ratio
+        self.min_samples = max(1, window // 5)
+        self.level = 0
+        self.inflight = 0
+        self._latencies = collections.deque(maxlen=window)
+        self._samples = 0
+        self._requests = 0
+        self._degraded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.p95_limit > 0 or self.max_inflight > 0
+
+    @property
+    def p95_ms(self) -> float:
+        if not self._latencies:
+            return 0.
+        return float(np.percentile(self._latencies, 95))
+
+    def _overloaded(self) -> bool:
+        return (self.p95_limit > 0 and self.p95_ms > self.p95_limit) or \
+            (self.max_inflight > 0 and self.inflight > self.max_inflight)
+
+    def _recovered(self) -> bool:
+        return (self.p95_limit <= 0 or self.p95_ms < self.p95_limit * self.recover_ratio) and \
+            (self.max_inflight <= 0 or self.inflight <= self.max_inflight * self.recover_ratio)
+
+    def _update(self):
+        if self._samples < self.min_samples:
+            return
+        level = self.level
+        if self._overloaded():
+            level = min(self.max_level, level + 1)
+        elif self._recovered():
+            level = max(0, level - 1)
+        if level != self.level:
+            logger.warning(f'Overload controller: degradation level {self.level} -> {level} '
+                           f'(p95: {self.p95_ms:.1f} ms, in flight: {self.inflight}).')
+            self.level = level
+            self._latencies.clear()
+            self._samples = 0
+
+    def begin(self):
+        """
+        Register request start.
+        """
+        self.inflight += 1
+        self._requests += 1
+
+    def end(self, took_ms: float):
+        """
+        Register request end and update degradation level.
+
+        Args:
+            took_ms (float): Request latency in milliseconds.
+        """
+        self.inflight = max(0, self.inflight - 1)
+        self._latencies.append(took_ms)
+        self._samples += 1
+        self._update()
+
+    def degrade(self, extract_ga: bool = False, detect_masks: bool = False, limit_faces: int = 0,
+                det_resolution: int = None) -> Tuple[dict, List[str]]:
+        """
+        Adjust request parameters according to current degradation level.
+
+        Args:
+            extract_ga (bool): Requested gender/age extraction.
+            detect_masks (bool): Requested mask detection.
+            limit_faces (int): Requested faces per image limit.
+            det_resolution (int): Requested detector resolution.
+
+        Returns:
+            tuple: Adjusted parameters and list of names of degraded parameters.
+        """
+        params = dict(extract_ga=extract_ga, detect_masks=detect_masks, limit_faces=limit_faces,
+                      det_resolution=det_resolution)
+        degraded = []
+        if self.level >= 1:
+            for name in ('extract_ga', 'detect_masks'):
+                if params[name]:
+                    params[name] = False
+                    degraded.append(name)
+        if self.level >= 2:
+            if self.det_resolution and (not det_resolution or det_resolution > self.det_resolution):
+                params['det_resolution'] = self.det_resolution
+                degraded.append('det_resolution')
+            if self.max_faces > 0 and (limit_faces <= 0 or limit_faces > self.max_faces):
+                params['limit_faces'] = self.max_faces
+                degraded.append('limit_faces')
+        if degraded:
+            self._degraded += 1
+        return params, degraded
+
+    def stats(self) -> dict:
+        """
+        Report current degradation level and load metrics.
+
+        Returns:
+            dict: Controller statistics.
+        """
+        return dict(level=self.level,
+                    p95_ms=self.p95_ms,
+                    p95_limit_ms=self.p95_limit,
+                    inflight=self.inflight,
+                    max_inflight=self.max_inflight,
+                    requests=self._requests,
+                    degraded_requests=self._degraded)
@@ -0,0 +1,187 @@
+import math
+from typing import List, Tuple
+
+import cv2
+import numpy as np
+
+from if_rest.core.model_zoo.detectors.common.nms import filter_faces
+
+
+def _tile_origins(length: int, tile: int, count: int) -> List[int]:
+    """
+    Evenly spread `count` tiles of size `tile` over `length` pixels, first and last tiles touch image borders.
+    """
+    if count <= 1 or length <= tile:
+        return [0]
+    step = (length - tile) / (count - 1)
+    return [int(round(i * step)) for i in range(count)]
+
+
+def plan_tiles(shape, tile_size: List[int], overlap: float = 0.2, max_tiles: int = 16) -> Tuple[float, list]:
+    """
+    Plan grid of overlapping detector sized tiles covering image.
+
+    Image is kept at native resolution if it can be covered by at most `max_tiles` tiles, otherwise it's
+    downscaled just enough to fit into tiles budget.
+
+    Args:
+        shape (tuple): The shape of the input image.
+        tile_size (List[int]): Tile size in (W, H) form, usually detector input size.
+        overlap (float): Minimum overlap of neighbouring tiles as fraction of tile size.
+        max_tiles (int): Maximum number of tiles per image.
+
+    Returns:
+        tuple: Scale factor applied to image before tiling and list of (x, y) tile origins in scaled image.
+    """
+    h, w = shape[:2]
+    tw, th = tile_size
+    step_w = max(1, int(tw * (1 - overlap)))
+    step_h = max(1, int(th * (1 - overlap)))
+
+    # Largest scale at which image is covered by nx * ny tiles, for every grid fitting into budget
+    scale = 0.
+    grid = (1, 1)
+    for nx in range(1, max(1, max_tiles) + 1):
+        ny = max(1, max_tiles // nx)
+        grid_scale = min(1., (tw + (nx - 1) * step_w) / w, (th + (ny - 1) * step_h) / h)
+        if grid_scale > scale:
+            scale = grid_scale
+            grid = (nx, ny)
+
+    sw, sh = int(round(w * scale)), int(round(h * scale))
+    nx = min(grid[0], max(1, math.ceil((sw - tw) / step_w) + 1))
+    ny = min(grid[1], max(1, math.ceil((sh - th) / step_h) + 1))
+    origins = [(x, y) for y in _tile_origins(sh, th, ny) for x in _tile_origins(sw, tw, nx)]
+    return scale, origins
+
+
+def plan_windows(boxes: np.ndarray, window_size: List[int], image_size: List[int], max_windows: int = 8) -> list:
+    """
+    Greedily place detector sized windows around boxes, skipping boxes already inside placed windows.
+
+    Args:
+        boxes (np.ndarray): Boxes to be covered ordered by priority, in scaled image coordinates.
+        window_size (List[int]): Window size in (W, H) form.
+        image_size (List[int]): Scaled image size in (W, H) form.
+        max_windows (int): Maximum number of windows.
+
+    Returns:
+        list: List of (x, y) window origins in scaled image.
+    """
+    tw, th = window_size
+    sw, sh = image_size
+    origins = []
+    for box in boxes:
+        if len(origins) >= max_windows:
+            break
+        if any(x <= box[0] and y <= box[1] and box[2] <= x + tw and box[3] <= y + th for x, y in origins):
+            continue
+        cx, cy = (box[0] + box[2]) / 2, (box[1] + box[3]) / 2
+        x = int(min(max(0, cx - tw / 2), max(0, sw - tw)))
+        y = int(min(max(0, cy - th / 2), max(0, sh - th)))
+        origins.append((x, y))
+    return origins
+
+
+def make_tiles(image: np.ndarray, scale: float, origins: list, tile_size: List[int]) -> List[np.ndarray]:
+    """
+    Cut tiles from image scaled by `scale`, tiles crossing image border are zero padded to `tile_size`.
+
+    Args:
+        image (np.ndarray): The input image.
+        scale (float): Scale factor applied to image before tiling.
+        origins (list): List of (x, y) tile origins in scaled image.
+        tile_size (List[int]): Tile size in (W, H) form.
+
+    Returns:
+        List[np.ndarray]: Tiles of `tile_size` size.
+    """
+    if scale != 1.:
+        image = cv2.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    tw, th = tile_size
+    tiles = []
+    for x, y in origins:
+        tile = image[y:y + th, x:x + tw]
+        if tile.shape[0] < th or tile.shape[1] < tw:
+            tile = cv2.copyMakeBorder(tile, 0, th - tile.shape[0], 0, tw - tile.shape[1], cv2.BORDER_CONSTANT)
+        tiles.append(np.ascontiguousarray(tile))
+    return tiles
+
+
+def _cut_by_seam(boxes: np.ndarray, tile_ids: np.ndarray, origins: list, tile_size: List[int],
+                 image_size: List[int], margin: float = 2.) -> np.ndarray:
+    """
+    Find boxes touching tile border lying inside image, i.e. faces possibly cut by tile seam.
+    """
+    tw, th = tile_size
+    sw, sh = image_size
+    org = np.array(origins, dtype=np.float32).reshape(-1, 2)[tile_ids]
+    cut = (org[:, 0] > 0) & (boxes[:, 0] <= org[:, 0] + margin)
+    cut |= (org[:, 1] > 0) & (boxes[:, 1] <= org[:, 1] + margin)
+    cut |= (org[:, 0] + tw < sw) & (boxes[:, 2] >= org[:, 0] + tw - margin)
+    cut |= (org[:, 1] + th < sh) & (boxes[:, 3] >= org[:, 1] + th - margin)
+    return cut
+
+
+def merge_detections(predictions: list, nms_threshold: float = 0.4, min_size: float = 0, limit: int = 0) -> tuple:
+    """
+    Merge detections of the same image from several sources with NMS.
+
+    Args:
+        predictions (list): List of (boxes, probs, landmarks) tuples in the same coordinates.
+        nms_threshold (float): IoU threshold for merging duplicate detections.
+        min_size (float): Minimum face width.
+        limit (int): Maximum number of largest faces, 0 for unlimited.
+
+    Returns:
+        tuple: Merged boxes, probs and landmarks.
+    """
+    boxes = np.concatenate([b.reshape(-1, 4) for b, _, _ in predictions])
+    probs = np.concatenate([p.reshape(-1) for _, p, _ in predictions])
+    landmarks = np.concatenate([lm.reshape(-1, 5, 2) for _, _, lm in predictions])
+    dets = np.hstack((boxes, probs.reshape(-1, 1))).astype(np.float32, copy=False)
+    keep, _ = filter_faces(dets, np.array([dets.shape[0]]), thresh=nms_threshold, min_size=min_size,
+                           limit=limit)
+    return boxes[keep], probs[keep], landmarks[keep]
+
+
+def merge_tiles(predictions: list, origins: list, tile_size: List[int], image_size: List[int],
+                nms_threshold: float = 0.4, min_size: float = 0, limit: int = 0) -> tuple:
+    """
+    Translate detections of image tiles to scaled image coordinates and merge duplicates across tile seams.
+
+    Faces cut by tile seam are dropped when mostly covered by a face detected in full in overlapping tile,
+    remaining duplicates are merged with NMS.
+
+    Args:
+        predictions (list): List of (boxes, probs, landmarks) tuples, one per tile.
+        origins (list): List of (x, y) tile origins in scaled image.
+        tile_size (List[int]): Tile size in (W, H) form.
+        image_size (List[int]): Scaled image size in (W, H) form.
+        nms_threshold (float): IoU threshold for merging detections from overlapping tiles.
+        min_size (float): Minimum face width in scaled image pixels.
+        limit (int): Maximum number of largest faces, 0 for unlimited.
+
+    Returns:
+        tuple: Merged boxes, probs and landmarks in scaled image coordinates.
+    """
+    boxes = [b + np.array([x, y, x, y], dtype=b.dtype) for (b, _, _), (x, y) in zip(predictions, origins)]
+    landmarks = [lm + np.array([x, y], dtype=lm.dtype) for (_, _, lm), (x, y) in zip(predictions, origins)]
+    tile_ids = np.concatenate([np.full(len(b), i) for i, b in enumerate(boxes)]).astype(np.int64)
+    boxes = np.concatenate(boxes).reshape(-1, 4)
+    probs = np.concatenate([p for _, p, _ in predictions])
+    landmarks = np.concatenate(landmarks).reshape(-1, 5, 2)
+
+    cut = _cut_by_seam(boxes, tile_ids, origins, tile_size, image_size)
+    if cut.any() and not cut.all():
+        a, b = boxes[cut], boxes[~cut]
+        w = np.minimum(a[:, None, 2], b[None, :, 2]) - np.maximum(a[:, None, 0], b[None, :, 0])
+        h = np.minimum(a[:, None, 3], b[None, :, 3]) - np.maximum(a[:, None, 1], b[None, :, 1])
+        inter = np.clip(w, 0, None) * np.clip(h, 0, None)
+        area = np.maximum((a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1]), 1e-6)
+        covered = np.zeros(len(boxes), dtype=bool)
+        covered[cut] = (inter / area[:, None]).max(axis=1) > 0.5
+        boxes, probs, landmarks = boxes[~covered], probs[~covered], landmarks[~covered]
+
+    return merge_detections([(boxes, probs, landmarks)], nms_threshold=nms_threshold, min_size=min_size,
+                            limit=limit)
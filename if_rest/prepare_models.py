@@ -15,6 +15,22 @@ logging.basicConfig(
 )
 
 
+def role_option(role: str, name: str):
+    """
+    Get ONNX Runtime option value for model role, applying per role overrides the same way as
+    `FaceAnalysis` does.
+
+    Args:
+        role (str): Model role, one of `det`, `rec`, `ga`, `mask`.
+        name (str): Option name without `ort_` prefix.
+
+    Returns:
+        Option value for model role.
+    """
+    default = getattr(settings.models, f'ort_{name}')
+    return settings.models.ort_role_options.get(role, {}).get(name, default)
+
+
 def prepare_models(root_dir: str = '/models'):
     """
     Bootstrap models before running API.
@@ -28,25 +44,37 @@ def prepare_models(root_dir: str = '/models'):
     det_name = settings.models.det_name
     ga_name = settings.models.ga_name
     mask_detector = settings.models.mask_detector
+    det_cascade_name = settings.models.det_cascade_name
 
     max_size = settings.models.max_size
 
     max_size = validate_max_size(max_size)
 
-    models = [model for model in [det_name, rec_name, ga_name, mask_detector] if model is not None]
+    roles = {det_name: 'det', det_cascade_name: 'det', rec_name: 'rec', ga_name: 'ga', mask_detector: 'mask'}
+    models = [model for model in [det_name, det_cascade_name, rec_name, ga_name, mask_detector] if model is not None]
 
     for model in models:
+        role = roles[model]
+        im_sizes = [max_size]
+        is_detector = model in (det_name, det_cascade_name)
+        dynamic_shape = is_detector and settings.models.det_dynamic_shape
+        if is_detector and settings.models.det_resolutions and not dynamic_shape:
+            im_sizes = [validate_max_size([e, e]) for e in settings.models.det_resolutions]
         batch_size = 1
         if model_configs.models[model].get('allow_batching'):
-            if model == det_name:
+            if is_detector:
                 batch_size = settings.models.det_batch_size
             else:
                 batch_size = settings.models.rec_batch_size
         logger.info(f"Preparing '{model}' model...")
 
-        prepare_backend(model_name=model, backend_name=settings.models.inference_backend, im_size=max_size,
-                        force_fp16=settings.models.force_fp16,
-                        max_batch_size=batch_size, config=model_configs)
+        for im_size in im_sizes:
+            prepare_backend(model_name=model, backend_name=settings.models.inference_backend, im_size=im_size,
+                            force_fp16=settings.models.force_fp16,
+                            max_batch_size=batch_size, config=model_configs,
+                            onnx_cache=role_option(role, 'model_cache'),
+                            dynamic_shape=dynamic_shape,
+                            fold_input=role_option(role, 'fold_preprocessing'))
 
         logger.info(f"'{model}' model ready!")
 
@@ -58,6 +58,21 @@ class BodyExtract(BaseModel):
                                                   example=0,
                                                   description='Ignore faces smaller than this size')
 
+    det_resolution: Optional[int] = pydantic.Field(default=None,
+                                                   example=None,
+                                                   description='Pin detector resolution (closest of configured '
+                                                               'DET_RESOLUTIONS), otherwise selected per image')
+
+    det_tiling: Optional[bool] = pydantic.Field(default=False,
+                                                example=False,
+                                                description='Detect faces of large images in overlapping detector '
+                                                            'sized tiles instead of downscaling whole image')
+
+    det_refine: Optional[bool] = pydantic.Field(default=False,
+                                                example=False,
+                                                description='Run coarse detection pass and re-detect small '
+                                                            'candidate faces at higher resolution')
+
     verbose_timings: Optional[bool] = pydantic.Field(default=False,
                                                      example=True,
                                                      description='Return all timings.')
@@ -97,6 +112,21 @@ class BodyDraw(BaseModel):
                                                   example=0,
                                                   description='Ignore faces smaller than this size')
 
+    det_resolution: Optional[int] = pydantic.Field(default=None,
+                                                   example=None,
+                                                   description='Pin detector resolution (closest of configured '
+                                                               'DET_RESOLUTIONS), otherwise selected per image')
+
+    det_tiling: Optional[bool] = pydantic.Field(default=False,
+                                                example=False,
+                                                description='Detect faces of large images in overlapping detector '
+                                                            'sized tiles instead of downscaling whole image')
+
+    det_refine: Optional[bool] = pydantic.Field(default=False,
+                                                example=False,
+                                                description='Run coarse detection pass and re-detect small '
+                                                            'candidate faces at higher resolution')
+
     detect_masks: Optional[bool] = pydantic.Field(default=settings.defaults.detect_masks,
                                                   example=settings.defaults.detect_masks,
                                                   description='Detect medical masks')
@@ -1,13 +1,18 @@
-from typing import Union, Optional, List
+from typing import Union, Optional, List, Literal
 import os
 
 # 禁用 Numba 缓存以避免 multiprocessing 兼容性问题
 os.environ['NUMBA_CACHE_DIR'] = '/tmp/numba_cache'
 os.environ['NUMBA_DISABLE_JIT'] = '0'  # 保持 JIT 启用以获得性能
 
+from pydantic.v1 import validator
 from pydantic.v1.env_settings import BaseSettings
 from pydantic.v1.validators import str_validator
 
+ort_execution_modes = ('sequential', 'parallel')
+ort_graph_optimizations = ('disable', 'basic', 'extended', 'all')
+ort_roles = ('det', 'rec', 'ga', 'mask')
+
 headers = {
     'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:126.0) Gecko/20100101 Firefox/126.0'
 }
@@ -21,7 +26,15 @@ def empty_to_none(v: str) -> Optional[str]:
 
 def str_to_int_list(v):
     if isinstance(v, str):
-        val = list(map(int, v.split(',')))
+        val = [int(e) for e in v.split(',') if e.strip()]
+        return val
+    else:
+        return v
+
+
+def str_to_str_list(v):
+    if isinstance(v, str):
+        val = [e.strip() for e in v.split(',') if e.strip()]
         return val
     else:
         return v
@@ -33,6 +46,12 @@ class StrToIntList(str):
         yield str_to_int_list
 
 
+class StrToStrList(str):
+    @classmethod
+    def __get_validators__(cls):
+        yield str_to_str_list
+
+
 class EmptyStrToNone(str):
     @classmethod
     def __get_validators__(cls):
@@ -63,8 +82,66 @@ class Models(BaseSettings):
     mask_detector: Union[EmptyStrToNone, None, str] = None
     rec_batch_size: int = 1
     det_batch_size: int = 1
+    rec_dynamic_batching: bool = False
+    rec_batch_wait_ms: float = 5.
+    det_dynamic_batching: bool = False
+    det_batch_wait_ms: float = 5.
+    # Square detector input sizes loaded side by side, i.e. 320,480,640,1024 (empty = single detector of max_size)
+    det_resolutions: Union[StrToIntList, List[int]] = []
+    det_min_face_px: int = 16
+    det_target_face_size: int = 0
+    # Run detector with dynamic input shape (SCRFD and YOLOv5-face with onnx backend)
+    det_dynamic_shape: bool = False
+    # Tiled detection mode (opt-in per request): tiles overlap and maximum number of tiles per image
+    det_tile_overlap: float = 0.2
+    det_max_tiles: int = 16
+    # Two-pass detection (opt-in per request): coarse pass threshold and maximum re-detected regions per image
+    det_refine_threshold: float = 0.3
+    det_refine_max_rois: int = 8
+    # Detector cascade: fast detector run before `det_name`, confident and borderline scores (empty = disabled)
+    det_cascade_name: Union[EmptyStrToNone, None, str] = None
+    det_cascade_accept: float = 0.8
+    det_cascade_borderline: float = 0.3
+    # Overload controller: p95 request latency (ms) and in-flight requests limits triggering degraded
+    # processing (0 = not checked), detector resolution and faces limit used under overload (0 = not changed)
+    overload_p95_ms: float = 0.
+    overload_max_inflight: int = 0
+    overload_det_resolution: int = 0
+    overload_max_faces: int = 0
+    compute_threads: int = 0
+    # Run recognition, gender/age and mask heads on the same crops in parallel, one worker thread per head
+    concurrent_heads: bool = False
+    # Compose heads consuming 112x112 crops into single ONNX Runtime session (onnx backend only)
+    merge_heads: bool = False
     force_fp16: bool = False
     triton_uri: str = None
+    # ONNX Runtime session options, 0 threads means ONNX Runtime default
+    ort_intra_op_threads: int = 0
+    ort_inter_op_threads: int = 0
+    ort_execution_mode: Literal[ort_execution_modes] = 'sequential'
+    ort_graph_optimization: Literal[ort_graph_optimizations] = 'all'
+    ort_enable_mem_arena: bool = True
+    ort_providers: Union[StrToStrList, List[str]] = ['CPUExecutionProvider']
+    # Keep reshaped and ORT-optimized models in `onnx-cache` dir to speed up restarts
+    ort_model_cache: bool = True
+    # Fold input normalization into detection and recognition graphs, models take raw uint8 images
+    ort_fold_preprocessing: bool = False
+    # Per model role (det, rec, ga, mask) overrides of options above, i.e. {"det": {"intra_op_threads": 2}}
+    ort_role_options: dict = {}
+
+    @validator('ort_role_options')
+    def check_ort_role_options(cls, v):
+        allowed = dict(execution_mode=ort_execution_modes, graph_optimization=ort_graph_optimizations)
+        for role, options in v.items():
+            if role not in ort_roles:
+                raise ValueError(f"unknown role '{role}', allowed roles: {', '.join(ort_roles)}")
+            if not isinstance(options, dict):
+                raise ValueError(f"options of role '{role}' must be a dict")
+            for key, values in allowed.items():
+                if key in options and options[key] not in values:
+                    raise ValueError(f"invalid {key} '{options[key]}' for role '{role}', "
+                                     f"allowed values: {', '.join(values)}")
+        return v
 
 
 class Settings(BaseSettings):